@@ -1,87 +1,254 @@
-import json
-import os
-import random
-
-import numpy as np
-from PIL import Image
-
-# 定义路径和目录
-DATA_PATHS = ["data/BJ_data.json", "data/SH_data.json", "data/GZ_data.json", "data/SZ_data.json"]
-OUTPUT_DIRECTORIES = ["data_aug/Beijing", "data_aug/Shanghai", "data_aug/Guangzhou", "data_aug/Shenzhen"]
-OUTPUT_JSON_PATHS = ["data_aug/BJ_data.json", "data_aug/SH_data.json", "data_aug/GZ_data.json", "data_aug/SZ_data.json"]
-
-
-def mixgen(image, text, ids, lam=0.5):
-    """
-    混合图像和文本来生成新的增强数据。
-    """
-    num_samples = image.shape[0]
-    pairs = list(zip(image, text, ids))
-    random.shuffle(pairs)
-
-    mixed_images, mixed_texts, new_ids = [], [], []
-
-    for i in range(0, num_samples, 2):
-        img1, txt1, id1 = pairs[i]
-        img2, txt2, id2 = pairs[i + 1]
-
-        mixed_images.append(lam * img1 + (1 - lam) * img2)
-        mixed_texts.append(txt1 + " " + txt2)
-        new_ids.append(f"19_{id1}_{id2}_s")
-
-    return np.array(mixed_images), np.array(mixed_texts), np.array(new_ids)
-
-
-def load_and_preprocess_image(image_path):
-    """
-    加载和预处理图像。
-    """
-    img = Image.open(image_path)
-    return np.array(img) / 255.0
-
-
-def main():
-    for city_index, data_path in enumerate(DATA_PATHS):
-        output_directory = OUTPUT_DIRECTORIES[city_index]
-        output_json_path = OUTPUT_JSON_PATHS[city_index]
-
-        # 加载JSON数据
-        with open(data_path, "r") as json_file:
-            data = json.load(json_file)
-
-        # 提取图像路径、标题和ID
-        image_paths = [item["image"] for item in data]
-        captions = [item["caption"] for item in data]
-        ids = ['_'.join(item["image_id"].split('_')[1:3]) for item in data]
-
-        # 加载和预处理图像
-        images = np.array([load_and_preprocess_image(path) for path in image_paths])
-        captions_np = np.array(captions)
-        ids_np = np.array(ids)
-
-        # 数据增强
-        mixed_images, mixed_texts, new_ids = mixgen(images, captions_np, ids_np)
-
-        # 检查输出目录是否存在
-        os.makedirs(output_directory, exist_ok=True)
-
-        # 为增强数据准备条目
-        data_entries = [{
-            "mixed_texts": mixed_texts[i],
-            "mixed_images": os.path.join(output_directory, f"{new_ids[i]}.jpg"),
-            "ids": new_ids[i]
-        } for i in range(len(new_ids))]
-
-        # 保存混合图像和JSON数据
-        for i, entry in enumerate(data_entries):
-            Image.fromarray((mixed_images[i] * 255).astype(np.uint8)).save(entry["mixed_images"])
-            print(f"Saved mixed image {entry['mixed_images']}")
-
-        with open(output_json_path, "w") as json_file:
-            json.dump(data_entries, json_file, indent=4)
-
-        print(f"Data augmentation and saving for {data_path} completed.")
-
-
-if __name__ == "__main__":
-    main()
+import io
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.shard_writer import encode_jpeg, make_writer
+from common.tile_store import read_tile
+
+# 定义路径和目录
+DATA_PATHS = ["data/BJ_data.json", "data/SH_data.json", "data/GZ_data.json", "data/SZ_data.json"]
+OUTPUT_DIRECTORIES = ["data_aug/Beijing", "data_aug/Shanghai", "data_aug/Guangzhou", "data_aug/Shenzhen"]
+OUTPUT_JSON_PATHS = ["data_aug/BJ_data.json", "data_aug/SH_data.json", "data_aug/GZ_data.json", "data_aug/SZ_data.json"]
+# 混合系数方案：新图像 = λ * 图像1 + (1 - λ) * 图像2。常数（如 0.5），或为每一对图像抽取 λ：('beta', a, b)、('uniform', 低, 高)
+LAM = 0.5
+# 随机种子：相同的种子得到相同的配对和 λ（None 表示每次不同）
+SEED = None
+# 并行加载、混合和保存图像的进程数；每个进程一次处理 BATCH_SIZE 对图像，内存中只有各进程的一个小批次
+WORKERS = os.cpu_count()
+BATCH_SIZE = 32
+# 输出格式：'jpeg'（每张图像一个文件，条目写入 JSON，与之前相同）、'tar'（WebDataset tar 分片）或 'array'（uint8 像素分片加偏移索引）
+OUTPUT_FORMAT = 'jpeg'
+# 每个分片的样本数（仅 'tar' 和 'array'）
+SHARD_SIZE = 1000
+# 可选：混合前把图像缩放到模型的输入尺寸 (宽, 高)，例如 (224, 224)；None 表示保持原尺寸
+RESIZE = None
+
+
+def pair_indices(count, rng):
+    """
+    打乱索引（而不是图像）并两两配对，返回 (对数, 2) 的索引数组。
+    样本数为奇数时，剩下的一个样本与随机另一个样本配对，使每个样本都被使用。
+    """
+    indices = rng.permutation(count)
+    pairs = np.stack([indices[0:count - count % 2:2], indices[1::2]], axis=1)
+    if count % 2 and count > 1:
+        partner = indices[rng.integers(count - 1)]
+        pairs = np.concatenate([pairs, [[indices[-1], partner]]])
+    return pairs
+
+
+def sample_lams(count, schedule, rng):
+    """
+    按混合系数方案为每一对图像给出 λ（float32 数组）。
+    """
+    if isinstance(schedule, (int, float)):
+        return np.full(count, schedule, dtype=np.float32)
+    name, *params = schedule
+    if name == 'beta':
+        return rng.beta(*params, size=count).astype(np.float32)
+    if name == 'uniform':
+        return rng.uniform(*params, size=count).astype(np.float32)
+    raise ValueError(f"Unknown lambda schedule {schedule!r}")
+
+
+def mix_batch(images1, images2, lams, out=None):
+    """
+    用一次广播运算混合整批图像：out[k] = lams[k] * images1[k] + (1 - lams[k]) * images2[k]。
+
+    :param images1: (B, H, W, C) uint8 数组。
+    :param images2: 与 images1 形状相同的 uint8 数组。
+    :param lams: (B,) 混合系数。
+    :param out: 可选的 uint8 输出数组（例如共享内存中的切片）；结果截断为整数。
+    :return: 混合后的 uint8 图像。
+    """
+    lams = np.asarray(lams, dtype=np.float32).reshape((-1,) + (1,) * (images1.ndim - 1))
+    mixed = np.multiply(images1, lams, dtype=np.float32)
+    mixed += np.multiply(images2, 1 - lams, dtype=np.float32)
+    if out is None:
+        return mixed.astype(np.uint8)
+    np.copyto(out, mixed, casting='unsafe')
+    return out
+
+
+def load_image(image_path, size=None):
+    """
+    加载 uint8 RGB 图像（瓦片可以是单独文件，也可以在城市的 .pack 文件中），可选缩放到 size (宽, 高)。
+    """
+    with Image.open(io.BytesIO(read_tile(image_path))) as img:
+        img = img.convert('RGB')
+        if size is not None and img.size != size:
+            img = img.resize(size)
+        return np.asarray(img)
+
+
+def mix_files(task):
+    """
+    工作进程：加载一个小批次的图像对（可选缩放到 size），一次广播运算混合。
+    target 为输出路径列表时逐张保存并返回路径；为 'jpeg' 时返回编码后的 JPEG 字节；为 'array' 时返回 uint8 数组。
+    """
+    image_paths1, image_paths2, lams, size, target = task
+    first = load_image(image_paths1[0], size)
+    size = first.shape[1::-1]
+    images1 = np.empty((len(image_paths1),) + first.shape, dtype=np.uint8)
+    images2 = np.empty_like(images1)
+    images1[0] = first
+    for k, (image_path1, image_path2) in enumerate(zip(image_paths1, image_paths2)):
+        if k:
+            images1[k] = load_image(image_path1, size)
+        images2[k] = load_image(image_path2, size)
+    mixed = mix_batch(images1, images2, lams, out=images1)
+    if target == 'array':
+        return mixed
+    if target == 'jpeg':
+        return [encode_jpeg(image) for image in mixed]
+    for image, output_path in zip(mixed, target):
+        Image.fromarray(image).save(output_path)
+    return target
+
+
+def bounded_map(pool, fn, tasks, window):
+    """
+    与 pool.map 相同，按顺序产出结果，但最多只有 window 个任务在执行或等待读取，
+    使用方（例如分片写入器）跟不上时不会在主进程中堆积已完成的批次。
+    """
+    futures = deque()
+    for task in tasks:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(pool.submit(fn, task))
+    while futures:
+        yield futures.popleft().result()
+
+
+def _mix_shared(task):
+    # 工作进程：直接在共享内存中读取输入图像并写入混合结果，图像不经过进程间复制
+    input_name, input_shape, output_name, output_shape, pairs, lams, start = task
+    input_memory, output_memory = SharedMemory(name=input_name), SharedMemory(name=output_name)
+    try:
+        images = np.ndarray(input_shape, dtype=np.uint8, buffer=input_memory.buf)
+        mixed = np.ndarray(output_shape, dtype=np.uint8, buffer=output_memory.buf)
+        mix_batch(images[pairs[:, 0]], images[pairs[:, 1]], lams, out=mixed[start:start + len(pairs)])
+        del images, mixed
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+
+def mixgen(images, texts, ids, lam=0.5, seed=None, workers=1, batch_size=BATCH_SIZE):
+    """
+    内存中的批量 MixGen，按小批次混合图像并拼接文本。
+
+    :param images: (N, H, W, C) uint8 图像数组。
+    :param texts: N 条文本。
+    :param ids: N 个 ID。
+    :param lam: 混合系数方案（见 LAM）。
+    :param seed: 随机种子。
+    :param workers: 进程数；大于 1 时输入和输出图像放在共享内存中，各进程按小批次直接读写。
+    :param batch_size: 每次广播运算混合的图像对数。
+    :return: 混合图像 (M, H, W, C) uint8 数组、混合文本、新 ID 和每一对的 λ；M 为 N / 2 向上取整。
+    """
+    images = np.ascontiguousarray(images, dtype=np.uint8)
+    rng = np.random.default_rng(seed)
+    pairs = pair_indices(len(images), rng)
+    lams = sample_lams(len(pairs), lam, rng)
+    mixed_texts = [texts[i] + " " + texts[j] for i, j in pairs]
+    new_ids = [f"19_{ids[i]}_{ids[j]}_s" for i, j in pairs]
+    batches = range(0, len(pairs), batch_size)
+
+    if workers <= 1:
+        mixed = np.empty((len(pairs),) + images.shape[1:], dtype=np.uint8)
+        for start in batches:
+            batch = pairs[start:start + batch_size]
+            mix_batch(images[batch[:, 0]], images[batch[:, 1]], lams[start:start + batch_size],
+                      out=mixed[start:start + batch_size])
+        return mixed, mixed_texts, new_ids, lams
+
+    output_shape = (len(pairs),) + images.shape[1:]
+    input_memory = SharedMemory(create=True, size=max(images.nbytes, 1))
+    output_memory = SharedMemory(create=True, size=max(int(np.prod(output_shape)), 1))
+    try:
+        np.ndarray(images.shape, dtype=np.uint8, buffer=input_memory.buf)[:] = images
+        tasks = [(input_memory.name, images.shape, output_memory.name, output_shape, pairs[start:start + batch_size],
+                  lams[start:start + batch_size], start) for start in batches]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            list(pool.map(_mix_shared, tasks))
+        mixed = np.ndarray(output_shape, dtype=np.uint8, buffer=output_memory.buf).copy()
+    finally:
+        for memory in (input_memory, output_memory):
+            memory.close()
+            memory.unlink()
+    return mixed, mixed_texts, new_ids, lams
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+    with ProcessPoolExecutor(max_workers=WORKERS, mp_context=get_context('spawn')) as pool:
+        for city_index, data_path in enumerate(DATA_PATHS):
+            output_directory = OUTPUT_DIRECTORIES[city_index]
+            output_json_path = OUTPUT_JSON_PATHS[city_index]
+
+            # 加载JSON数据（只有路径和标题，图像在混合时才按小批次加载）
+            with open(data_path, "r") as json_file:
+                data = json.load(json_file)
+
+            # 检查输出目录是否存在
+            os.makedirs(output_directory, exist_ok=True)
+
+            # 打乱索引并配对，抽取每一对的 λ，为增强数据准备条目
+            ids = ['_'.join(item["image_id"].split('_')[1:3]) for item in data]
+            pairs = pair_indices(len(data), rng)
+            lams = sample_lams(len(pairs), LAM, rng)
+            data_entries = []
+            for (i, j), lam in zip(pairs, lams):
+                new_id = f"19_{ids[i]}_{ids[j]}_s"
+                data_entries.append({
+                    "mixed_texts": data[i]["caption"] + " " + data[j]["caption"],
+                    "mixed_images": os.path.join(output_directory, f"{new_id}.jpg"),
+                    "ids": new_id,
+                    "lam": round(float(lam), 6)
+                })
+
+            # 由进程池按小批次加载、混合，并保存为单独的图像或编码后交给分片写入器；
+            # 最多 2 * WORKERS 个批次同时在途，主进程内存与数据集大小无关
+            tasks = []
+            for start in range(0, len(pairs), BATCH_SIZE):
+                batch = pairs[start:start + BATCH_SIZE]
+                if OUTPUT_FORMAT == 'jpeg':
+                    target = [entry["mixed_images"] for entry in data_entries[start:start + BATCH_SIZE]]
+                else:
+                    target = 'jpeg' if OUTPUT_FORMAT == 'tar' else 'array'
+                tasks.append(([data[i]["image"] for i in batch[:, 0]], [data[j]["image"] for j in batch[:, 1]],
+                              lams[start:start + BATCH_SIZE], RESIZE, target))
+
+            if OUTPUT_FORMAT == 'jpeg':
+                for output_paths in bounded_map(pool, mix_files, tasks, 2 * WORKERS):
+                    for output_path in output_paths:
+                        print(f"Saved mixed image {output_path}")
+                with open(output_json_path, "w") as json_file:
+                    json.dump(data_entries, json_file, indent=4)
+            else:
+                # 分片按配对顺序写入；JSON 只记录分片列表
+                entries = iter(data_entries)
+                with make_writer(OUTPUT_FORMAT, output_directory, max_samples=SHARD_SIZE) as writer:
+                    for images in bounded_map(pool, mix_files, tasks, 2 * WORKERS):
+                        for image, entry in zip(images, entries):
+                            writer.write(entry["ids"], image, entry["mixed_texts"], {"lam": entry["lam"]})
+                with open(output_json_path, "w") as json_file:
+                    json.dump({"format": OUTPUT_FORMAT, "samples": writer.samples, "shards": writer.shards},
+                              json_file, indent=4)
+                print(f"Wrote {writer.samples} mixed images to {len(writer.shards)} {OUTPUT_FORMAT} shards")
+
+            print(f"Data augmentation and saving for {data_path} completed.")
+
+
+if __name__ == "__main__":
+    main()
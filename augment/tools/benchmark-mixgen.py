@@ -0,0 +1,129 @@
+import glob
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import augment
+
+# Benchmark parameters
+sample_tiles = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'crawl', 'tiles', '*', '*.jpg')
+image_count = 201  # The sample tiles are copied until there are this many; odd, to cover the unpaired image
+seed = 0
+schedule = ('beta', 0.4, 0.4)
+workers = max(2, os.cpu_count())
+
+
+# Former path: every image of the city in one float64 array, pairs shuffled and mixed one at a time in Python
+def legacy_mixgen(image, text, ids, lam=0.5):
+    pairs = list(zip(image, text, ids))
+    random.shuffle(pairs)
+    mixed_images, mixed_texts, new_ids = [], [], []
+    for i in range(0, image.shape[0] - 1, 2):
+        img1, txt1, id1 = pairs[i]
+        img2, txt2, id2 = pairs[i + 1]
+        mixed_images.append(lam * img1 + (1 - lam) * img2)
+        mixed_texts.append(txt1 + " " + txt2)
+        new_ids.append(f"19_{id1}_{id2}_s")
+    return np.array(mixed_images), np.array(mixed_texts), np.array(new_ids)
+
+
+def run_legacy(data, output_directory):
+    ids = ['_'.join(item["image_id"].split('_')[1:3]) for item in data]
+    images = np.array([np.array(Image.open(item["image"])) / 255.0 for item in data])
+    mixed_images, mixed_texts, new_ids = legacy_mixgen(images, np.array([item["caption"] for item in data]),
+                                                       np.array(ids))
+    for image, new_id in zip(mixed_images, new_ids):
+        Image.fromarray((image * 255).astype(np.uint8)).save(os.path.join(output_directory, f"{new_id}.jpg"))
+
+
+def run_streaming():
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        augment.main()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    with open(augment.OUTPUT_JSON_PATHS[0]) as f:
+        return json.load(f)
+
+
+def measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == "__main__":
+    samples = sorted(glob.glob(sample_tiles))
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        data = []
+        for i in range(image_count):
+            path = os.path.join(directory, f"19_{i}_{i}_s.jpg")
+            shutil.copy(samples[i % len(samples)], path)
+            data.append({"caption": f"This is Figure {i}", "image": path, "image_id": f"19_{i}_{i}_s"})
+        data_path = os.path.join(directory, "data.json")
+        with open(data_path, "w") as f:
+            json.dump(data, f)
+        legacy_directory = os.path.join(directory, "legacy")
+        os.makedirs(legacy_directory)
+        augment.DATA_PATHS = [data_path]
+        augment.OUTPUT_DIRECTORIES = [os.path.join(directory, "streaming")]
+        augment.OUTPUT_JSON_PATHS = [os.path.join(directory, "streaming.json")]
+        augment.LAM, augment.SEED = schedule, seed
+
+        # The former path cannot take an odd count, so it gets one image less
+        _, legacy_time, legacy_peak = measure(run_legacy, data[:-1], legacy_directory)
+        entries, streaming_time, streaming_peak = measure(run_streaming)
+        ok &= run_streaming() == entries
+        logger.info(f"{image_count} images, {len(entries)} pairs, same output for the same seed: {ok}")
+        logger.info(f"legacy: {legacy_time:.2f}s, peak {legacy_peak / 1e6:.1f} MB allocated")
+        logger.info(f"streaming ({augment.WORKERS} processes, batches of {augment.BATCH_SIZE}): "
+                    f"{streaming_time:.2f}s, peak {streaming_peak / 1e6:.1f} MB allocated in this process")
+
+        # The seed reproduces the pairs; compare the pixels before JPEG encoding with the former float64 formula,
+        # which truncates after a /255 and *255 round trip and so can be one level lower
+        images = np.stack([augment.load_image(item["image"]) for item in data])
+        pairs = augment.pair_indices(image_count, np.random.default_rng(seed))
+        lams = np.array([entry["lam"] for entry in entries], dtype=np.float32)
+        reference = ((lams[:, None, None, None] * (images[pairs[:, 0]] / 255.0)
+                      + (1 - lams[:, None, None, None]) * (images[pairs[:, 1]] / 255.0)) * 255).astype(np.uint8)
+        difference = int(np.abs(reference.astype(np.int16) - augment.mix_batch(images[pairs[:, 0]],
+                                                                               images[pairs[:, 1]], lams)).max())
+        ok &= difference <= 1 and len(entries) == (image_count + 1) // 2
+        logger.info(f"largest pixel difference to the float64 formula: {difference}")
+
+    # In-memory API: per-pair Python loop against broadcast mini-batches, in one process and across a pool
+    # sharing the image buffers
+    texts = [item["caption"] for item in data]
+    ids = [str(i) for i in range(image_count)]
+    start = time.perf_counter()
+    legacy_mixgen(images[:-1] / 255.0, np.array(texts[:-1]), np.array(ids[:-1]))
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    serial = augment.mixgen(images, texts, ids, schedule, seed)
+    serial_time = time.perf_counter() - start
+    start = time.perf_counter()
+    shared = augment.mixgen(images, texts, ids, schedule, seed, workers=workers)
+    shared_time = time.perf_counter() - start
+    same = all(np.array_equal(a, b) for a, b in zip(serial, shared))
+    ok &= same
+    logger.info(f"mixgen in memory: per-pair loop (float64) {loop_time * 1000:.0f} ms, "
+                f"batched {serial_time * 1000:.0f} ms, "
+                f"{workers} processes on shared memory {shared_time * 1000:.0f} ms (pool start-up included, "
+                f"{os.cpu_count()} CPUs), same result: {same}")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,143 @@
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import augment
+from common.shard_writer import ArrayShard, iter_tar_samples
+
+# Benchmark parameters
+sample_tiles = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'crawl', 'tiles', '*', '*.jpg')
+image_count = 2000  # The sample tiles are copied until there are this many
+shard_size = 256
+resize = (224, 224)  # Model input size the shards are pre-resized to
+seed = 0
+
+
+def run(directory, data_path, output_format):
+    augment.DATA_PATHS = [data_path]
+    augment.OUTPUT_DIRECTORIES = [os.path.join(directory, output_format)]
+    augment.OUTPUT_JSON_PATHS = [os.path.join(directory, f"{output_format}.json")]
+    augment.OUTPUT_FORMAT, augment.SHARD_SIZE, augment.RESIZE, augment.SEED = output_format, shard_size, resize, seed
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.perf_counter()
+    try:
+        augment.main()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+    with open(augment.OUTPUT_JSON_PATHS[0]) as f:
+        return json.load(f), elapsed
+
+
+def decode(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+# Dataloader-style reads: every sample's pixels and text, in order
+def read_files(entries):
+    for entry in entries:
+        with open(entry["mixed_images"], 'rb') as f:
+            yield entry["ids"], decode(f.read()), entry["mixed_texts"]
+
+
+def read_tar(shards):
+    for key, data, text, _ in iter_tar_samples(shards):
+        yield key, decode(data), text
+
+
+def read_array(shards):
+    for shard in shards:
+        shard = ArrayShard(shard)
+        for image, text, record in shard:
+            yield record["key"], np.array(image), text
+
+
+# The same reads without decoding, which leaves the cost of reaching the bytes
+def read_files_raw(entries):
+    for entry in entries:
+        with open(entry["mixed_images"], 'rb') as f:
+            yield entry["ids"], f.read(), entry["mixed_texts"]
+
+
+def read_tar_raw(shards):
+    return ((key, data, text) for key, data, text, _ in iter_tar_samples(shards))
+
+
+def file_count(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def disk_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+if __name__ == "__main__":
+    samples = sorted(glob.glob(sample_tiles))
+    if not samples:
+        logger.error(f"No sample tiles in {sample_tiles}")
+        sys.exit(1)
+
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        data = []
+        os.makedirs(os.path.join(directory, "tiles"))
+        for i in range(image_count):
+            path = os.path.join(directory, "tiles", f"19_{i}_{i}_s.jpg")
+            shutil.copy(samples[i % len(samples)], path)
+            data.append({"caption": f"This is Figure {i}", "image": path, "image_id": f"19_{i}_{i}_s"})
+        data_path = os.path.join(directory, "data.json")
+        with open(data_path, "w") as f:
+            json.dump(data, f)
+
+        entries, jpeg_time = run(directory, data_path, 'jpeg')
+        tar_manifest, tar_time = run(directory, data_path, 'tar')
+        array_manifest, array_time = run(directory, data_path, 'array')
+        logger.info(f"{len(entries)} mixed pairs at {resize[0]}x{resize[1]}, shards of {shard_size}")
+        for name, elapsed, path in [('jpeg files', jpeg_time, 'jpeg'), ('tar shards', tar_time, 'tar'),
+                                    ('array shards', array_time, 'array')]:
+            path = os.path.join(directory, path)
+            logger.info(f"write {name}: {elapsed:.2f}s, {file_count(path)} files, {disk_size(path) / 1e6:.1f} MB")
+
+        readers = [('jpeg files, bytes only', read_files_raw(entries)),
+                   ('tar shards, bytes only', read_tar_raw(tar_manifest["shards"])),
+                   ('jpeg files', read_files(entries)), ('tar shards', read_tar(tar_manifest["shards"])),
+                   ('array shards', read_array(array_manifest["shards"]))]
+        results = {}
+        for name, reader in readers:
+            start = time.perf_counter()
+            results[name] = list(reader)
+            elapsed = time.perf_counter() - start
+            logger.info(f"read {name}: {len(results[name]) / elapsed:.0f} samples/s")
+
+        # Same samples in the same order; JPEG files and tar shards hold the same encoding, array shards the
+        # pixels before encoding, which the seed lets us mix again
+        files, tar, array = results['jpeg files'], results['tar shards'], results['array shards']
+        same_text = [(k, t) for k, _, t in files] == [(k, t) for k, _, t in tar] == [(k, t) for k, _, t in array]
+        same_tar = all(np.array_equal(a[1], b[1]) for a, b in zip(files, tar))
+        pairs = augment.pair_indices(image_count, np.random.default_rng(seed))
+        lams = np.array([entry["lam"] for entry in entries], dtype=np.float32)
+        same_array = all(
+            np.array_equal(augment.mix_batch(augment.load_image(data[i]["image"], resize)[None],
+                                             augment.load_image(data[j]["image"], resize)[None], [lam])[0], image)
+            for (i, j), lam, (_, image, _) in zip(pairs, lams, array))
+        # The shards are plain tar files for other readers, e.g. the webdataset package
+        names = [name for shard in tar_manifest["shards"] for name in tarfile.open(shard).getnames()]
+        same_text &= names[::3] == [f"{key}.jpg" for key, _, _ in tar]
+        ok &= same_text and same_tar and same_array and array_manifest["samples"] == len(entries)
+        logger.info(f"same keys and texts: {same_text}, tar pixels identical to the files: {same_tar}, "
+                    f"array pixels identical to the mixed images before encoding: {same_array}")
+    sys.exit(0 if ok else 1)
@@ -1,87 +1,45 @@
 import asyncio
-import base64
-import glob
-import json
 import os
-import random
-import uuid
+import sys
 
-import websockets
 from loguru import logger
 
-
-def get_image_base64(image_path):
-    """
-    Encodes the given image as a Base64 string.
-
-    :param image_path: Path to the image file.
-    :return: Base64 encoded string of the image.
-    """
-    with open(image_path, 'rb') as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode()
-        return "data:image/jpeg;base64," + encoded_image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.caption_backends import make_backend
+from common.caption_store import CaptionStore, ProcessedIndex, image_key
+from common.tile_prefilter import load_rejected
+from common.tile_store import list_tile_paths, read_tile
 
 
-async def process_image(semaphore, image_path):
+def get_image_source(image_path):
     """
-    Processes a single image and returns the description split into sentences.
+    Returns what the caption backend should read for the given image.
 
-    :param semaphore: Limit the number of tasks running simultaneously
     :param image_path: Path to the image file.
-    :return: List of description sentences.
+    :return: The path itself if the file exists (it is streamed in chunks), otherwise the tile's bytes
+             from the city's .pack file, as a zero-copy view.
     """
-    MAX_RETRIES = 3
-    for attempt in range(MAX_RETRIES):
-        try:
-            async with semaphore:
-                session_hash = uuid.uuid4().hex
-                uri = 'ws://llama-adapter.opengvlab.com/queue/join'
-                async with websockets.connect(uri) as websocket:
-                    # Sending first message to the server
-                    msg1 = {"fn_index": 1, "session_hash": session_hash}
-                    await websocket.send(json.dumps(msg1))
-                    while True:
-                        response = json.loads(await websocket.recv())
-                        if response["msg"] == "estimation":
-                            logger.info(f"First responses: {session_hash}, {response}")
-                            break
-
-                    # Sending second message containing the image
-                    image_base64 = get_image_base64(image_path)
-                    msg2 = {
-                        "fn_index": 1,
-                        "data": [image_base64, "", 128, 0.1, 0.75],
-                        "event_data": None,
-                        "session_hash": session_hash
-                    }
-                    await websocket.send(json.dumps(msg2))
-                    while True:
-                        response = json.loads(await websocket.recv())
-                        if response["msg"] == "process_completed":
-                            logger.info(f"Second responses: {session_hash}, {response}")
-                            break
-
-                    # Splitting the description into sentences
-                    description = response["output"]["data"][0]
-                    sentences = description.split('. ')
-                    logger.info(f"Processed image: {image_path}")
-                    return sentences
-        except Exception as e:
-            wait_time = random.uniform(1, 3)  # Random wait time between 1 and 3 seconds
-            logger.warning(f"Exception on attempt {attempt + 1}: {str(e)}. Retrying...")
-            await asyncio.sleep(wait_time)  # wait a second and try again
-
-    logger.error(f"Failed to process image after {MAX_RETRIES} attempts: {image_path}")
-    return []
+    if os.path.exists(image_path):
+        return image_path
+    return read_tile(image_path)
 
 
-BATCH_SIZE = 5
+# Caption backend: 'gradio' (the public LLaMA-Adapter V2 queue), 'http' (a generic HTTP endpoint, needs a 'url'),
+# 'local' (a transformers model batched on this machine's CPU) or 'mock' (deterministic, for benchmarks); see
+# common/caption_backends.py for the options of each. max_in_flight is the number of images (or local batches)
+# captioned at once; max_size/quality downscale and/or re-encode images first (None keeps them).
+BACKEND = 'gradio'
+BACKEND_OPTIONS = {'max_in_flight': 32, 'max_size': None, 'quality': None}
+# Skip tiles rejected by img-prefilter.py (listed in pairs/<city>_prefilter.csv) as open water, forest, desert or blank
+SKIP_PREFILTERED = True
+# Also write the legacy <city>_captions.json at the end of the run (tools/export-captions.py does it on demand)
+EXPORT_JSON = False
 
 
 async def main():
     """
-    Main function to process all images in the specified directories and save
-    the captions as JSON objects.
+    Main function to process all images in the specified directories and append
+    the captions to one JSONL caption store per city.
     """
     # Create 'pairs' directory if it does not exist
     output_directory = 'pairs'
@@ -89,65 +47,60 @@ async def main():
 
     base_directory = '../tiles'
     cities = ['Beijing', 'Guangzhou', 'Shanghai', 'Shenzhen']
-    semaphore = asyncio.Semaphore(1000)
+    client = make_backend(BACKEND, **BACKEND_OPTIONS)
 
     for city in cities:
         directory_path = os.path.join(base_directory, city)
         logger.info(f"Processing directory: {directory_path}")
 
-        # Finding all image files in the directory
-        pattern = os.path.join(directory_path, '*.jpg')
-        image_paths = glob.glob(pattern)
+        # Finding all image files in the directory (or in its .pack file)
+        image_paths = list_tile_paths(directory_path)
 
-        # Load existing data if the file exists
+        # Open the city's caption store; captions of a legacy JSON file are imported once
         city_json_filename = os.path.join(output_directory, f"{city}_captions.json")
-        existing_data = []
-        if os.path.exists(city_json_filename):
-            with open(city_json_filename, 'r') as file:
-                existing_data = json.load(file)
-
-        # Convert existing data into a set for easy lookup
-        existing_images = set(item["image"] for sublist in existing_data for item in sublist)
-
-        new_image_paths = []
-        for image_path in image_paths:
-            base_name = '/'.join(image_path.split('/')[-2:])
-            if base_name not in existing_images:
-                new_image_paths.append(image_path)
-
-        if not new_image_paths:
-            logger.info(f"All images for {city} have already been processed.")
-            continue
-
-        # Process new images and generate new data
-        new_data = []
-        for i in range(0, len(new_image_paths), BATCH_SIZE):
-            batch_paths = new_image_paths[i:i + BATCH_SIZE]
-            tasks = [process_image(semaphore, image_path) for image_path in batch_paths]
-            descriptions = await asyncio.gather(*tasks)
-
-            batch_results = []
-            for image_path, description_sentences in zip(batch_paths, descriptions):
-                image_name = os.path.basename(image_path)
-                image_results = [{"caption": sentence.strip(), "image": os.path.join(city, image_name)} for sentence in
-                                 description_sentences if sentence]
-                batch_results.extend(image_results)
-
-            new_data.extend(batch_results)
-            logger.info(f"Processed batch {i // BATCH_SIZE + 1} for {city}")
-
-            # Flatten existing_data list if it's nested
-            existing_data_flat = [item for sublist in existing_data for item in sublist]
-
-            # Combine existing and new data, then write to the JSON file
-            existing_data_flat.extend(new_data)
-
-            # Wrap the entire existing_data_flat list in an additional list
-            combined_data = [existing_data_flat]
-
-            with open(city_json_filename, 'w') as file:
-                json.dump(combined_data, file, indent=2)
-            logger.info(f"Saved {len(new_data)} results to {city_json_filename}")
+        with CaptionStore(os.path.join(output_directory, f"{city}_captions.jsonl")) as store:
+            if not len(store) and os.path.exists(city_json_filename):
+                logger.info(f"Imported {store.import_json(city_json_filename)} images from {city_json_filename}")
+
+            # Keys are paths relative to base_directory (e.g. Beijing/18_1_2_s.jpg), the same as the records' "image"
+            image_keys = {image_key(image_path, base_directory): image_path for image_path in image_paths}
+            index = ProcessedIndex(store.keys_path)
+            new_image_paths = [image_keys[key] for key in index.missing(image_keys)]
+            # Images img-filter.py routed out of the store are not captioned again (packed tiles stay listed)
+            filtered = load_rejected(os.path.join(output_directory, f"{city}_filtered.csv"))
+            if filtered:
+                count = len(new_image_paths)
+                new_image_paths = [path for path in new_image_paths if image_key(path, base_directory) not in filtered]
+                logger.info(f"Skipping {count - len(new_image_paths)} images routed out by img-filter.py")
+            if SKIP_PREFILTERED:
+                rejected = load_rejected(os.path.join(output_directory, f"{city}_prefilter.csv"))
+                if rejected:
+                    count = len(new_image_paths)
+                    new_image_paths = [path for path in new_image_paths
+                                       if image_key(path, base_directory) not in rejected]
+                    logger.info(f"Skipping {count - len(new_image_paths)} tiles rejected by the pre-filter")
+
+            if not new_image_paths:
+                logger.info(f"All images for {city} have already been processed.")
+                index.close()
+                continue
+
+            # Caption new images as a continuous stream; results arrive in completion order and are appended
+            # to the store as they come
+            def on_done(image_path, description):
+                if description is not None:
+                    # Splitting the description into sentences
+                    store.add(image_key(image_path, base_directory),
+                              [sentence.strip() for sentence in description.split('. ') if sentence])
+                    logger.info(f"Processed image: {image_path}")
+
+            await client.run(new_image_paths, get_image_source, on_done)
+            client.log_summary(city)
+            store.sync()
+            index.refresh().close()
+            if EXPORT_JSON:
+                store.export_json(city_json_filename)
+                logger.info(f"Exported {len(store)} images to {city_json_filename}")
 
 
 # Running the main function
@@ -1,72 +1,85 @@
-import json
 import os
 import shutil
+import sys
 
-
-def find_and_extract_images_with_keyword(json_file, keyword):
-    """
-    Searches for images containing the keyword in the given JSON file and returns them.
-    :param json_file: Path to the JSON file to be searched.
-    :param keyword: The keyword to look for in the captions.
-    :return: A list of entries that match the keyword and a list of images associated with those entries.
-    """
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-
-    images_with_keyword = set()  # Use a set to ensure uniqueness of images
-    extracted_data = []
-
-    # 'data' is an outer list containing nested lists
-    for entry_group in data:
-        # 'entry_group' is an inner list
-        for entry in entry_group:
-            if keyword in entry['caption']:
-                images_with_keyword.add(entry['image'])
-                extracted_data.append(entry)
-
-    return extracted_data, list(images_with_keyword)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.caption_filter import CaptionFilter
+from common.caption_store import CaptionStore
+from common.tile_prefilter import load_rejected, write_report
+from common.tile_store import PACK_SUFFIX
 
 
-def remove_images_from_data(json_file, images_to_remove):
+def filter_city(caption_filter, json_dir, city):
     """
-    Removes specified image entries from a JSON file.
-    :param json_file: Path to the JSON file to be modified.
-    :param images_to_remove: List of images to be removed from the file.
+    Routes every image of a city's caption store to the kept store or to a category store, in one streaming pass.
+
+    The kept records replace the city's store, and the records of each category are appended to
+    <json_dir>/<category>/<city>_captions.jsonl. Legacy <city>_captions.json files are imported first where there is
+    no store yet, and rewritten once at the end. The routed images are added to <json_dir>/<city>_filtered.csv, which
+    img-caption-generator.py skips: tiles in a city's .pack cannot be moved out of the city, and would otherwise be
+    captioned again.
+    :param caption_filter: The CaptionFilter holding the rules.
+    :param json_dir: Directory of the caption stores.
+    :param city: Name of the city.
+    :return: A dict of category to the images routed to it.
     """
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-
-    # Remove entries matching the specified images
-    for entry_group in data:
-        entry_group[:] = [entry for entry in entry_group if entry['image'] not in images_to_remove]
-
-    # Remove any empty entry groups
-    data[:] = [entry_group for entry_group in data if entry_group]
-
-    # Write the updated data back to the JSON file
-    with open(json_file, 'w') as f:
-        json.dump(data, f, indent=2)
-
-
-def save_to_new_json(data, new_json_file):
-    """
-    Saves the data to a new JSON file. If the file already exists, this function appends data rather than overwriting it.
-    :param data: The data to be saved.
-    :param new_json_file: Path of the file where data is to be saved.
-    """
-    existing_data = []
-
-    # If the file already exists, read its content
-    if os.path.exists(new_json_file):
-        with open(new_json_file, 'r') as f:
-            existing_data = json.load(f)
-
-    # Add the new data
-    existing_data.extend(data)
-
-    # Write the data back
-    with open(new_json_file, 'w') as f:
-        json.dump(existing_data, f, indent=4)
+    jsonl_file = os.path.join(json_dir, city + "_captions.jsonl")
+    json_file = os.path.join(json_dir, city + "_captions.json")
+    filtered_file = os.path.join(json_dir, city + "_captions.filtered.jsonl")
+    if not os.path.exists(jsonl_file) and not os.path.exists(json_file):
+        print(f"Warning: No captions for {city}!")
+        return {}
+
+    source = CaptionStore(jsonl_file)
+    if not len(source) and os.path.exists(json_file):
+        source.import_json(json_file)
+    source.sync()
+
+    kept = CaptionStore(filtered_file)
+    buckets = {}
+    routed = {}
+    for image, captions, category in caption_filter.route(source.records()):
+        if category is None:
+            kept.add(image, captions)
+            continue
+        if category not in buckets:
+            buckets[category] = CaptionStore(os.path.join(json_dir, category, city + "_captions.jsonl"))
+            bucket_json_file = os.path.join(json_dir, category, city + "_captions.json")
+            if not len(buckets[category]) and os.path.exists(bucket_json_file):
+                buckets[category].import_json(bucket_json_file)
+        if image not in buckets[category]:
+            buckets[category].add(image, captions)
+        routed.setdefault(category, []).append(image)
+    # Images stored without any caption record (e.g. an empty description) never reach route(); their keys are
+    # carried over so the caption generator still counts them as processed
+    routed_images = {image for images in routed.values() for image in images}
+    for image in sorted(source.keys() - kept.keys() - routed_images):
+        kept.add(image, [])
+    source.close()
+    kept.close()
+
+    # Swap in the kept records; the processed-image index is rebuilt from the new key file on its next use
+    os.replace(filtered_file, source.path)
+    os.replace(kept.keys_path, source.keys_path)
+    index_file = os.path.splitext(source.path)[0] + '.index'
+    if os.path.exists(index_file):
+        os.remove(index_file)
+
+    # Same format as the pre-filter's report, without features
+    filtered_csv = os.path.join(json_dir, city + "_filtered.csv")
+    filtered = load_rejected(filtered_csv)
+    for category, images in routed.items():
+        filtered.update(dict.fromkeys(images, category))
+    if filtered:
+        write_report(filtered_csv, ((image, category, None) for image, category in filtered.items()))
+
+    if os.path.exists(json_file):
+        with CaptionStore(jsonl_file) as store:
+            store.export_json(json_file)
+    for category, bucket in buckets.items():
+        bucket.export_json(os.path.join(json_dir, category, city + "_captions.json"))
+        bucket.close()
+    return routed
 
 
 def move_images_to_folder(images, source_folder, destination_folder):
@@ -90,29 +103,31 @@ def move_images_to_folder(images, source_folder, destination_folder):
 
 
 img_base_dir = "../tiles"
-img_filter_base_dir = img_base_dir + '/ocean'
 json_dir = 'pairs'
 city_list = ['Beijing', 'Shanghai', 'Guangzhou', 'Shenzhen']
+# Categories in priority order: an image matching several goes to the first. Keywords match anywhere in a caption;
+# compiled regexes can be used too, e.g. re.compile(r'\bsea\b')
+rules = {
+    'ocean': ['ocean'],
+    # 'forest': ['forest'],
+    # 'desert': ['desert'],
+}
 
 if __name__ == "__main__":
-    # Specifying paths for multiple JSON files
+    caption_filter = CaptionFilter(rules)
     for city in city_list:
-        json_file = os.path.join(json_dir, city + "_captions.json")
-
-        # Find images based on the keyword
-        extracted_data, images_to_remove = find_and_extract_images_with_keyword(json_file, 'ocean')
-
-        # Move found images to a specific folder
-        move_images_to_folder(images_to_remove, os.path.join(img_base_dir, city),
-                              os.path.join(img_filter_base_dir, city))
-
-        # Remove found images from the original data
-        remove_images_from_data(json_file, images_to_remove)
-
-        # Save the extracted data to a new JSON file
-        save_to_new_json(extracted_data, os.path.join(img_filter_base_dir, 'ocean.json'))
-
-        # Print the list of removed images
-        print("Removed images:")
-        for img in images_to_remove:
-            print(img)
+        routed = filter_city(caption_filter, json_dir, city)
+
+        for category, images in routed.items():
+            # Move the category's images to <img_base_dir>/<category>/<city>; packed tiles stay in the pack
+            if os.path.exists(os.path.join(img_base_dir, city) + PACK_SUFFIX):
+                print(f"{city} is packed: its {category} images stay in the pack, listed in "
+                      f"{os.path.join(json_dir, city + '_filtered.csv')}")
+            else:
+                move_images_to_folder(images, os.path.join(img_base_dir, city),
+                                      os.path.join(img_base_dir, category, city))
+
+            # Print the list of removed images
+            print(f"Removed {category} images:")
+            for img in images:
+                print(img)
@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.caption_filter import CaptionFilter
+from common.caption_store import CaptionStore, ProcessedIndex, image_key
+from common.tile_prefilter import DEFAULT_THRESHOLDS, prefilter_tiles, write_report
+from common.tile_store import list_tile_paths
+
+# Tiles are classified with these thresholds (see common/tile_prefilter.py); rejected tiles are listed in
+# pairs/<city>_prefilter.csv, which img-caption-generator.py reads to skip them
+THRESHOLDS = dict(DEFAULT_THRESHOLDS)
+WORKERS = None  # Processes computing tile features (None for one per CPU)
+# Caption words per category, to check the pre-filter against tiles that were already captioned. Whole words only,
+# so that e.g. 'sea' does not match "season" or 'sand' "thousand"
+CAPTION_RULES = {
+    'ocean': [re.compile(r'\b(?:oceans?|seas?|water)\b')],
+    'forest': [re.compile(r'\b(?:forests?|trees?|vegetation)\b')],
+    'desert': [re.compile(r'\b(?:deserts?|sand|sands)\b')],
+}
+
+
+def caption_agreement(store_path, rejected):
+    """
+    For the rejected tiles that already have captions, how many captions name the category the pixels gave.
+
+    Blank tiles have no land cover for a caption to name, so they are only counted, apart from the agreement.
+    :return: (captioned rejected land-cover tiles, of which agreeing, captioned blank tiles), or None if the city
+             has no caption store.
+    """
+    if not os.path.exists(store_path):
+        return None
+    caption_filter = CaptionFilter(CAPTION_RULES, ignore_case=True)
+    captioned, agreeing, blank = 0, 0, 0
+    with CaptionStore(store_path) as store:
+        for image, captions, category in caption_filter.route(record for record in store.records()
+                                                              if record['image'] in rejected):
+            if rejected[image] == 'blank':
+                blank += 1
+                continue
+            captioned += 1
+            agreeing += category == rejected[image]
+    return captioned, agreeing, blank
+
+
+def main():
+    """
+    Classifies every tile of each city from cheap pixel statistics and reports the caption calls saved.
+    """
+    output_directory = 'pairs'
+    os.makedirs(output_directory, exist_ok=True)
+
+    base_directory = '../tiles'
+    cities = ['Beijing', 'Guangzhou', 'Shanghai', 'Shenzhen']
+
+    for city in cities:
+        directory_path = os.path.join(base_directory, city)
+        image_paths = list_tile_paths(directory_path)
+        if not image_paths:
+            logger.info(f"No tiles in {directory_path}")
+            continue
+
+        start = time.perf_counter()
+        rows = [(image_key(path, base_directory), category, features)
+                for path, category, features in prefilter_tiles(image_paths, THRESHOLDS, WORKERS)]
+        elapsed = time.perf_counter() - start
+        write_report(os.path.join(output_directory, f"{city}_prefilter.csv"), rows)
+
+        rejected = {image: category for image, category, _ in rows if category}
+        # Only rejected tiles that are not captioned yet save a call
+        index = ProcessedIndex(os.path.join(output_directory, f"{city}_captions.keys"))
+        uncaptioned = index.missing(image for image, _, _ in rows)
+        index.close()
+        saved = sum(image in rejected for image in uncaptioned)
+
+        counts = Counter(rejected.values())
+        logger.info(f"{city}: {len(rows)} tiles classified in {elapsed:.1f}s ({len(rows) / elapsed:.0f}/s), "
+                    f"{len(rejected)} rejected ({', '.join(f'{n} {c}' for c, n in counts.most_common()) or 'none'})")
+        logger.info(f"{city}: {saved} of {len(uncaptioned)} caption calls saved "
+                    f"({saved / len(uncaptioned) if uncaptioned else 0:.1%})")
+        agreement = caption_agreement(os.path.join(output_directory, f"{city}_captions.jsonl"), rejected)
+        if agreement and agreement[0]:
+            logger.info(f"{city}: captions of {agreement[1]} of {agreement[0]} already captioned rejected tiles "
+                        f"name the same category")
+        if agreement and agreement[2]:
+            logger.info(f"{city}: {agreement[2]} already captioned tiles were rejected as blank (not compared)")
+
+
+if __name__ == "__main__":
+    main()
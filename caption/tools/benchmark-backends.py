@@ -0,0 +1,124 @@
+import asyncio
+import importlib.util
+import io
+import os
+import sys
+
+import numpy as np
+import websockets
+from aiohttp import web
+from loguru import logger
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_backends import make_backend, mock_caption
+
+# Benchmark parameters
+host, port = '127.0.0.1', 8769
+image_count = 256
+image_side = 256  # Pixels; random-noise JPEGs, about the size of a zoom 16 tile
+http_latency = 0.1  # Seconds the stand-in HTTP model server takes per image
+machine_cost_per_hour = 0.20  # What an hour of this machine costs, for the local and mock "local" rows
+api_cost_per_image = 0.0005  # Per-call price to assume for the HTTP endpoint
+
+# (row name, backend, options, expected caption of an image's bytes or None to skip the check). The mock rows
+# are simulated latency profiles: a remote queue serving single images, and a CPU model whose forward pass
+# costs a fixed overhead plus a smaller per-image share, unbatched and batched.
+benchmarks = [
+    ('mock, no latency (harness overhead)', 'mock',
+     dict(latency=0, image_latency=0, max_in_flight=8), mock_caption),
+    ('mock remote queue profile', 'mock',
+     dict(latency=0.5, image_latency=0, max_in_flight=32), mock_caption),
+    ('mock local profile, batch 1', 'mock',
+     dict(latency=0.2, image_latency=0.05, max_in_flight=1, cost_per_hour=machine_cost_per_hour), mock_caption),
+    ('mock local profile, batch 16', 'mock',
+     dict(latency=0.2, image_latency=0.05, max_in_flight=2, batch_size=16, cost_per_hour=machine_cost_per_hour),
+     mock_caption),
+    ('http stand-in server', 'http',
+     dict(url=f"http://{host}:{port}/caption", max_in_flight=32, cost_per_image=api_cost_per_image), mock_caption),
+    ('gradio stand-in queue (keep-alive)', 'gradio',
+     dict(uri=f"ws://{host}:{port + 1}", max_in_flight=32, backoff_base=0.05, timeout=10), None),
+]
+if importlib.util.find_spec('torch') and importlib.util.find_spec('transformers'):
+    for batch_size in (1, 8, 16):
+        benchmarks.append((f"local model, batch {batch_size}", 'local',
+                           dict(batch_size=batch_size, max_new_tokens=32, temperature=0,
+                                cost_per_hour=machine_cost_per_hour), None))
+else:
+    logger.warning("torch/transformers are not installed, skipping the local model backend")
+
+
+def make_images():
+    random = np.random.default_rng(0)
+    images = {}
+    for i in range(image_count):
+        pixels = random.integers(0, 256, (image_side, image_side, 3), dtype=np.uint8)
+        output = io.BytesIO()
+        Image.fromarray(pixels).save(output, format='JPEG', quality=85)
+        images[f"image_{i}.jpg"] = output.getvalue()
+    return images
+
+
+async def http_caption(request):
+    """Stand-in HTTP model server: the image is the body, the generation parameters the query."""
+    data = await request.read()
+    if 'max_new_tokens' not in request.query:
+        raise web.HTTPBadRequest(text="missing generation parameters")
+    await asyncio.sleep(http_latency)
+    return web.json_response({'caption': mock_caption(data)})
+
+
+def load_gradio_stand_in():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-caption-client.py')
+    spec = importlib.util.spec_from_file_location('benchmark_caption_client', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.failure_rate = 0
+    return module
+
+
+async def run_benchmark(backend, options, images):
+    client = make_backend(backend, **options)
+    results = {}
+    await client.run(images, images.get, results.__setitem__)
+    return client.summary(), results
+
+
+async def main():
+    images = make_images()
+    gradio = load_gradio_stand_in()
+    app = web.Application(client_max_size=0)
+    app.router.add_post('/caption', http_caption)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    ok = True
+    rows = []
+    try:
+        async with websockets.serve(lambda ws: gradio.gradio_queue(ws, False), host, port + 1, max_size=None):
+            for name, backend, options, expected in benchmarks:
+                if backend == 'gradio':
+                    expected = lambda data: gradio.expected_caption(gradio.data_uri(data))
+                summary, results = await run_benchmark(backend, options, images)
+                if expected is None:
+                    correct = len(results) == len(images) and None not in results.values()
+                else:
+                    correct = all(results.get(image) == expected(data) for image, data in images.items())
+                ok &= correct
+                rows.append((name, summary, correct))
+    finally:
+        await runner.cleanup()
+
+    logger.info(f"{image_count} images of {image_side}x{image_side}:")
+    for name, summary, correct in rows:
+        logger.info(f"{name:40} {summary['images_per_second']:7.1f} images/s, batch latency p50 "
+                    f"{summary['latency_p50']:.2f}s, cost per 1k images {summary['cost_per_1k_images']:.4f}, "
+                    f"captions {'ok' if correct else 'WRONG'}")
+    return ok
+
+
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    sys.exit(0 if asyncio.run(main()) else 1)
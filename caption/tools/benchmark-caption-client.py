@@ -0,0 +1,133 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import websockets
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_client import GradioQueueBackend
+
+# Benchmark parameters
+host, port = '127.0.0.1', 8767
+image_count = 200
+image_size = 20000  # Bytes per fake image, roughly a zoom 16 satellite JPEG
+server_latency = (0.05, 0.25)  # Seconds the stand-in model takes per image, drawn uniformly
+failure_rate = 0.05  # Share of jobs on which the stand-in server drops the connection
+legacy_batch_size = 5
+max_in_flight = 32
+
+
+def data_uri(image):
+    return "data:image/jpeg;base64," + base64.b64encode(image).decode()
+
+
+def expected_caption(image_base64):
+    return f"A satellite image {hashlib.md5(image_base64.encode()).hexdigest()[:8]}. It has roads. "
+
+
+async def gradio_queue(websocket, close_after_job):
+    """
+    Stand-in for a gradio 3 `/queue/join` endpoint running the captioning model.
+
+    Speaks the same messages (send_hash, estimation, send_data, process_starts, process_completed). Real
+    gradio closes the socket after each job; with `close_after_job` False the connection serves job after job.
+    """
+    try:
+        while True:
+            await websocket.send(json.dumps({"msg": "send_hash"}))
+            request = json.loads(await websocket.recv())
+            if random.random() < failure_rate:
+                await websocket.close(code=1011)
+                return
+            await websocket.send(json.dumps({"msg": "estimation", "rank": 0, "queue_size": 1,
+                                             "avg_event_process_time": sum(server_latency) / 2}))
+            await websocket.send(json.dumps({"msg": "send_data"}))
+            data = json.loads(await websocket.recv())
+            assert data["session_hash"] == request["session_hash"]
+            await websocket.send(json.dumps({"msg": "process_starts"}))
+            await asyncio.sleep(random.uniform(*server_latency))
+            await websocket.send(json.dumps({
+                "msg": "process_completed",
+                "output": {"data": [expected_caption(data["data"][0])], "is_generating": False},
+                "success": True
+            }))
+            if close_after_job:
+                return
+    except websockets.ConnectionClosed:
+        pass
+
+
+# Former client: a new connection per image, lock-step batches of `legacy_batch_size`, 1-3 s random retry waits
+async def legacy_process_image(uri, image_base64):
+    for attempt in range(3):
+        try:
+            session_hash = uuid.uuid4().hex
+            async with websockets.connect(uri, max_size=None) as websocket:
+                await websocket.send(json.dumps({"fn_index": 1, "session_hash": session_hash}))
+                while json.loads(await websocket.recv())["msg"] != "estimation":
+                    pass
+                await websocket.send(json.dumps({"fn_index": 1, "data": [image_base64, "", 128, 0.1, 0.75],
+                                                 "event_data": None, "session_hash": session_hash}))
+                while True:
+                    response = json.loads(await websocket.recv())
+                    if response["msg"] == "process_completed":
+                        return response["output"]["data"][0]
+        except Exception:
+            await asyncio.sleep(random.uniform(1, 3))
+    return None
+
+
+async def run_legacy(uri, images):
+    start = time.perf_counter()
+    results = {}
+    for i in range(0, len(images), legacy_batch_size):
+        batch = list(images)[i:i + legacy_batch_size]
+        descriptions = await asyncio.gather(*(legacy_process_image(uri, data_uri(images[name])) for name in batch))
+        results.update(zip(batch, descriptions))
+    return time.perf_counter() - start, results
+
+
+async def run_client(uri, images):
+    client = GradioQueueBackend(uri, max_in_flight=max_in_flight, backoff_base=0.05, timeout=10)
+    results = {}
+    start = time.perf_counter()
+    await client.run(images, images.get, results.__setitem__)
+    elapsed = time.perf_counter() - start
+    client.log_summary(uri)
+    return elapsed, results
+
+
+def check(results, images):
+    wrong = [name for name, image in images.items() if results.get(name) != expected_caption(data_uri(image))]
+    return len(results) == len(images) and not wrong
+
+
+async def main():
+    images = {f"image_{i}.jpg": os.urandom(image_size) for i in range(image_count)}
+    ok = True
+    async with websockets.serve(lambda ws: gradio_queue(ws, True), host, port, max_size=None), \
+            websockets.serve(lambda ws: gradio_queue(ws, False), host, port + 1, max_size=None):
+        legacy_time, results = await run_legacy(f"ws://{host}:{port}", images)
+        ok &= check(results, images)
+        logger.info(f"legacy lock-step batches of {legacy_batch_size}: {legacy_time:.1f}s, "
+                    f"{image_count / legacy_time:.1f} images/s")
+        for name, uri in [('gradio (closes after each job)', f"ws://{host}:{port}"),
+                          ('keep-alive server', f"ws://{host}:{port + 1}")]:
+            elapsed, results = await run_client(uri, images)
+            ok &= check(results, images)
+            logger.info(f"client, {name}: {elapsed:.1f}s, {image_count / elapsed:.1f} images/s "
+                        f"({legacy_time / elapsed:.1f}x), all captions match: {check(results, images)}")
+    return ok
+
+
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", filter=lambda record: record["level"].name != "WARNING")
+    sys.exit(0 if asyncio.run(main()) else 1)
@@ -0,0 +1,78 @@
+import base64
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_payload import PayloadBuilder
+
+# Benchmark parameters
+image_size = 2 * 1024 * 1024  # Bytes of the synthetic image file (a large masked AOI image)
+repeats = 20
+sample_images = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'v2', 'img', 'masked_images',
+                             '*.jpg')
+max_size, quality = 512, 80  # Resize/re-encode setting to report
+
+
+# Former path: read, base64, decode to str, prepend the data URI, json.dumps, encode for the socket
+def legacy_payload(image_path, session_hash):
+    with open(image_path, 'rb') as image_file:
+        encoded_image = base64.b64encode(image_file.read()).decode()
+    image_base64 = "data:image/jpeg;base64," + encoded_image
+    message = {"fn_index": 1, "data": [image_base64, "", 128, 0.1, 0.75], "event_data": None,
+               "session_hash": session_hash}
+    return json.dumps(message).encode()
+
+
+def builder_payload(builder, image_path, session_hash):
+    builder.build(image_path)
+    builder.set_session_hash(session_hash)
+    return builder.payload
+
+
+def measure(func, *args):
+    """Best time and peak traced allocation of one call."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+if __name__ == "__main__":
+    session_hash = uuid.uuid4().hex
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+        f.write(os.urandom(image_size))
+        f.flush()
+
+        builder = PayloadBuilder()
+        same = bytes(builder_payload(builder, f.name, session_hash)) == legacy_payload(f.name, session_hash)
+        legacy_time, legacy_peak = measure(legacy_payload, f.name, session_hash)
+        # The builder's buffer is reused across images, so it is measured warm, as in a long captioning run
+        builder_time, builder_peak = measure(builder_payload, builder, f.name, session_hash)
+
+    logger.info(f"{image_size / 1e6:.1f} MB image, payloads identical: {same}")
+    logger.info(f"legacy: {legacy_time * 1000:.1f} ms, peak {legacy_peak / 1e6:.1f} MB allocated per payload")
+    logger.info(f"builder: {builder_time * 1000:.1f} ms, peak {builder_peak / 1e6:.2f} MB allocated per payload "
+                f"(plus its reusable {builder.size / 1e6:.1f} MB buffer)")
+
+    samples = sorted(glob.glob(sample_images))
+    if samples:
+        resizing = PayloadBuilder(max_size=max_size, quality=quality)
+        original = sum(PayloadBuilder().build(path).size for path in samples)
+        resized = sum(resizing.build(path).size for path in samples)
+        logger.info(f"{len(samples)} sample images: {original / 1e3:.0f} kB of payload, "
+                    f"{resized / 1e3:.0f} kB with max_size={max_size}, quality={quality}")
+    sys.exit(0 if same else 1)
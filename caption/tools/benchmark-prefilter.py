@@ -0,0 +1,48 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.tile_prefilter import prefilter_tiles, tile_features
+
+# Benchmark parameters
+sample_tiles = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'crawl', 'tiles', '*', '*.jpg')
+tile_count = 4000  # The sample tiles are copied until there are this many
+workers = os.cpu_count()
+
+
+def run_serial(paths, size):
+    for path in paths:
+        tile_features(path, size=size)
+
+
+if __name__ == "__main__":
+    samples = sorted(glob.glob(sample_tiles))
+    if not samples:
+        logger.error(f"No sample tiles in {sample_tiles}")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(tile_count):
+            path = os.path.join(directory, f"16_{i}_0_s.jpg")
+            shutil.copy(samples[i % len(samples)], path)
+            paths.append(path)
+
+        subset = paths[:500]
+        for name, size in [('full 256 px decode', 256), ('64 px draft decode', 64)]:
+            start = time.perf_counter()
+            run_serial(subset, size)
+            elapsed = time.perf_counter() - start
+            logger.info(f"1 process, {name}: {len(subset) / elapsed:.0f} tiles/s")
+
+        start = time.perf_counter()
+        rejected = sum(category is not None for _, category, _ in prefilter_tiles(paths, workers=workers))
+        elapsed = time.perf_counter() - start
+        logger.info(f"{workers} processes, 64 px draft decode: {tile_count} tiles in {elapsed:.1f}s, "
+                    f"{tile_count / elapsed:.0f} tiles/s (pool start-up included), {rejected} rejected")
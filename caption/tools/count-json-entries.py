@@ -1,4 +1,9 @@
 import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_store import ProcessedIndex
 
 
 def count_json_entries(json_file):
@@ -26,8 +31,33 @@ def count_json_entries(json_file):
     return length
 
 
+def count_store_entries(json_file):
+    """
+    Counts the entries and images of the caption store that backs a caption JSON file, without parsing captions.
+
+    Args:
+        json_file (str): Path of the caption JSON file; the store is the .jsonl/.keys pair with the same name.
+
+    Returns:
+        tuple: (entries, images), or None if there is no caption store for the file.
+    """
+    base = os.path.splitext(json_file)[0]
+    if not os.path.exists(base + '.keys'):
+        return None
+
+    # One record per line
+    entries = 0
+    with open(base + '.jsonl', 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            entries += chunk.count(b'\n')
+
+    index = ProcessedIndex(base + '.keys')
+    index.close()
+    return entries, len(index)
+
+
 if __name__ == "__main__":
-    # Prints the number of entries in each specified JSON file.
+    # Prints the number of entries in each specified JSON file (or in its caption store, when there is one).
     json_files = [
         '../pairs/Beijing_captions.json',
         '../pairs/Shanghai_captions.json',
@@ -40,4 +70,8 @@ if __name__ == "__main__":
     ]
 
     for json_file in json_files:
-        print(f"{json_file}: {count_json_entries(json_file)} entries")
+        counts = count_store_entries(json_file)
+        if counts is not None:
+            print(f"{json_file}: {counts[0]} entries, {counts[1]} images (caption store)")
+        else:
+            print(f"{json_file}: {count_json_entries(json_file)} entries")
@@ -0,0 +1,35 @@
+import os
+import sys
+
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_store import CaptionStore
+
+# Export parameters
+output_directory = '../pairs'
+cities = ['Beijing', 'Guangzhou', 'Shanghai', 'Shenzhen']
+
+
+def export_captions(output_directory, city):
+    """
+    Compact a city's JSONL caption store into the legacy <city>_captions.json read by img-filter.py and the
+    integrate and augment steps.
+
+    :return: Number of images exported, or None if the city has no caption store.
+    """
+    jsonl_path = os.path.join(output_directory, f"{city}_captions.jsonl")
+    if not os.path.exists(jsonl_path):
+        return None
+    with CaptionStore(jsonl_path) as store:
+        store.export_json(os.path.join(output_directory, f"{city}_captions.json"))
+        return len(store)
+
+
+if __name__ == "__main__":
+    for city in cities:
+        count = export_captions(output_directory, city)
+        if count is None:
+            logger.info(f"No caption store for {city}")
+        else:
+            logger.info(f"Exported {count} images for {city}")
@@ -1,9 +1,17 @@
-import glob
 import json
 import os
+import sys
 
 from loguru import logger
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.caption_store import ProcessedIndex, image_key
+from common.tile_prefilter import load_rejected
+from common.tile_store import list_tile_paths
+
+# As in img-caption-generator.py: also leave out tiles rejected by img-prefilter.py (pairs/<city>_prefilter.csv)
+SKIP_PREFILTERED = True
+
 
 def get_unprocessed_image_count():
     """
@@ -11,9 +19,8 @@ def get_unprocessed_image_count():
     This function checks against already processed images to avoid duplication.
     """
 
-    # Ensures the output directory exists; creates it if not.
+    # The directory holding the caption stores; nothing is written to it.
     output_directory = 'pairs'
-    os.makedirs(output_directory, exist_ok=True)
 
     # The base directory where the city image folders are located.
     base_directory = '../tiles'
@@ -23,23 +30,39 @@ def get_unprocessed_image_count():
         directory_path = os.path.join(base_directory, city)
         logger.info(f"Processing directory: {directory_path}")
 
-        # Glob pattern to match all jpg images within the city's directory.
-        pattern = os.path.join(directory_path, '*.jpg')
-        image_paths = glob.glob(pattern)
+        # All jpg tiles of the city, whether stored as files or in the city's .pack file.
+        image_paths = list_tile_paths(directory_path)
 
-        # Attempt to load existing caption JSON data if available.
+        # Processed images come from the sorted key index of the city's caption store, not from the captions.
+        # The query only reads: the index is opened read-only, and a legacy JSON file without a store is read as is.
         city_json_filename = os.path.join(output_directory, f"{city}_captions.json")
-        existing_data = []
-        if os.path.exists(city_json_filename):
-            with open(city_json_filename, 'r') as file:
-                existing_data = json.load(file)
-
-        # Creates a set of already processed images for quick lookup.
-        existing_images = set(item["image"] for sublist in existing_data for item in sublist)
+        keys_path = os.path.join(output_directory, f"{city}_captions.keys")
+        keys = (image_key(image_path, base_directory) for image_path in image_paths)
+        if os.path.exists(keys_path) or not os.path.exists(city_json_filename):
+            index = ProcessedIndex(keys_path, readonly=True)
+            processed_count = len(index)
+            new_images = index.missing(keys)
+            index.close()
+        else:
+            with open(city_json_filename, 'r', encoding='utf-8') as file:
+                existing_images = set(item["image"] for sublist in json.load(file) for item in sublist)
+            processed_count = len(existing_images)
+            new_images = [key for key in keys if key not in existing_images]
 
-        # Filters out images that have already been processed.
-        new_image_paths = [image_path for image_path in image_paths
-                           if '/'.join(image_path.split('/')[-2:]) not in existing_images]
+        # Images img-filter.py routed out of the store and tiles rejected by the pre-filter are not captioned either
+        skipped = load_rejected(os.path.join(output_directory, f"{city}_filtered.csv"))
+        if SKIP_PREFILTERED:
+            skipped.update(load_rejected(os.path.join(output_directory, f"{city}_prefilter.csv")))
+        if skipped:
+            count = len(new_images)
+            new_images = [key for key in new_images if key not in skipped]
+            logger.info(f"{count - len(new_images)} unprocessed images are skipped by the filter or pre-filter "
+                        f"for {city}.")
 
-        logger.info(f"{len(new_image_paths)} new images to process for {city}.")
+        logger.info(f"{processed_count} images already processed for {city}.")
+        logger.info(f"{len(new_images)} new images to process for {city}.")
         logger.info(f"{len(image_paths)} total images for {city}.")
+
+
+if __name__ == "__main__":
+    get_unprocessed_image_count()
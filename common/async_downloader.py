@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+from loguru import logger
+
+from common.downloader import DownloadStats
+
+
+def _write_file(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class AsyncTileDownloader:
+    """
+    asyncio/aiohttp alternative to TileDownloader for very large crawls.
+
+    Jobs are streamed through a bounded queue into a fixed set of worker coroutines, so memory stays
+    flat however many tiles a city has, and a single process can keep tens of thousands of requests in
+    flight over one pooled aiohttp session. File writes are handed to a thread so they never block the
+    event loop.
+    """
+
+    def __init__(self, concurrency=10000, timeout=30, max_retries=3, headers=None, queue_size=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.headers = headers or {'User-Agent': 'Mozilla/5.0'}
+        self.queue_size = queue_size or concurrency * 2
+        self.stats = DownloadStats()
+        self.on_done = None
+
+    async def fetch(self, session, url):
+        """
+        Fetch a URL, retrying throttled (429/5xx) or failed requests with exponential backoff.
+
+        :return: Response body, or None if the tile could not be downloaded.
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            status, content = None, b''
+            try:
+                async with session.get(url) as response:
+                    status = response.status
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            self.stats.record(time.perf_counter() - start, status, len(content))
+
+            if status == 200:
+                return content
+            if status is not None and status != 429 and status < 500:
+                # Other 4xx responses will not change on retry
+                error = f"HTTP {status}"
+                break
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+        self.stats.record_failure()
+        logger.info(f"-- {url} -> {error or f'HTTP {status}'}")
+        return None
+
+    async def _worker(self, session, queue):
+        while True:
+            job = await queue.get()
+            try:
+                if job is None:
+                    return
+                url, filename = job[:2]
+                content = await self.fetch(session, url)
+                if content is not None and filename is not None:
+                    try:
+                        await asyncio.to_thread(_write_file, filename, content)
+                    except OSError as e:
+                        self.stats.record_failure()
+                        logger.info(f"-- {filename} -> {e}")
+                        content = None
+                if self.on_done is not None:
+                    await asyncio.to_thread(self.on_done, job, content)
+            finally:
+                queue.task_done()
+
+    async def run(self, jobs, on_done=None, skip_existing=True):
+        """
+        Download every (url, filename) pair produced by `jobs`.
+
+        :param jobs: Iterable of (url, filename, ...) tuples; consumed lazily. Extra items are passed to `on_done`.
+                     A filename of None leaves storing the content to `on_done`.
+        :param on_done: Optional callback `on_done(job, content)` run in a worker thread after each job;
+                        `content` is None on failure.
+        :param skip_existing: Skip jobs whose file already exists (disable when the caller tracks progress itself).
+        """
+        self.on_done = on_done
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=0)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+            workers = [asyncio.create_task(self._worker(session, queue)) for _ in range(self.concurrency)]
+            for job in jobs:
+                if skip_existing and os.path.exists(job[1]):
+                    continue
+                await queue.put(job)  # Blocks while the queue is full
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+    def log_summary(self, name):
+        summary = self.stats.summary()
+        logger.info(f"{name}: {summary['tiles']} tiles ({summary['megabytes']:.1f} MB) in {summary['elapsed']:.1f}s, "
+                    f"{summary['tiles_per_second']:.1f} tiles/s, {summary['megabytes_per_second']:.2f} MB/s, "
+                    f"latency p50 {summary['latency_p50'] * 1000:.0f} ms / p95 {summary['latency_p95'] * 1000:.0f} ms, "
+                    f"{summary['failed']} failed, {summary['throttled']} throttled responses")
+        return summary
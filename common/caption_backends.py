@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import io
+import os
+
+import aiohttp
+from loguru import logger
+from PIL import Image
+
+from common.caption_client import CaptionBackend, CaptionError, GradioQueueBackend
+
+
+def mock_caption(data):
+    """The deterministic caption MockBackend gives an image's bytes."""
+    return f"A satellite image {hashlib.md5(data).hexdigest()[:8]}. It has roads. "
+
+
+class HttpBackend(CaptionBackend):
+    """
+    Captions images through a generic HTTP endpoint, e.g. a self-hosted inference server.
+
+    Each image is POSTed as the raw request body with the generation parameters as query parameters, and the
+    caption is read from a field of the JSON response. All workers share one connection pool, so
+    `max_in_flight` requests are in flight at once over kept-alive connections.
+    """
+
+    def __init__(self, url, response_field='caption', headers=None, content_type='image/jpeg', max_in_flight=32,
+                 **kwargs):
+        """
+        :param url: URL to POST images to.
+        :param response_field: Dotted path of the caption in the JSON response (e.g. "choices.0.text").
+        :param headers: Extra request headers, e.g. an Authorization header.
+        :param content_type: Content type of the request body.
+        :param max_in_flight: Number of requests in flight at once.
+        :param kwargs: See CaptionBackend.
+        """
+        super().__init__(max_in_flight=max_in_flight, **kwargs)
+        self.url = url
+        self.response_field = response_field.split('.')
+        self.headers = {'Content-Type': content_type, **(headers or {})}
+        self.session = None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _field(self, response):
+        for key in self.response_field:
+            response = response[int(key) if isinstance(response, list) else key]
+        if not isinstance(response, str):
+            raise CaptionError(f"unexpected caption {response!r}")
+        return response
+
+    async def _request(self, data):
+        params = {'prompt': self.prompt, 'max_new_tokens': self.max_new_tokens, 'temperature': self.temperature,
+                  'top_p': self.top_p}
+        async with self.session.post(self.url, data=data, params=params) as response:
+            response.raise_for_status()
+            return self._field(await response.json(content_type=None))
+
+    async def caption_batch(self, state, jobs, inputs):
+        errors = (aiohttp.ClientError, OSError, asyncio.TimeoutError, CaptionError, KeyError, IndexError, ValueError)
+        descriptions = []
+        for job, data in zip(jobs, inputs):
+            self.payload_bytes += len(data)
+            descriptions.append(await self.retry(job, lambda: self._request(data), errors))
+        return descriptions
+
+
+class LocalModelBackend(CaptionBackend):
+    """
+    Runs an image-to-text model from Hugging Face transformers on the local CPU, a whole batch of images per
+    forward pass.
+
+    Workers decode and resize their batches in threads while a lock lets one `generate` call at a time use all
+    the cores, so with the default two workers the next batch is ready when the model finishes the current
+    one. Needs `torch` and `transformers`, which are imported when the model is loaded.
+    """
+
+    def __init__(self, model='Salesforce/blip-image-captioning-base', batch_size=16, max_in_flight=2,
+                 threads=None, max_size=384, **kwargs):
+        """
+        :param model: Hugging Face model id or local path of a vision-to-text model.
+        :param batch_size: Images per forward pass.
+        :param max_in_flight: Number of workers preparing batches.
+        :param threads: Torch CPU threads (None keeps torch's default of one per core).
+        :param max_size: Downscale images to at most this many pixels before the processor resizes them.
+        :param kwargs: See CaptionBackend; sampling is used when `temperature` is above 0.
+        """
+        super().__init__(max_in_flight=max_in_flight, batch_size=batch_size, max_size=max_size, **kwargs)
+        self.model_name = model
+        self.threads = threads
+        self.model = None
+        self.processor = None
+        self._lock = None
+
+    def _load(self):
+        try:
+            import torch
+            from transformers import AutoModelForVision2Seq, AutoProcessor
+        except ImportError as e:
+            raise ImportError("The local caption backend needs torch and transformers "
+                              "(pip install torch transformers)") from e
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.processor = AutoProcessor.from_pretrained(self.model_name)
+        self.model = AutoModelForVision2Seq.from_pretrained(self.model_name).eval()
+
+    async def open(self):
+        self._lock = asyncio.Lock()
+        if self.model is None:
+            await asyncio.to_thread(self._load)
+
+    def prepare(self, state, source):
+        if not isinstance(source, (str, os.PathLike)):
+            source = io.BytesIO(source)
+        with Image.open(source) as image:
+            if self.max_size:
+                image.draft('RGB', (self.max_size, self.max_size))
+                image.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+            return image.convert('RGB')
+
+    def _generate(self, images):
+        import torch
+
+        if self.prompt:
+            inputs = self.processor(images=images, text=[self.prompt] * len(images), padding=True,
+                                    return_tensors='pt')
+        else:
+            inputs = self.processor(images=images, return_tensors='pt')
+        options = {'max_new_tokens': self.max_new_tokens}
+        if self.temperature > 0:
+            options.update(do_sample=True, temperature=self.temperature, top_p=self.top_p)
+        with torch.inference_mode():
+            output = self.model.generate(**inputs, **options)
+        return [text.strip() for text in self.processor.batch_decode(output, skip_special_tokens=True)]
+
+    async def caption_batch(self, state, jobs, inputs):
+        self.payload_bytes += sum(image.width * image.height * 3 for image in inputs)
+        async with self._lock:
+            try:
+                return await asyncio.to_thread(self._generate, inputs)
+            except (RuntimeError, ValueError) as e:
+                # Not retried: the same batch would fail the same way
+                logger.error(f"Failed to caption {len(jobs)} images ({jobs[0]}...): {e}")
+                return [None] * len(jobs)
+
+
+class MockBackend(CaptionBackend):
+    """
+    Deterministic stand-in model for benchmarks and dry runs.
+
+    The caption is derived from a hash of the image bytes and every call takes `latency` plus `image_latency`
+    per image in the batch, so runs are repeatable and batching, concurrency and cost settings can be compared
+    without a model or network. With `batch_size` 1 and a high `max_in_flight` it models a remote queue; with
+    bigger batches and few workers, a local model.
+    """
+
+    def __init__(self, latency=0.2, image_latency=0.02, max_in_flight=4, **kwargs):
+        """
+        :param latency: Seconds every call takes.
+        :param image_latency: Seconds added per image in the batch.
+        :param max_in_flight: Number of calls served at once.
+        :param kwargs: See CaptionBackend.
+        """
+        super().__init__(max_in_flight=max_in_flight, **kwargs)
+        self.latency = latency
+        self.image_latency = image_latency
+
+    async def caption_batch(self, state, jobs, inputs):
+        self.payload_bytes += sum(len(data) for data in inputs)
+        await asyncio.sleep(self.latency + self.image_latency * len(inputs))
+        return [mock_caption(data) for data in inputs]
+
+
+BACKENDS = {
+    'gradio': GradioQueueBackend,
+    'http': HttpBackend,
+    'local': LocalModelBackend,
+    'mock': MockBackend,
+}
+
+
+def make_backend(name, **options):
+    """
+    Create a caption backend by name.
+
+    :param name: One of BACKENDS: 'gradio', 'http', 'local' or 'mock'.
+    :param options: Keyword arguments of the backend's class.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown caption backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](**options)
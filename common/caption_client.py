@@ -0,0 +1,373 @@
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+import numpy as np
+import websockets
+from loguru import logger
+
+from common.caption_payload import PayloadBuilder, resize_image
+
+DEFAULT_URI = 'ws://llama-adapter.opengvlab.com/queue/join'
+
+
+class CaptionError(Exception):
+    """The caption server rejected a job (queue full, or the model failed on it)."""
+
+
+class CaptionBackend:
+    """
+    Base of the caption backends (see common/caption_backends.py for the others).
+
+    Jobs are streamed through a bounded queue into `max_in_flight` worker coroutines. A free worker takes the
+    next job plus up to `batch_size - 1` more that are already queued, prepares their images in a thread and
+    hands them to `caption_batch` together, so remote backends keep many single images in flight while a local
+    model gets whole batches per forward pass. The run's counts, latencies and cost are kept for `summary`.
+
+    Subclasses implement `caption_batch`, and may override `prepare` (how an image source becomes the
+    backend's input), `open`/`close` (resources shared by the run, e.g. an HTTP session or a model) and
+    `open_worker`/`close_worker` (per-worker resources, e.g. a websocket).
+    """
+
+    def __init__(self, max_in_flight=32, batch_size=1, queue_size=None, max_retries=3, backoff_base=1.0,
+                 backoff_max=30.0, timeout=300, prompt="", max_new_tokens=128, temperature=0.1, top_p=0.75,
+                 max_size=None, quality=None, cost_per_hour=0.0, cost_per_image=0.0):
+        """
+        :param max_in_flight: Number of workers, i.e. batches captioned concurrently.
+        :param batch_size: Most images handed to `caption_batch` at once.
+        :param queue_size: Bound of the job queue (defaults to two batches per worker).
+        :param max_retries: Retries per image after the first attempt.
+        :param backoff_base: Backoff cap in seconds after the first failure; it doubles with every retry.
+        :param backoff_max: Upper bound of the backoff cap in seconds.
+        :param timeout: Seconds allowed for one attempt.
+        :param prompt: Prompt given to the model with each image ("" for the model's default).
+        :param max_new_tokens: Most tokens generated per caption.
+        :param temperature: Sampling temperature.
+        :param top_p: Nucleus sampling threshold.
+        :param max_size: Downscale images so that their longest side is at most this many pixels first.
+        :param quality: Re-encode images as JPEG at this quality first.
+        :param cost_per_hour: Price of running the backend for an hour (machine or reserved endpoint), for
+                              the cost per 1k images in `summary`.
+        :param cost_per_image: Price per captioned image (per-call API pricing).
+        """
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.queue_size = queue_size or max_in_flight * batch_size * 2
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_size = max_size
+        self.quality = quality
+        self.cost_per_hour = cost_per_hour
+        self.cost_per_image = cost_per_image
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Start the counts, latencies and clock of `summary` afresh; `run` calls it, so a summary covers one run."""
+        self.started = time.perf_counter()
+        self.processed = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.payload_bytes = 0
+        self.latencies = []
+
+    @property
+    def parameters(self):
+        """The generation parameters in the order of the gradio demo (prompt, max tokens, temperature, top p)."""
+        return [self.prompt, self.max_new_tokens, self.temperature, self.top_p]
+
+    def backoff(self, attempt):
+        """Full jitter: a uniform wait between 0 and the exponentially growing cap."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def retry(self, name, attempt, errors, on_error=None):
+        """
+        Await `attempt()` until it succeeds, each try limited to `timeout`, backing off after failures.
+
+        :param name: Job name for the log.
+        :param attempt: Coroutine function making one attempt.
+        :param errors: Exception types that count as a failed attempt.
+        :param on_error: Optional coroutine function run after each failed attempt (e.g. to drop a connection).
+        :return: The result of the first successful attempt, or None once `max_retries` retries have failed.
+        """
+        retries = 0
+        while True:
+            try:
+                return await asyncio.wait_for(attempt(), self.timeout)
+            except errors as e:
+                error = e
+            if on_error is not None:
+                await on_error()
+            if retries >= self.max_retries:
+                logger.error(f"Failed to caption {name} after {retries + 1} attempts: {error}")
+                return None
+            wait_time = self.backoff(retries)
+            retries += 1
+            self.retries += 1
+            logger.warning(f"Attempt {retries} for {name} failed: {error}. Retrying in {wait_time:.1f}s")
+            await asyncio.sleep(wait_time)
+
+    def prepare(self, state, source):
+        """
+        Turn an image source into the backend's input; runs in a worker thread.
+
+        :param state: The worker's state from `open_worker`.
+        :param source: Path of an image file, or its bytes.
+        :return: By default the image's JPEG bytes, resized as configured.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                source = f.read()
+        if self.max_size or self.quality:
+            source = resize_image(source, self.max_size, self.quality)
+        return source
+
+    async def caption_batch(self, state, jobs, inputs):
+        """
+        Caption prepared images.
+
+        :param state: The worker's state from `open_worker`.
+        :param jobs: The jobs, for logging.
+        :param inputs: Their `prepare`d inputs.
+        :return: One description per job, None where captioning failed.
+        """
+        raise NotImplementedError
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def open_worker(self):
+        return None
+
+    async def close_worker(self, state):
+        pass
+
+    def _prepare_batch(self, state, jobs, source):
+        inputs = []
+        for job in jobs:
+            try:
+                inputs.append(self.prepare(state, source(job)))
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not read {job}: {e}")
+                inputs.append(None)
+        return inputs
+
+    async def _next_batch(self, queue):
+        """Wait for a job, then take up to `batch_size - 1` more already queued; None once the jobs run out."""
+        job = await queue.get()
+        if job is None:
+            queue.put_nowait(None)  # Pass the end marker on to the next worker
+            return None
+        batch = [job]
+        while len(batch) < self.batch_size and not queue.empty():
+            job = queue.get_nowait()
+            if job is None:
+                queue.put_nowait(None)
+                break
+            batch.append(job)
+        return batch
+
+    async def _worker(self, queue, source, on_done):
+        state = await self.open_worker()
+        try:
+            while (batch := await self._next_batch(queue)) is not None:
+                inputs = await asyncio.to_thread(self._prepare_batch, state, batch, source)
+                ready = [i for i, item in enumerate(inputs) if item is not None]
+                descriptions = [None] * len(batch)
+                if ready:
+                    start = time.perf_counter()
+                    results = await self.caption_batch(state, [batch[i] for i in ready], [inputs[i] for i in ready])
+                    self.latencies.append(time.perf_counter() - start)
+                    self.batches += 1
+                    for i, description in zip(ready, results):
+                        descriptions[i] = description
+                for job, description in zip(batch, descriptions):
+                    if description is None:
+                        self.failed += 1
+                    else:
+                        self.processed += 1
+                    on_done(job, description)
+        finally:
+            await self.close_worker(state)
+
+    async def run(self, jobs, source, on_done):
+        """
+        Caption every job produced by `jobs`, keeping `max_in_flight` batches in flight until all are done.
+
+        :param jobs: Iterable of jobs (e.g. image paths); consumed lazily.
+        :param source: Callable `source(job)` returning the image's path or bytes; it is called and the image
+                       prepared in a worker thread.
+        :param on_done: Callback `on_done(job, description)` run on the event loop as each job finishes, in
+                        completion order; `description` is None if the image could not be captioned.
+        """
+        self.reset_stats()
+        await self.open()
+        try:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            workers = [asyncio.create_task(self._worker(queue, source, on_done)) for _ in range(self.max_in_flight)]
+            for job in jobs:
+                await queue.put(job)  # Blocks while every worker is busy and the queue is full
+            await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            await self.close()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+        cost = self.cost_per_hour * elapsed / 3600 + self.cost_per_image * self.processed
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'retries': self.retries,
+            'batches': self.batches,
+            'megabytes_sent': self.payload_bytes / 1e6,
+            'elapsed': elapsed,
+            'images_per_second': self.processed / elapsed if elapsed else 0.0,
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'cost': cost,
+            'cost_per_1k_images': cost / self.processed * 1000 if self.processed else 0.0,
+        }
+
+    def log_summary(self, name):
+        summary = self.summary()
+        message = (f"{name}: {summary['processed']} images captioned in {summary['elapsed']:.1f}s "
+                   f"({summary['images_per_second']:.2f}/s) in {summary['batches']} batches, latency p50 "
+                   f"{summary['latency_p50']:.2f}s / p95 {summary['latency_p95']:.2f}s, {summary['failed']} failed, "
+                   f"{summary['retries']} retries, {summary['megabytes_sent']:.1f} MB of images")
+        if 'connections' in summary:
+            message += f", {summary['connections']} connections opened"
+        if summary['cost']:
+            message += f", cost {summary['cost']:.2f} ({summary['cost_per_1k_images']:.3f} per 1k images)"
+        logger.info(message)
+        return summary
+
+
+class _Connection:
+    """
+    A worker's websocket, which stays open across jobs for as long as the server keeps it open, and the
+    payload builder whose buffer it reuses for every image it sends.
+    """
+
+    def __init__(self, builder):
+        self.websocket = None
+        self.builder = builder
+
+    async def close(self):
+        if self.websocket is not None:
+            websocket, self.websocket = self.websocket, None
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+
+class GradioQueueBackend(CaptionBackend):
+    """
+    Captions images through a gradio queue endpoint (`/queue/join`) from a pool of long-lived websockets.
+
+    Each worker owns one connection, so a new image is sent as soon as any worker is free instead of waiting
+    for a whole batch to finish. The gradio queue protocol has no job ids, so each connection carries one job
+    at a time and `max_in_flight` is both the number of connections and the number of images being captioned
+    at once. A connection the server closed after a job (as gradio does) is reopened for the next one; failed
+    jobs are retried on a fresh connection after an exponential backoff with full jitter.
+
+    Each connection encodes its images with its own PayloadBuilder, straight into a reusable buffer.
+    """
+
+    def __init__(self, uri=DEFAULT_URI, max_in_flight=32, fn_index=1, **kwargs):
+        """
+        :param uri: Websocket URI of the gradio queue.
+        :param max_in_flight: Number of connections, i.e. images captioned concurrently.
+        :param fn_index: Index of the gradio function to call.
+        :param kwargs: See CaptionBackend; the generation parameters are sent after the image. The queue
+                       takes one image per request, so `batch_size` is always 1.
+        """
+        kwargs['batch_size'] = 1
+        super().__init__(max_in_flight=max_in_flight, **kwargs)
+        self.uri = uri
+        self.fn_index = fn_index
+
+    def reset_stats(self):
+        super().reset_stats()
+        self.connections = 0
+
+    async def _receive(self, websocket, expected):
+        while True:
+            response = json.loads(await websocket.recv())
+            if response.get("msg") == expected:
+                return response
+            if response.get("msg") == "queue_full":
+                raise CaptionError("queue full")
+
+    def builder(self):
+        """A payload builder with this client's message layout and resize options."""
+        return PayloadBuilder(self.fn_index, self.parameters, self.max_size, self.quality)
+
+    async def _request(self, websocket, builder):
+        """Run one gradio queue exchange for the image in `builder` on an open websocket; return the model's text."""
+        session_hash = uuid.uuid4().hex
+        await websocket.send(json.dumps({"fn_index": self.fn_index, "session_hash": session_hash}))
+        response = await self._receive(websocket, "estimation")
+        logger.debug(f"Queued: {session_hash}, {response}")
+
+        # The message is already UTF-8 JSON, so it goes out as a text frame without a str round trip
+        # (send(..., text=True) needs websockets 14 or later)
+        builder.set_session_hash(session_hash)
+        await websocket.send(builder.payload, text=True)
+        response = await self._receive(websocket, "process_completed")
+        if not response.get("success", True):
+            raise CaptionError(response.get("output", {}).get("error") or "process failed")
+        return response["output"]["data"][0]
+
+    async def _attempt(self, connection):
+        if connection.websocket is not None:
+            try:
+                return await self._request(connection.websocket, connection.builder)
+            except websockets.ConnectionClosed:
+                # The server closed the connection after the previous job; not a failure of this one
+                await connection.close()
+        connection.websocket = await websockets.connect(self.uri, max_size=None)
+        self.connections += 1
+        return await self._request(connection.websocket, connection.builder)
+
+    async def caption(self, connection, name=''):
+        """
+        Caption the image last built by the connection's builder, reconnecting and retrying as needed.
+
+        :return: The model's description, or None if every attempt failed.
+        """
+        errors = (websockets.ConnectionClosed, websockets.InvalidHandshake, OSError, asyncio.TimeoutError, CaptionError,
+                  KeyError, ValueError)
+        return await self.retry(name, lambda: self._attempt(connection), errors, connection.close)
+
+    def prepare(self, connection, source):
+        return connection.builder.build(source)
+
+    async def caption_batch(self, connection, jobs, inputs):
+        self.payload_bytes += connection.builder.size
+        return [await self.caption(connection, jobs[0])]
+
+    async def open_worker(self):
+        return _Connection(self.builder())
+
+    async def close_worker(self, connection):
+        await connection.close()
+
+    def summary(self):
+        summary = super().summary()
+        summary['connections'] = self.connections
+        return summary
@@ -0,0 +1,52 @@
+"""
+Rule-based routing of captioned images into categories (e.g. ocean, forest, desert).
+
+Each image's caption sentences are joined and checked once against the rules in priority order, stopping at the
+first category that matches; images that match nothing are kept.
+"""
+import itertools
+import re
+
+
+class CaptionFilter:
+    """
+    Routes caption records to `None` (keep) or to the category of the first matching rule.
+    """
+
+    def __init__(self, rules, ignore_case=False):
+        """
+        :param rules: {category: [pattern, ...]} in priority order. A str pattern is a keyword matched anywhere in the
+                      caption (like `keyword in caption`); a compiled `re.Pattern` is searched for as a regex.
+        :param ignore_case: Match keywords and regexes case-insensitively.
+        """
+        self.categories = list(rules)
+        self.ignore_case = ignore_case
+        # Keywords are checked with `in`, a C substring search that beats one big re alternation (re tries every
+        # branch at every position; it is not an Aho-Corasick automaton). Regexes are searched one by one, each
+        # keeping its own flags; with ignore_case they are recompiled with IGNORECASE added
+        self._rules = []
+        for patterns in rules.values():
+            keywords = tuple(p.lower() if ignore_case else p for p in patterns if isinstance(p, str))
+            regexes = tuple(re.compile(p.pattern, p.flags | re.IGNORECASE) if ignore_case else p
+                            for p in patterns if isinstance(p, re.Pattern))
+            self._rules.append((keywords, regexes))
+
+    def category(self, text):
+        """The category of the highest-priority rule matching `text`, or None."""
+        folded = text.lower() if self.ignore_case else text
+        for category, (keywords, regexes) in zip(self.categories, self._rules):
+            if any(keyword in folded for keyword in keywords) or any(regex.search(text) for regex in regexes):
+                return category
+        return None
+
+    def route(self, records):
+        """
+        Group caption records by image and route each image.
+
+        :param records: Iterable of {"caption", "image"} records, each image's records consecutive (as in a caption
+                        store or the legacy JSON).
+        :return: Generator of (image, captions, category) with category None for images to keep.
+        """
+        for image, group in itertools.groupby(records, key=lambda record: record["image"]):
+            captions = [record["caption"] for record in group]
+            yield image, captions, self.category('\n'.join(captions))
@@ -0,0 +1,129 @@
+import binascii
+import io
+import json
+import os
+
+from PIL import Image
+
+DATA_URI_PREFIX = b'data:image/jpeg;base64,'
+SESSION_HASH_LENGTH = 32  # uuid4().hex
+
+
+def resize_image(data, max_size=None, quality=None):
+    """
+    Downscale JPEG bytes so that their longest side is at most `max_size` and/or re-encode them at `quality`.
+
+    :return: The new JPEG bytes (a memoryview of the encoder's buffer).
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if max_size:
+            # Let the JPEG decoder skip most of the work for large downscales
+            image.draft('RGB', (max_size, max_size))
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.convert('RGB').save(output, format='JPEG', quality=quality or 90)
+    return output.getbuffer()
+
+
+class PayloadBuilder:
+    """
+    Builds the gradio queue message carrying an image straight into one reusable bytearray.
+
+    The JSON around the image is prebuilt once; the image is read in fixed-size chunks (or sliced from a
+    bytes-like object such as a pack's mmap view) and each chunk's base64 is copied into its place in the
+    buffer, so no full-size bytes, str or json.dumps copies of the image are ever made. The buffer only grows,
+    so a builder per connection keeps memory at one payload per image in flight.
+
+    Optionally the image is first downscaled to fit `max_size` and/or re-encoded as JPEG at `quality`; smaller
+    payloads upload faster and the model processes them faster too.
+    """
+
+    def __init__(self, fn_index=1, parameters=("", 128, 0.1, 0.75), max_size=None, quality=None,
+                 chunk_size=3 * 64 * 1024):
+        """
+        :param fn_index: Index of the gradio function to call.
+        :param parameters: Model parameters sent after the image.
+        :param max_size: Longest side in pixels to downscale larger images to; None keeps the size.
+        :param quality: JPEG quality to re-encode at; None keeps the original encoding unless resizing.
+        :param chunk_size: Bytes read per chunk; a multiple of 3 so chunks encode without base64 padding.
+        """
+        self.max_size = max_size
+        self.quality = quality
+        self._chunk = bytearray(chunk_size - chunk_size % 3)
+        self._head = (f'{{"fn_index": {json.dumps(fn_index)}, "data": ["'.encode() + DATA_URI_PREFIX)
+        self._tail = (f'", {json.dumps(list(parameters))[1:-1]}], "event_data": null, "session_hash": "'
+                      .encode())
+        self._buffer = bytearray()
+        self._length = 0
+        self._hash_offset = 0
+
+    def _prepare(self, size):
+        """Lay out head, room for `size` image bytes in base64, tail and hash; return the base64 offset."""
+        encoded_size = 4 * ((size + 2) // 3)
+        self._hash_offset = len(self._head) + encoded_size + len(self._tail)
+        self._length = self._hash_offset + SESSION_HASH_LENGTH + 2
+        if len(self._buffer) < self._length:
+            self._buffer = bytearray(self._length)
+        buffer = self._buffer
+        buffer[:len(self._head)] = self._head
+        buffer[self._hash_offset - len(self._tail):self._hash_offset] = self._tail
+        buffer[self._length - 2:self._length] = b'"}'
+        return len(self._head)
+
+    def _encode_into(self, offset, chunk):
+        encoded = binascii.b2a_base64(chunk, newline=False)
+        self._buffer[offset:offset + len(encoded)] = encoded
+        return offset + len(encoded)
+
+    def resize(self, data):
+        """Downscale and/or re-encode JPEG bytes as configured; returns the new encoded bytes."""
+        return resize_image(data, self.max_size, self.quality)
+
+    def build(self, source):
+        """
+        Encode an image into the buffer.
+
+        :param source: Path of an image file, or its bytes (any bytes-like object, e.g. a memoryview of a pack).
+        :return: self, for `set_session_hash` and `payload`.
+        """
+        if self.max_size or self.quality:
+            if isinstance(source, (str, os.PathLike)):
+                with open(source, 'rb') as f:
+                    source = f.read()
+            source = self.resize(source)
+
+        if isinstance(source, (str, os.PathLike)):
+            chunk = memoryview(self._chunk)
+            with open(source, 'rb') as f:
+                remaining = os.fstat(f.fileno()).st_size
+                offset = self._prepare(remaining)
+                while remaining:
+                    # Buffered readinto fills the whole chunk unless the file ends, so only the last chunk
+                    # can need base64 padding
+                    read = f.readinto(chunk[:min(len(chunk), remaining)])
+                    if not read:
+                        break
+                    offset = self._encode_into(offset, chunk[:read])
+                    remaining -= read
+        else:
+            view = memoryview(source).cast('B')
+            offset = self._prepare(len(view))
+            step = len(self._chunk)
+            for start in range(0, len(view), step):
+                offset = self._encode_into(offset, view[start:start + step])
+        if offset != self._hash_offset - len(self._tail):
+            raise OSError(f"{source} was truncated while it was being read")
+        return self
+
+    def set_session_hash(self, session_hash):
+        """Write the session hash of the next request into the message."""
+        self._buffer[self._hash_offset:self._hash_offset + SESSION_HASH_LENGTH] = session_hash.encode()
+
+    @property
+    def payload(self):
+        """The complete JSON message, a view into the reusable buffer (valid until the next `build`)."""
+        return memoryview(self._buffer)[:self._length]
+
+    @property
+    def size(self):
+        return self._length
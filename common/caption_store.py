@@ -0,0 +1,326 @@
+"""
+Append-only caption storage.
+
+Captions are appended to `<name>.jsonl`, one {"caption", "image"} record per line, exactly the items of the legacy
+`[[{...}, ...]]` caption JSON. Next to it, `<name>.keys` indexes the captioned images: one `image<TAB>offset` line
+per image, where offset is the size of the JSONL file once that image's records were written. Resuming only reads
+the key file into a set, and on open both files are cut back to the last image whose key and records are both
+complete, so a crash never leaves half an image behind. Key lines are written only after the records they point
+to have been fsynced.
+
+The legacy nested-list JSON is written only by an explicit `export_json`.
+
+Images are keyed by `image_key`: the image path relative to the directory being captioned, with '/' separators
+(e.g. Beijing/18_1_2_s.jpg for ../tiles/Beijing/18_1_2_s.jpg), which is also the "image" of its records.
+`ProcessedIndex` keeps a sorted copy of a store's keys for status queries that should not read the whole journal.
+"""
+import json
+import mmap
+import os
+import time
+
+
+class CaptionStore:
+    """
+    Caption records of one dataset (e.g. a city) in an append-only JSONL file with an index of captioned images.
+
+    Writes are fsynced in batches: after every `sync_every` images or `sync_interval` seconds, and on close.
+    """
+
+    def __init__(self, path, sync_every=100, sync_interval=5.0):
+        """
+        :param path: Path of the JSONL file, e.g. pairs/Beijing_captions.jsonl; the index is <path without .jsonl>.keys.
+        :param sync_every: Images between fsyncs.
+        :param sync_interval: Seconds between fsyncs.
+        """
+        self.path = path
+        self.keys_path = os.path.splitext(path)[0] + '.keys'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._keys = set()
+        self._pending = []  # Key lines whose records are not fsynced yet
+        self._last_sync = time.monotonic()
+        self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as f:
+                keys_data = f.read()
+        else:
+            keys_data = self._rebuild_index(data_size)
+
+        # Keep keys up to the first partial line or the first one pointing past the end of the records
+        end, valid = 0, 0
+        for line in keys_data.split(b'\n')[:-1]:
+            key, _, offset = line.decode('utf-8').rpartition('\t')
+            if int(offset) > data_size:
+                break
+            self._keys.add(key)
+            end = int(offset)
+            valid += len(line) + 1
+
+        self._data = open(self.path, 'ab')
+        self._index = open(self.keys_path, 'ab')
+        # Drop records of an image whose key was never written, and any key written after a torn line
+        self._data.truncate(end)
+        self._index.truncate(valid)
+        self._size = end
+
+    def _rebuild_index(self, data_size):
+        """Recreate a missing key file from the complete records of the JSONL file."""
+        lines, image, offset = [], None, 0
+        if data_size:
+            with open(self.path, 'rb') as f:
+                for record in f:
+                    if not record.endswith(b'\n'):
+                        break
+                    record_image = json.loads(record)["image"]
+                    if image is not None and record_image != image:
+                        lines.append(f"{image}\t{offset}\n")
+                    image = record_image
+                    offset += len(record)
+        if image is not None:
+            lines.append(f"{image}\t{offset}\n")
+        keys_data = ''.join(lines).encode('utf-8')
+        with open(self.keys_path, 'wb') as f:
+            f.write(keys_data)
+        return keys_data
+
+    def __contains__(self, image):
+        return image in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return set(self._keys)
+
+    def add(self, image, captions):
+        """
+        Append the captions of one image and mark it as captioned (also when `captions` is empty).
+
+        :param image: Image key stored in each record, e.g. Beijing/18_1_2_s.jpg.
+        :param captions: Caption sentences of the image.
+        """
+        content = ''.join(json.dumps({"caption": caption, "image": image}, ensure_ascii=False) + '\n'
+                          for caption in captions).encode('utf-8')
+        self._data.write(content)
+        self._size += len(content)
+        self._pending.append(f"{image}\t{self._size}\n")
+        self._keys.add(image)
+        if len(self._pending) >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Make every added image durable: records first, then the key lines pointing at them."""
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        if self._pending:
+            self._index.write(''.join(self._pending).encode('utf-8'))
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            self._pending = []
+        self._last_sync = time.monotonic()
+
+    def records(self):
+        """Yield every caption record, in the order they were added."""
+        self._data.flush()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def import_json(self, json_path):
+        """
+        Append the records of a legacy nested-list caption JSON, skipping images already in the store.
+
+        :return: Number of images imported.
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        captions = {}
+        for item in (item for sublist in data for item in sublist):
+            if item["image"] not in self._keys:
+                captions.setdefault(item["image"], []).append(item["caption"])
+        for image, sentences in captions.items():
+            self.add(image, sentences)
+        self.sync()
+        return len(captions)
+
+    def export_json(self, json_path, ensure_ascii=True):
+        """
+        Compact the store into the legacy `[[{"caption", "image"}, ...]]` JSON file read by the other tools.
+
+        The file is written to a temporary name and renamed, so readers never see a partial export.
+        """
+        self.sync()
+        tmp_path = json_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([list(self.records())], f, ensure_ascii=ensure_ascii, indent=2)
+        os.replace(tmp_path, json_path)
+
+    def close(self):
+        if self._data.closed:
+            return
+        self.sync()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def image_key(image_path, base_directory):
+    """Canonical key of an image: its path relative to `base_directory`, with '/' separators."""
+    return os.path.relpath(image_path, base_directory).replace(os.sep, '/')
+
+
+class ProcessedIndex:
+    """
+    Sorted, deduplicated file of the image keys in a CaptionStore's key journal (<name>.index next to <name>.keys).
+
+    The index starts with a header line `<journal bytes covered> <key count>` and then holds one key per line in
+    byte order. `refresh` only reads the part of the journal written since the last refresh and merges the new
+    keys in, so the count is a header read and membership is a binary search over the memory-mapped file.
+    A read-only index never writes: keys the index file does not cover yet are only held in memory.
+    """
+
+    def __init__(self, keys_path, readonly=False):
+        """
+        :param keys_path: Path of the store's key journal (CaptionStore.keys_path).
+        :param readonly: Do not create or update the index file, e.g. for status queries.
+        """
+        self.keys_path = keys_path
+        self.index_path = os.path.splitext(keys_path)[0] + '.index'
+        self.readonly = readonly
+        self.count = 0
+        self._covered = 0
+        self._mmap = None
+        self._header_end = 0
+        self._stale = False  # Read-only and the index file covers more than the journal, so it is not used
+        self._extra = set()  # Read-only: keys of the journal the index file does not cover
+        self.refresh()
+
+    def _read_header(self):
+        if not os.path.exists(self.index_path):
+            return 0, 0
+        with open(self.index_path, 'rb') as f:
+            covered, count = f.readline().split()
+        return int(covered), int(count)
+
+    def refresh(self):
+        """Merge keys added to the journal since the last refresh into the sorted index (in memory if read-only)."""
+        journal_size = os.path.getsize(self.keys_path) if os.path.exists(self.keys_path) else 0
+        covered, count = self._read_header()
+        self._stale = False
+        if covered > journal_size:
+            # The store cut the journal back after a crash; rebuild from scratch
+            covered, count = 0, 0
+            self._close_mmap()
+            if self.readonly:
+                self._stale = True
+            else:
+                os.remove(self.index_path)
+
+        if covered < journal_size:
+            with open(self.keys_path, 'rb') as f:
+                f.seek(covered)
+                tail = f.read(journal_size - covered)
+            tail = tail[:tail.rfind(b'\n') + 1]  # Complete lines only
+            new_keys = sorted({line.rpartition(b'\t')[0] for line in tail.split(b'\n')[:-1]})
+        else:
+            tail, new_keys = b'', []
+        if self.readonly:
+            self._open_mmap()
+            self._extra = {key for key in new_keys if not self._contains(key)}
+            count += len(self._extra)
+        else:
+            if new_keys or tail:
+                covered, count = self._merge(new_keys, covered + len(tail))
+            self._open_mmap()
+
+        self._covered, self.count = covered, count
+        return self
+
+    def _existing_keys(self):
+        if self._stale or not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'rb') as f:
+            f.readline()
+            return f.read().split(b'\n')[:-1]
+
+    def _merge(self, new_keys, covered):
+        # Keys already in the index need no second line; the rest are appended and the two sorted runs are
+        # merged by list.sort, which does it in a single linear pass
+        self._open_mmap()
+        new_keys = [key for key in new_keys if not self._contains(key)]
+        keys = self._existing_keys()
+        keys.extend(new_keys)
+        keys.sort()
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(f"{covered} {len(keys)}".encode().ljust(40) + b'\n')
+            if keys:
+                f.write(b'\n'.join(keys) + b'\n')
+        self._close_mmap()
+        os.replace(tmp_path, self.index_path)
+        return covered, len(keys)
+
+    def _open_mmap(self):
+        self._close_mmap()
+        if self._stale or not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            self._header_end = len(f.readline())
+            if os.fstat(f.fileno()).st_size > self._header_end:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        target = key.encode('utf-8')
+        return target in self._extra or self._contains(target)
+
+    def _contains(self, target):
+        if self._mmap is None:
+            return False
+        mm, lo, hi = self._mmap, self._header_end, len(self._mmap)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', self._header_end - 1, mid) + 1
+            end = mm.find(b'\n', mid)
+            line = mm[start:end]
+            if line == target:
+                return True
+            if line < target:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def missing(self, keys):
+        """Keys not in the index, in the order given."""
+        keys = list(keys)
+        if len(keys) * 32 < self.count:
+            # A few keys: binary search each of them
+            return [key for key in keys if key not in self]
+        # Many keys: one pass over the index file into a set
+        existing = set(self._existing_keys())
+        existing.update(self._extra)
+        return [key for key in keys if key.encode('utf-8') not in existing]
+
+    def close(self):
+        self._close_mmap()
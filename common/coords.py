@@ -0,0 +1,197 @@
+"""
+Offline conversions between the coordinate systems used across the toolkit
+    - WGS84: The coordinate system used by the GPS global satellite positioning system.
+    - GCJ02: Mars coordinate system, used by AMap (Gaode), the source of our AOI polygons.
+    - BD09: Baidu's lat/lng system, an extra offset on top of GCJ02.
+    - BD09MC: Baidu Mercator, the planar system that Baidu tiles are cut from.
+
+Every function takes scalars or NumPy arrays (broadcast against each other) and
+returns NumPy values, so a whole column of coordinates converts in one call.
+The BD09 <-> BD09MC tables are the ones behind the geoconv v1 API, which makes
+the results match what `api.map.baidu.com/geoconv/v1/` returned for from=5/to=6
+and from=6/to=5.
+"""
+import numpy as np
+
+X_PI = np.pi * 3000.0 / 180.0
+
+# Krasovsky 1940 ellipsoid, used by the GCJ02 obfuscation
+A = 6378245.0
+EE = 0.00669342162296594323
+
+# Size of a Baidu tile in pixels; zoom 18 is the level where one pixel is one Mercator unit
+TILE_SIZE = 256
+BASE_ZOOM = 18
+
+# Latitude/Mercator bands and polynomial coefficients used by Baidu's projection
+MCBAND = np.array([12890594.86, 8362377.87, 5591021, 3481989.83, 1678043.12, 0])
+LLBAND = np.array([75, 60, 45, 30, 15, 0])
+MC2LL = np.array([
+    [1.410526172116255e-08, 8.98305509648872e-06, -1.9939833816331, 200.9824383106796, -187.2403703815547,
+     91.6087516669843, -23.38765649603339, 2.57121317296198, -0.03801003308653, 17337981.2],
+    [-7.435856389565537e-09, 8.983055097726239e-06, -0.78625201886289, 96.32687599759846, -1.85204757529826,
+     -59.36935905485877, 47.40033549296737, -16.50741931063887, 2.28786674699375, 10260144.86],
+    [-3.030883460898826e-08, 8.98305509983578e-06, 0.30071316287616, 59.74293618442277, 7.357984074871,
+     -25.38371002664745, 13.45380521110908, -3.29883767235584, 0.32710905363475, 6856817.37],
+    [-1.981981304930552e-08, 8.983055099779535e-06, 0.03278182852591, 40.31678527705744, 0.65659298677277,
+     -4.44255534477492, 0.85341911805263, 0.12923347998204, -0.04625736007561, 4482777.06],
+    [3.09191371068437e-09, 8.983055096812155e-06, 6.995724062e-05, 23.10934304144901, -0.00023663490511,
+     -0.6321817810242, -0.00663494467273, 0.03430082397953, -0.00466043876332, 2555164.4],
+    [2.890871144776878e-09, 8.983055095805407e-06, -3.068298e-08, 7.47137025468032, -3.53937994e-06,
+     -0.02145144861037, -1.234426596e-05, 0.00010322952773, -3.23890364e-06, 826088.5],
+])
+LL2MC = np.array([
+    [-0.0015702102444, 111320.7020616939, 1704480524535203, -10338987376042340, 26112667856603880,
+     -35149669176653700, 26595700718403920, -10725012454188240, 1800819912950474, 82.5],
+    [0.0008277824516172526, 111320.7020463578, 647795574.6671607, -4082003173.641316, 10774905663.51142,
+     -15171875531.51559, 12053065338.62167, -5124939663.577472, 913311935.9512032, 67.5],
+    [0.00337398766765, 111320.7020202162, 4481351.045890365, -23393751.19931662, 79682215.47186455,
+     -115964993.2797253, 97236711.15602145, -43661946.33752821, 8477230.501135234, 52.5],
+    [0.00220636496208, 111320.7020209128, 51751.86112841131, 3796837.749470245, 992013.7397791013,
+     -1221952.21711287, 1340652.697009075, -620943.6990984312, 144416.9293806241, 37.5],
+    [-0.0003441963504368392, 111320.7020576856, 278.2353980772752, 2485758.690035394, 6070.750963243378,
+     54821.18345352118, 9540.606633304236, -2710.55326746645, 1405.483844121726, 22.5],
+    [-0.0003218135878613132, 111320.7020701615, 0.00369383431289, 823725.6402795718, 0.46104986909093,
+     2351.343141331292, 1.58060784298199, 8.77738589078284, 0.37238884252424, 7.45],
+])
+
+
+def out_of_china(lng, lat):
+    """Boolean mask of points outside the rough China bounding box, where GCJ02 equals WGS84."""
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    return (lng < 72.004) | (lng > 137.8347) | (lat < 0.8293) | (lat > 55.8271)
+
+
+def _gcj02_delta(lng, lat):
+    """GCJ02 offset (dlng, dlat) in degrees for WGS84 points."""
+    x = lng - 105.0
+    y = lat - 35.0
+    abs_x = np.sqrt(np.abs(x))
+
+    dlat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * abs_x
+    dlat += (20.0 * np.sin(6.0 * x * np.pi) + 20.0 * np.sin(2.0 * x * np.pi)) * 2.0 / 3.0
+    dlat += (20.0 * np.sin(y * np.pi) + 40.0 * np.sin(y / 3.0 * np.pi)) * 2.0 / 3.0
+    dlat += (160.0 * np.sin(y / 12.0 * np.pi) + 320 * np.sin(y * np.pi / 30.0)) * 2.0 / 3.0
+
+    dlng = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * abs_x
+    dlng += (20.0 * np.sin(6.0 * x * np.pi) + 20.0 * np.sin(2.0 * x * np.pi)) * 2.0 / 3.0
+    dlng += (20.0 * np.sin(x * np.pi) + 40.0 * np.sin(x / 3.0 * np.pi)) * 2.0 / 3.0
+    dlng += (150.0 * np.sin(x / 12.0 * np.pi) + 300.0 * np.sin(x / 30.0 * np.pi)) * 2.0 / 3.0
+
+    rad_lat = lat / 180.0 * np.pi
+    magic = 1 - EE * np.sin(rad_lat) ** 2
+    sqrt_magic = np.sqrt(magic)
+    dlat = (dlat * 180.0) / ((A * (1 - EE)) / (magic * sqrt_magic) * np.pi)
+    dlng = (dlng * 180.0) / (A / sqrt_magic * np.cos(rad_lat) * np.pi)
+    return dlng, dlat
+
+
+def wgs84_to_gcj02(lng, lat):
+    """Convert WGS84 lng/lat to GCJ02 lng/lat."""
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    dlng, dlat = _gcj02_delta(lng, lat)
+    outside = out_of_china(lng, lat)
+    return np.where(outside, lng, lng + dlng), np.where(outside, lat, lat + dlat)
+
+
+def gcj02_to_wgs84(lng, lat, iterations=3):
+    """Convert GCJ02 lng/lat to WGS84 lng/lat by fixed-point refinement of the forward offset."""
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    wgs_lng, wgs_lat = lng, lat
+    for _ in range(iterations):
+        dlng, dlat = _gcj02_delta(wgs_lng, wgs_lat)
+        wgs_lng, wgs_lat = lng - dlng, lat - dlat
+    outside = out_of_china(lng, lat)
+    return np.where(outside, lng, wgs_lng), np.where(outside, lat, wgs_lat)
+
+
+def gcj02_to_bd09(lng, lat):
+    """Convert GCJ02 lng/lat to BD09 lng/lat."""
+    x, y = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    z = np.sqrt(x * x + y * y) + 0.00002 * np.sin(y * X_PI)
+    theta = np.arctan2(y, x) + 0.000003 * np.cos(x * X_PI)
+    return z * np.cos(theta) + 0.0065, z * np.sin(theta) + 0.006
+
+
+def bd09_to_gcj02(lng, lat):
+    """Convert BD09 lng/lat to GCJ02 lng/lat."""
+    x = np.asarray(lng, dtype=np.float64) - 0.0065
+    y = np.asarray(lat, dtype=np.float64) - 0.006
+    z = np.sqrt(x * x + y * y) - 0.00002 * np.sin(y * X_PI)
+    theta = np.arctan2(y, x) - 0.000003 * np.cos(x * X_PI)
+    return z * np.cos(theta), z * np.sin(theta)
+
+
+def wgs84_to_bd09(lng, lat):
+    """Convert WGS84 lng/lat to BD09 lng/lat."""
+    return gcj02_to_bd09(*wgs84_to_gcj02(lng, lat))
+
+
+def bd09_to_wgs84(lng, lat):
+    """Convert BD09 lng/lat to WGS84 lng/lat."""
+    return gcj02_to_wgs84(*bd09_to_gcj02(lng, lat))
+
+
+def _convertor(x, y, coef):
+    """Evaluate Baidu's band polynomial; `coef` holds one row of coefficients per point."""
+    x_out = coef[..., 0] + coef[..., 1] * np.abs(x)
+    c = np.abs(y) / coef[..., 9]
+    # Evaluated as coef * c * c * ... left to right, like the reference implementation, to keep
+    # bit-for-bit parity with geoconv
+    y_out = coef[..., 2]
+    for i in range(3, 9):
+        term = coef[..., i]
+        for _ in range(i - 2):
+            term = term * c
+        y_out = y_out + term
+    return np.copysign(x_out, x), np.copysign(y_out, y)
+
+
+def bd09_to_bd09mc(lng, lat):
+    """Convert BD09 lng/lat to BD09 Mercator x/y (geoconv from=5, to=6)."""
+    lng, lat = np.broadcast_arrays(np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    lng = np.where(np.abs(lng) > 180.0, (lng + 180.0) % 360.0 - 180.0, lng)
+    lat = np.clip(lat, -74.0, 74.0)
+    # Pick the first band whose lower bound the absolute latitude reaches
+    band = np.argmax(np.abs(lat)[..., np.newaxis] >= LLBAND, axis=-1)
+    return _convertor(lng, lat, LL2MC[band])
+
+
+def bd09mc_to_bd09(x, y):
+    """Convert BD09 Mercator x/y to BD09 lng/lat (geoconv from=6, to=5)."""
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    band = np.argmax(np.abs(y)[..., np.newaxis] >= MCBAND, axis=-1)
+    return _convertor(x, y, MC2LL[band])
+
+
+def bd09mc_to_pixel(x, y, zoom):
+    """Scale BD09 Mercator x/y to global pixel coordinates at the given zoom level."""
+    res = 2.0 ** (BASE_ZOOM - zoom)
+    return np.asarray(x, dtype=np.float64) / res, np.asarray(y, dtype=np.float64) / res
+
+
+def pixel_to_bd09mc(px, py, zoom):
+    """Scale global pixel coordinates at the given zoom level back to BD09 Mercator x/y."""
+    res = 2.0 ** (BASE_ZOOM - zoom)
+    return np.asarray(px, dtype=np.float64) * res, np.asarray(py, dtype=np.float64) * res
+
+
+def pixel_to_tile(px, py):
+    """Integer tile indices containing the given pixel coordinates."""
+    return (np.floor_divide(px, TILE_SIZE).astype(np.int64),
+            np.floor_divide(py, TILE_SIZE).astype(np.int64))
+
+
+def tile_to_bd09mc(tile_x, tile_y, zoom):
+    """BD09 Mercator x/y of the lower-left (south-west) corner of a tile."""
+    return pixel_to_bd09mc(np.asarray(tile_x) * TILE_SIZE, np.asarray(tile_y) * TILE_SIZE, zoom)
+
+
+def bd09_to_pixel(lng, lat, zoom):
+    """Convert BD09 lng/lat to global pixel coordinates at the given zoom level."""
+    return bd09mc_to_pixel(*bd09_to_bd09mc(lng, lat), zoom)
+
+
+def tile_to_bd09(tile_x, tile_y, zoom):
+    """BD09 lng/lat of the lower-left (south-west) corner of a tile."""
+    return bd09mc_to_bd09(*tile_to_bd09mc(tile_x, tile_y, zoom))
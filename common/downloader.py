@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of in-flight requests.
+
+    Every successful, fast response raises the limit by 1/limit (about +1 per round of requests);
+    a 429, 5xx or network error halves it and adds a pause between request starts, which decays
+    again as responses recover. This replaces fixed random sleeps with a rate the server can sustain.
+
+    The limit is decreased at most once per congestion window: a burst of throttled responses to requests that
+    were all in flight together counts as one congestion signal, so only throttles of requests started after
+    the last decrease decrease it again. The pause is jittered so retries do not restart in lockstep.
+    """
+
+    def __init__(self, initial=32, minimum=1, maximum=666, target_latency=2.0, max_delay=10.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.in_flight = 0
+        self._window = 0  # Number of decreases so far; a request remembers the window it started in
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a slot (and the current pause, with jitter).
+
+        :return: The congestion window the request starts in, to pass to `release`.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            delay = self.delay
+            window = self._window
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.5))
+        return window
+
+    def release(self, latency, throttled, window=None):
+        """
+        :param latency: Seconds the request took.
+        :param throttled: Whether the response was a 429, 5xx or network error.
+        :param window: What `acquire` returned for the request; None counts it in the current window.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                if window is None or window == self._window:
+                    self._window += 1
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.delay = min(self.max_delay, max(self.delay * 2, 0.1))
+            else:
+                if latency <= self.target_latency:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.delay = self.delay / 2 if self.delay > 0.01 else 0.0
+            self._condition.notify_all()
+
+
+class DownloadStats:
+    """Thread-safe counters and latencies for a download run."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.succeeded = 0
+        self.failed = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, latency, status, size):
+        with self._lock:
+            self.latencies.append(latency)
+            if status == 200:
+                self.succeeded += 1
+                self.bytes += size
+            elif status is None or status == 429 or status >= 500:
+                self.throttled += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def summary(self):
+        """Return throughput and latency figures for everything recorded so far."""
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'tiles': self.succeeded,
+            'failed': self.failed,
+            'throttled': self.throttled,
+            'requests': len(self.latencies),
+            'megabytes': self.bytes / 1e6,
+            'elapsed': elapsed,
+            'tiles_per_second': self.succeeded / elapsed if elapsed else 0.0,
+            'megabytes_per_second': self.bytes / 1e6 / elapsed if elapsed else 0.0,
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95)),
+        }
+
+
+class TileDownloader:
+    """
+    Downloads tiles over one shared, connection-pooled requests.Session.
+
+    The session keeps HTTP connections alive across tiles, and its pool is sized to the worker count so
+    no worker waits for a connection. Concurrency is governed by an AdaptiveLimiter, and throttled or
+    failed requests are retried a few times before the tile is given up.
+    """
+
+    def __init__(self, max_workers=666, initial_concurrency=32, timeout=10, max_retries=3,
+                 headers=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update(headers or {'User-Agent': 'Mozilla/5.0'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = AdaptiveLimiter(initial=min(initial_concurrency, max_workers), maximum=max_workers)
+        self.stats = DownloadStats()
+
+    def fetch(self, url):
+        """
+        Fetch a URL, adapting concurrency to the server's responses.
+
+        :param url: Tile URL.
+        :return: Response body, or None if the tile could not be downloaded.
+        """
+        for attempt in range(self.max_retries + 1):
+            window = self.limiter.acquire()
+            start = time.perf_counter()
+            status, content, error = None, b'', None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                status, content = response.status_code, response.content
+            except requests.RequestException as e:
+                error = e
+            latency = time.perf_counter() - start
+            throttled = status is None or status == 429 or status >= 500
+            self.limiter.release(latency, throttled, window)
+            self.stats.record(latency, status, len(content))
+
+            if status == 200:
+                return content
+            if not throttled:
+                # Other 4xx responses will not change on retry
+                error = f"HTTP {status}"
+                break
+            logger.info(f"-- {url} -> {error or f'HTTP {status}'} (attempt {attempt + 1}), "
+                        f"concurrency now {int(self.limiter.limit)}")
+
+        self.stats.record_failure()
+        logger.info(f"-- {url} -> {error or f'HTTP {status}'}")
+        return None
+
+    def log_summary(self, name):
+        summary = self.stats.summary()
+        logger.info(f"{name}: {summary['tiles']} tiles ({summary['megabytes']:.1f} MB) in {summary['elapsed']:.1f}s, "
+                    f"{summary['tiles_per_second']:.1f} tiles/s, {summary['megabytes_per_second']:.2f} MB/s, "
+                    f"latency p50 {summary['latency_p50'] * 1000:.0f} ms / p95 {summary['latency_p95'] * 1000:.0f} ms, "
+                    f"{summary['failed']} failed, {summary['throttled']} throttled responses, "
+                    f"final concurrency {int(self.limiter.limit)}")
+        return summary
+
+    def close(self):
+        self.session.close()
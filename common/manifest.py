@@ -0,0 +1,144 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class CrawlManifest:
+    """
+    SQLite record of every tile a crawl has attempted, keyed by (city, zoom, x, y).
+
+    Each row stores the status ('done' or 'failed'), byte size, MD5 checksum, attempt count and the
+    earliest time a failed tile may be retried (exponential backoff). On restart, the tiles of a range
+    are loaded in one query into a NumPy bitmap, so only missing or retry-due tiles are scheduled,
+    without a stat call per tile. Writes are buffered and committed in batches.
+    """
+
+    def __init__(self, path, max_attempts=5, backoff=60.0, batch_size=500):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                city TEXT NOT NULL,
+                zoom INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                checksum TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_retry REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (city, zoom, x, y)
+            ) WITHOUT ROWID
+        """)
+        self._connection.commit()
+        self._pending_writes = []
+        self._lock = threading.Lock()
+
+    def _load(self, city, zoom, start_x, stop_x, start_y, stop_y):
+        """Bitmaps (indexed [x - start_x, y - start_y]) of done tiles and of failed tiles not yet due for retry."""
+        self.flush()
+        shape = (max(stop_x - start_x, 0), max(stop_y - start_y, 0))
+        done = np.zeros(shape, dtype=bool)
+        blocked = np.zeros(shape, dtype=bool)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT x, y, status, attempts, next_retry FROM tiles "
+                "WHERE city = ? AND zoom = ? AND x >= ? AND x < ? AND y >= ? AND y < ?",
+                (city, zoom, start_x, stop_x, start_y, stop_y)).fetchall()
+        if rows:
+            xs, ys, statuses, attempts, next_retry = map(np.array, zip(*rows))
+            xs, ys = xs - start_x, ys - start_y
+            is_done = statuses == 'done'
+            done[xs[is_done], ys[is_done]] = True
+            waiting = ~is_done & ((attempts >= self.max_attempts) | (next_retry > time.time()))
+            blocked[xs[waiting], ys[waiting]] = True
+        return done, blocked
+
+    def pending(self, city, zoom, start_x, stop_x, start_y, stop_y):
+        """
+        Tiles of the range that still need downloading: never attempted, or failed and due for retry.
+
+        :return: Tuple of (generator of (x, y), number of done tiles, number of failed tiles still backing off).
+                 The generator walks the index array of pending tiles, so no list of tuples is built.
+        """
+        done, blocked = self._load(city, zoom, start_x, stop_x, start_y, stop_y)
+        todo = np.argwhere(~done & ~blocked)
+        tiles = ((start_x + int(dx), start_y + int(dy)) for dx, dy in todo)
+        return tiles, int(done.sum()), int(blocked.sum())
+
+    def has_tiles(self, city, zoom):
+        """Whether the manifest has any record for this city and zoom level."""
+        self.flush()
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM tiles WHERE city = ? AND zoom = ? LIMIT 1",
+                                           (city, zoom)).fetchone()
+        return row is not None
+
+    def import_existing(self, city, zoom, store):
+        """
+        Mark tiles already in a tile store (e.g. from crawls that predate the manifest) as done.
+
+        Uses the store's listing once instead of checking every tile of the range.
+        """
+        rows = [(city, zoom, x, y, 'done', store.size(tile_zoom, x, y), None, 1, 0.0)
+                for tile_zoom, x, y in store.keys() if tile_zoom == zoom]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO tiles (city, zoom, x, y, status, bytes, checksum, attempts, next_retry) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+        return len(rows)
+
+    def _record(self, row):
+        with self._lock:
+            self._pending_writes.append(row)
+            if len(self._pending_writes) >= self.batch_size:
+                self._flush_locked()
+
+    def record_success(self, city, zoom, x, y, content):
+        """Record a downloaded tile with its size and checksum."""
+        self._record((city, zoom, x, y, 'done', len(content), hashlib.md5(content).hexdigest()))
+
+    def record_failure(self, city, zoom, x, y):
+        """Record a failed tile; its next retry is pushed back exponentially with each attempt."""
+        self._record((city, zoom, x, y, 'failed', 0, None))
+
+    def _flush_locked(self):
+        if not self._pending_writes:
+            return
+        now = time.time()
+        for city, zoom, x, y, status, size, checksum in self._pending_writes:
+            if status == 'done':
+                self._connection.execute(
+                    "INSERT INTO tiles (city, zoom, x, y, status, bytes, checksum, attempts, next_retry) "
+                    "VALUES (?, ?, ?, ?, 'done', ?, ?, 1, 0) "
+                    "ON CONFLICT (city, zoom, x, y) DO UPDATE SET status = 'done', bytes = excluded.bytes, "
+                    "checksum = excluded.checksum, attempts = attempts + 1, next_retry = 0",
+                    (city, zoom, x, y, size, checksum))
+            else:
+                self._connection.execute(
+                    "INSERT INTO tiles (city, zoom, x, y, status, attempts, next_retry) "
+                    "VALUES (?, ?, ?, ?, 'failed', 1, ?) "
+                    "ON CONFLICT (city, zoom, x, y) DO UPDATE SET status = 'failed', attempts = attempts + 1, "
+                    "next_retry = ? * (1 << MIN(attempts, 20)) + ?",
+                    (city, zoom, x, y, now + self.backoff, self.backoff, now))
+        self._connection.commit()
+        self._pending_writes = []
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        self.flush()
+        self._connection.close()
@@ -0,0 +1,155 @@
+"""
+Polygon mask rasterization with NumPy.
+
+Rings are scan-converted in one vectorized pass: every (edge, pixel row) crossing is generated at once, sorted
+by row and x, and consecutive crossings are paired into runs of inside pixels (even-odd rule, so interior rings
+cut holes and the parts of a MultiPolygon simply add up). The runs are then either copied straight from the
+source image, or their complement is zeroed in place (`mask_in_place`), or they are turned into a uint8 mask.
+
+A pixel is inside when its centre is inside the polygon.
+"""
+import numpy as np
+
+
+def polygon_rings(geometry):
+    """Exterior and interior rings of a Polygon or MultiPolygon, as (N, 2) float arrays."""
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    rings = []
+    for polygon in polygons:
+        rings.append(np.asarray(polygon.exterior.coords, dtype=np.float64)[:, :2])
+        rings.extend(np.asarray(interior.coords, dtype=np.float64)[:, :2] for interior in polygon.interiors)
+    return rings
+
+
+def polygon_spans(rings, height, width):
+    """
+    Horizontal runs of pixels inside closed rings given in pixel coordinates (x to the right, y down).
+
+    :param rings: Iterable of (N, 2) arrays of ring vertices; rings are closed implicitly.
+    :param height: Raster height in pixels.
+    :param width: Raster width in pixels.
+    :return: Arrays (rows, starts, stops): pixels row, starts[i]:stops[i] are inside. Runs of a row are disjoint.
+    """
+    rings = [np.asarray(ring, dtype=np.float64) for ring in rings]
+    empty = np.zeros(0, dtype=np.int64)
+    if not rings:
+        return empty, empty, empty
+    x0, y0 = np.concatenate(rings).T
+    x1, y1 = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings]).T
+
+    # Rows whose pixel centre (row + 0.5) lies in [min(y0, y1), max(y0, y1)) of each non-horizontal edge
+    first_row = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    stop_row = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    counts = stop_row - first_row
+    edges = np.repeat(np.arange(len(x0)), counts)
+    if len(edges) == 0:
+        return empty, empty, empty
+    rows = np.arange(len(edges)) - np.repeat(np.cumsum(counts) - counts, counts) + first_row[edges]
+
+    # x of each crossing, then pair crossings of the same row left to right
+    xs = x0[edges] + (rows + 0.5 - y0[edges]) * (x1[edges] - x0[edges]) / (y1[edges] - y0[edges])
+    order = np.lexsort((xs, rows))
+    rows, xs = rows[order], xs[order]
+    # Pixel columns whose centre lies in [x_enter, x_leave)
+    starts = np.clip(np.ceil(xs[0::2] - 0.5), 0, width).astype(np.int64)
+    stops = np.clip(np.ceil(xs[1::2] - 0.5), 0, width).astype(np.int64)
+    keep = starts < stops
+    return rows[0::2][keep], starts[keep], stops[keep]
+
+
+def _spans_to_mask(rows, starts, stops, height, width):
+    # +1/-1 steps at the ends of each run; runs of a row never overlap, so the running sum is 0 or 1.
+    # Starts (and stops) are distinct within a row, so plain fancy indexing is enough for each of them.
+    steps = np.zeros((height, width + 1), dtype=np.uint8)
+    steps[rows, starts] = 1
+    steps[rows, stops] -= 1
+    np.cumsum(steps, axis=1, dtype=np.uint8, out=steps)
+    return steps[:, :width]
+
+
+def rasterize_rings(rings, height, width):
+    """
+    Rasterize closed rings given in pixel coordinates into a mask.
+
+    :return: uint8 array of shape (height, width), 1 inside the polygon and 0 outside.
+    """
+    return _spans_to_mask(*polygon_spans(rings, height, width), height, width)
+
+
+def masked_copy(image, rings, out=None):
+    """
+    Copy the pixels of an (H, W) or (H, W, C) image that lie inside the rings; everything else is 0.
+
+    Only the inside runs are copied into a zero-initialised output, so no mask or background image the size
+    of the output is allocated. Extremely jagged polygons, where copying each short run one by one would cost
+    more than a few passes over the whole image, are masked band by band instead.
+
+    :param image: Source image array; it is not modified.
+    :param rings: Rings in the image's pixel coordinates.
+    :param out: Optional zero-filled output array of the same shape and dtype (e.g. a memmap).
+    """
+    height, width = image.shape[:2]
+    if out is None:
+        out = np.zeros_like(image)
+    rows, starts, stops = polygon_spans(rings, height, width)
+
+    # Copying a run costs about as much as masking a few hundred pixels in bulk
+    if len(rows) * 256 <= height * width:
+        for row, start, stop in zip(rows.tolist(), starts.tolist(), stops.tolist()):
+            out[row, start:stop] = image[row, start:stop]
+        return out
+
+    mask = _spans_to_mask(rows, starts, stops, height, width)
+    channels = image.shape[2] if image.ndim == 3 else 1
+    band = max(1, (1 << 22) // (width * channels))
+    for row in range(0, height, band):
+        band_mask = mask[row:row + band]
+        if image.ndim == 3:
+            band_mask = np.repeat(band_mask[:, :, np.newaxis], channels, axis=2)
+        np.multiply(image[row:row + band], band_mask, out=out[row:row + band])
+    return out
+
+
+def mask_in_place(image, rings):
+    """
+    Zero the pixels of an (H, W) or (H, W, C) image that lie outside the rings, in place.
+
+    Only the gaps between inside runs (and rows with no run at all) are written, so nothing the size of the image
+    is allocated. Extremely jagged polygons are masked band by band with a mask of one band's rows at a time.
+
+    :param image: Writable image array.
+    :param rings: Rings in the image's pixel coordinates.
+    :return: `image`.
+    """
+    height, width = image.shape[:2]
+    rows, starts, stops = polygon_spans(rings, height, width)
+
+    if len(rows) * 256 > height * width:
+        channels = image.shape[2] if image.ndim == 3 else 1
+        band = max(1, (1 << 22) // (width * channels))
+        for row in range(0, height, band):
+            # Runs are sorted by row, so each band's runs are a contiguous slice
+            first, last = np.searchsorted(rows, [row, row + band])
+            band_mask = _spans_to_mask(rows[first:last] - row, starts[first:last], stops[first:last],
+                                       min(band, height - row), width)
+            if image.ndim == 3:
+                band_mask = band_mask[:, :, np.newaxis]
+            np.multiply(image[row:row + band], band_mask, out=image[row:row + band])
+        return image
+
+    # Gaps: before each row's first run, between consecutive runs of a row, and after each row's last run
+    new_row = np.ones(len(rows), dtype=bool)
+    new_row[1:] = rows[1:] != rows[:-1]
+    row_end = np.roll(new_row, -1)
+    gap_starts = np.where(new_row, 0, np.roll(stops, 1))
+    for row, start, stop in zip(rows.tolist(), gap_starts.tolist(), starts.tolist()):
+        image[row, start:stop] = 0
+    for row, start in zip(rows[row_end].tolist(), stops[row_end].tolist()):
+        image[row, start:] = 0
+    # Rows without any run, zeroed as blocks of consecutive rows
+    empty = np.ones(height, dtype=bool)
+    empty[rows] = False
+    bounds = np.flatnonzero(np.diff(np.concatenate(([0], empty.view(np.int8), [0]))))
+    for first, stop in zip(bounds[0::2].tolist(), bounds[1::2].tolist()):
+        image[first:stop] = 0
+    return image
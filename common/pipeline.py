@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline: `workers` threads taking items from a bounded input queue.
+
+    To run a stage in a process pool, its function can submit the item and wait for the result, so at most
+    `workers` items are in the pool at once and a slow stage blocks the one before it through the full queue
+    between them.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or 2 * workers)
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, failed):
+        with self._lock:
+            self.busy += elapsed
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def summary(self, elapsed):
+        """Throughput and utilisation of the stage over `elapsed` seconds of pipeline run time."""
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'items_per_second': self.processed / elapsed if elapsed else 0.0,
+            # Fraction of the stage's worker time spent working rather than waiting for input or output
+            'utilisation': self.busy / (elapsed * self.workers) if elapsed else 0.0,
+            'max_queue_depth': self.max_depth,
+        }
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues.
+
+    Each stage's function takes one item and returns the item for the next stage (None drops it). Items
+    flow through all stages concurrently, e.g. one AOI's tiles are downloaded while the previous AOI is being
+    stitched and the one before it is being saved. An exception in a stage is logged and drops only that item.
+    """
+
+    def __init__(self, name='pipeline'):
+        self.name = name
+        self.stages = []
+        self.started = None
+
+    def add_stage(self, name, func, workers=1, queue_size=None):
+        self.stages.append(Stage(name, func, workers, queue_size))
+        return self
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            result, failed = None, False
+            try:
+                result = stage.func(item)
+            except Exception:
+                failed = True
+                logger.exception(f"{self.name}: stage '{stage.name}' failed")
+            stage.record(time.perf_counter() - start, failed)
+            if result is not None and next_stage is not None:
+                next_stage.queue.put(result)  # Blocks while the next stage is behind
+
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(_DONE)
+
+    def run(self, items, log_interval=60.0):
+        """
+        Feed `items` (consumed lazily) through every stage and wait until all of them are done.
+
+        :param items: Iterable of inputs for the first stage.
+        :param log_interval: Seconds between progress logs.
+        :return: Dict of stage name -> summary (see Stage.summary).
+        """
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{n}", daemon=True)
+                   for index, stage in enumerate(self.stages) for n in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        first = self.stages[0]
+        last_log = time.perf_counter()
+        for item in items:
+            first.queue.put(item)  # Blocks while the first stage is behind
+            if time.perf_counter() - last_log >= log_interval:
+                self.log_summary()
+                last_log = time.perf_counter()
+        for _ in range(first.workers):
+            first.queue.put(_DONE)
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=log_interval)
+                if thread.is_alive():
+                    self.log_summary()
+        return self.log_summary()
+
+    def log_summary(self):
+        elapsed = time.perf_counter() - self.started
+        summaries = {}
+        for stage in self.stages:
+            summary = summaries[stage.name] = stage.summary(elapsed)
+            logger.info(f"{self.name} [{stage.name}]: {summary['processed']} done, {summary['failed']} failed, "
+                        f"{summary['items_per_second']:.2f}/s, {summary['utilisation']:.0%} busy "
+                        f"({stage.workers} workers), max queue {summary['max_queue_depth']}")
+        return summaries
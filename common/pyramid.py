@@ -0,0 +1,124 @@
+"""
+Builds coarser zoom levels of a tile pyramid from the finest level, without downloading them again.
+
+Each parent tile at zoom z - 1 covers the 2x2 children (2x, 2y), (2x + 1, 2y), (2x, 2y + 1), (2x + 1, 2y + 1) at
+zoom z (Baidu tile y grows northwards, so the 2y + 1 children form the top half). Parents are visited in Morton
+(Z-order) so that the children read in turn sit next to each other in a pack and in the page cache, and are
+downsampled by a process pool that only ever holds one parent's four children per task in memory.
+"""
+import io
+from multiprocessing import Pool
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from common.coords import TILE_SIZE
+from common.tile_store import PackedTileStore, get_tile_store, open_tile_store
+
+_worker_store = None
+
+
+def morton_code(x, y):
+    """Interleave the bits of non-negative integer arrays x and y into Z-order codes."""
+
+    def spread(v):
+        v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+        v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return v
+
+    return spread(x) | (spread(y) << np.uint64(1))
+
+
+def parent_tiles(tiles):
+    """Unique parents of (x, y) tiles, in Morton order."""
+    if not tiles:
+        return []
+    xy = np.unique(np.asarray(list(tiles), dtype=np.int64) >> 1, axis=0)
+    origin = xy.min(axis=0)
+    order = np.argsort(morton_code(xy[:, 0] - origin[0], xy[:, 1] - origin[1]), kind='stable')
+    return [(int(x), int(y)) for x, y in xy[order]]
+
+
+def _init_worker(directory, suffix, packed):
+    global _worker_store
+    _worker_store = open_tile_store(directory, suffix, packed, readonly=True)
+
+
+def downsample_tile(store, zoom, x, y, suffix):
+    """
+    Render parent tile (x, y) at `zoom` from its four children at `zoom` + 1.
+
+    Missing children are left black. Returns the encoded tile, or None if no child exists.
+    """
+    parent = None
+    for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        data = store.get(zoom + 1, 2 * x + dx, 2 * y + dy)
+        if data is None:
+            continue
+        with Image.open(io.BytesIO(data)) as child:
+            child = child.convert('RGB')
+            if parent is None:
+                parent = Image.new('RGB', (2 * child.width, 2 * child.height))
+            # Children with the larger y lie to the north, i.e. in the top half of the parent
+            parent.paste(child, (dx * child.width, (1 - dy) * child.height))
+    if parent is None:
+        return None
+
+    # 2x2 box filter back down to one tile
+    parent = parent.reduce(2) if parent.width == 2 * TILE_SIZE else parent.resize((TILE_SIZE, TILE_SIZE), Image.BOX)
+    buffer = io.BytesIO()
+    if suffix.endswith('.png'):
+        parent.save(buffer, format='PNG', optimize=True)
+    else:
+        parent.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def _build_parent(job):
+    zoom, x, y, suffix = job
+    return x, y, downsample_tile(_worker_store, zoom, x, y, suffix)
+
+
+def build_pyramid(directory, max_zoom, min_zoom, suffix='_s.jpg', packed=None, processes=None, overwrite=False,
+                  chunk_size=64):
+    """
+    Derive zoom levels max_zoom - 1 down to min_zoom from the tiles already stored at max_zoom.
+
+    :param directory: Tile directory of a city, e.g. tiles/Beijing (its pack is used if there is one).
+    :param max_zoom: Finest (downloaded) zoom level.
+    :param min_zoom: Coarsest zoom level to build.
+    :param suffix: Tile file name suffix; '.png' tiles are written as PNG, others as JPEG.
+    :param packed: True/False to force a store backend; None picks the pack if it exists.
+    :param processes: Worker processes (defaults to the CPU count).
+    :param overwrite: Rebuild parent tiles that already exist.
+    :param chunk_size: Parents handed to a worker at a time.
+    :return: Dict of zoom level -> number of tiles built.
+    """
+    store = get_tile_store(directory, suffix, packed)
+    packed = isinstance(store, PackedTileStore)
+    tiles = [(x, y) for zoom, x, y in store.keys() if zoom == max_zoom]
+    built = {}
+
+    for zoom in range(max_zoom - 1, min_zoom - 1, -1):
+        parents = parent_tiles(tiles)
+        jobs = [(zoom, x, y, suffix) for x, y in parents if overwrite or not store.has(zoom, x, y)]
+        # Children written at the previous level must be on disk before workers open the store
+        store.flush()
+        count = 0
+        with Pool(processes, initializer=_init_worker, initargs=(directory, suffix, packed)) as pool:
+            for x, y, content in pool.imap(_build_parent, jobs, chunksize=chunk_size):
+                if content is not None:
+                    store.put(zoom, x, y, content)
+                    count += 1
+        built[zoom] = count
+        logger.info(f"{directory}: built {count} tiles at zoom {zoom} from zoom {zoom + 1} "
+                    f"({len(parents) - len(jobs)} already present)")
+        tiles = parents
+
+    store.flush()
+    return built
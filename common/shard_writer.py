@@ -0,0 +1,267 @@
+"""
+Sharded output for image-text pairs, so a training dataloader streams a few large files sequentially instead of
+opening one small file per sample.
+
+    - TarShardWriter: WebDataset-style tar shards. Each sample is consecutive `<key>.jpg`, `<key>.txt` and
+      `<key>.json` members (the JSON holds the sample's metadata), so `webdataset.WebDataset` or `iter_tar_samples`
+      can read the shards as a stream.
+    - ArrayShardWriter: decoded uint8 pixels appended to `<shard>.bin`, with `<shard>.idx.npy` holding the
+      (offset, height, width, channels) of every sample and `<shard>.jsonl` its key, text and metadata. `ArrayShard`
+      memory-maps the .bin file, so reading a sample is a slice of the page cache with no decode at all.
+
+Both close a shard after `max_samples` samples (or once it holds `max_bytes` of image data) and start the next,
+named `<prefix>-000000`, `<prefix>-000001`, ... A shard is written under a `.tmp` name and renamed when complete,
+so a crash never leaves a truncated shard behind. Images are passed as numpy arrays or, for tar shards, as
+already-encoded JPEG bytes, which lets worker processes do the encoding.
+"""
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+TAR_BLOCK = tarfile.BLOCKSIZE
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('height', '<u4'), ('width', '<u4'), ('channels', '<u4')])
+
+
+def encode_jpeg(image, quality=75):
+    """JPEG bytes of a uint8 RGB array (quality 75 is Pillow's default, as for images saved to files)."""
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class ShardWriter:
+    """
+    Base class: rolls samples over into numbered shards. Subclasses open, add to and finish one shard.
+    """
+
+    suffix = ''  # Extension of a finished shard's path as listed in `shards`
+
+    def __init__(self, directory, prefix='shard', max_samples=1000, max_bytes=None):
+        """
+        :param directory: Directory the shards are written to.
+        :param prefix: Shard name prefix.
+        :param max_samples: Samples per shard.
+        :param max_bytes: Optional bound on the image bytes of a shard; a shard is closed once it reaches it.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.shards = []  # Paths of the finished shards
+        self.samples = 0
+        self._shard = None
+        self._shard_samples = 0
+        self._shard_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, key, image, text, metadata=None):
+        """
+        Add one sample.
+
+        :param key: Sample key, unique within the dataset (e.g. the image ID).
+        :param image: uint8 (H, W, C) array, or JPEG bytes where the format stores JPEG.
+        :param text: The sample's text.
+        :param metadata: Optional JSON-serialisable dict stored with the sample.
+        """
+        if self._shard is None:
+            self._shard = os.path.join(self.directory, f"{self.prefix}-{len(self.shards):06d}")
+            self._open(self._shard)
+        self._shard_bytes += self._add(key, image, text, metadata or {})
+        self._shard_samples += 1
+        self.samples += 1
+        if self._shard_samples >= self.max_samples or (self.max_bytes and self._shard_bytes >= self.max_bytes):
+            self._finish_shard()
+
+    def _finish_shard(self):
+        self._finish(self._shard)
+        self.shards.append(self._shard + self.suffix)
+        self._shard, self._shard_samples, self._shard_bytes = None, 0, 0
+
+    def close(self):
+        """Finish the last shard; returns the paths of all shards."""
+        if self._shard is not None:
+            self._finish_shard()
+        return self.shards
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, shard):
+        raise NotImplementedError
+
+    def _add(self, key, image, text, metadata):
+        """Add a sample to the open shard; returns the bytes of image data written."""
+        raise NotImplementedError
+
+    def _finish(self, shard):
+        raise NotImplementedError
+
+
+class TarShardWriter(ShardWriter):
+    """WebDataset tar shards: `<key>.jpg`, `<key>.txt` and `<key>.json` per sample."""
+
+    suffix = '.tar'
+
+    def __init__(self, directory, prefix='shard', max_samples=1000, max_bytes=None, quality=75):
+        """
+        :param quality: JPEG quality for images passed as arrays.
+        """
+        super().__init__(directory, prefix, max_samples, max_bytes)
+        self.quality = quality
+        self._tar = None
+
+    def _open(self, shard):
+        self._tar = tarfile.open(shard + '.tar.tmp', 'w', format=tarfile.USTAR_FORMAT)
+
+    def _member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _add(self, key, image, text, metadata):
+        if isinstance(image, np.ndarray):
+            image = encode_jpeg(image, self.quality)
+        self._member(f"{key}.jpg", image)
+        self._member(f"{key}.txt", text.encode('utf-8'))
+        self._member(f"{key}.json", json.dumps(metadata, ensure_ascii=False).encode('utf-8'))
+        return len(image)
+
+    def _finish(self, shard):
+        self._tar.close()
+        self._tar = None
+        os.replace(shard + '.tar.tmp', shard + '.tar')
+
+
+class ArrayShardWriter(ShardWriter):
+    """Raw uint8 pixels in `<shard>.bin`, with an offset index `<shard>.idx.npy` and texts in `<shard>.jsonl`."""
+
+    def __init__(self, directory, prefix='shard', max_samples=1000, max_bytes=None):
+        super().__init__(directory, prefix, max_samples, max_bytes)
+        self._data = self._records = None
+        self._index = []
+
+    def _open(self, shard):
+        self._data = open(shard + '.bin.tmp', 'wb')
+        self._records = open(shard + '.jsonl.tmp', 'w', encoding='utf-8')
+        self._index = []
+
+    def _add(self, key, image, text, metadata):
+        if not isinstance(image, np.ndarray):
+            with Image.open(io.BytesIO(image)) as decoded:
+                image = np.asarray(decoded.convert('RGB'))
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.ndim == 2:
+            image = image[..., None]
+        self._index.append((self._data.tell(),) + image.shape)
+        self._data.write(image.data)
+        self._records.write(json.dumps({'key': key, 'text': text, **metadata}, ensure_ascii=False) + '\n')
+        return image.nbytes
+
+    def _finish(self, shard):
+        self._data.close()
+        self._records.close()
+        self._data = self._records = None
+        # The index is written last: a shard is complete once its .idx.npy exists
+        os.replace(shard + '.bin.tmp', shard + '.bin')
+        os.replace(shard + '.jsonl.tmp', shard + '.jsonl')
+        np.save(shard + '.idx.tmp.npy', np.array(self._index, dtype=INDEX_DTYPE))
+        os.replace(shard + '.idx.tmp.npy', shard + '.idx.npy')
+
+
+class ArrayShard:
+    """
+    Read access to an array shard: `shard[i]` is (image, text, metadata), the image a read-only view of the
+    memory-mapped pixels.
+    """
+
+    def __init__(self, shard):
+        """
+        :param shard: Path of the shard without extension (as returned by ArrayShardWriter.close).
+        """
+        self.index = np.load(shard + '.idx.npy')
+        self.pixels = np.memmap(shard + '.bin', dtype=np.uint8, mode='r') if len(self.index) else np.empty(0, np.uint8)
+        with open(shard + '.jsonl', encoding='utf-8') as f:
+            self.records = [json.loads(line) for line in f]
+
+    def __len__(self):
+        return len(self.index)
+
+    def image(self, i):
+        offset, height, width, channels = self.index[i].tolist()
+        return self.pixels[offset:offset + height * width * channels].reshape(height, width, channels)
+
+    def __getitem__(self, i):
+        record = dict(self.records[i])
+        text = record.pop('text')
+        return self.image(i), text, record
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _tar_members(shard_path, buffering=1 << 20):
+    # Reads the ustar headers the writer produces directly: tarfile's generic parsing costs several times the
+    # I/O for samples of a few KB
+    with open(shard_path, 'rb', buffering=buffering) as f:
+        while True:
+            header = f.read(TAR_BLOCK)
+            if len(header) < TAR_BLOCK or not header.strip(b'\0'):
+                return
+            name = header[:100].split(b'\0', 1)[0].decode('utf-8')
+            prefix = header[345:500].split(b'\0', 1)[0].decode('utf-8')
+            size = int(header[124:136].split(b'\0', 1)[0].strip() or b'0', 8)
+            data = f.read(size)
+            f.seek(-size % TAR_BLOCK, os.SEEK_CUR)
+            if header[156:157] in (b'0', b'\0'):  # Regular files only
+                yield f"{prefix}/{name}" if prefix else name, data
+
+
+def iter_tar_samples(shard_paths):
+    """
+    Stream the samples of tar shards in order, reading each shard sequentially.
+
+    :param shard_paths: Paths of .tar shards.
+    :return: Generator of (key, JPEG bytes, text, metadata).
+    """
+    for shard_path in shard_paths:
+        sample_key, members = None, {}
+        for name, data in _tar_members(shard_path):
+            key, extension = name.rsplit('.', 1)
+            if key != sample_key and members:
+                yield _tar_sample(sample_key, members)
+                members = {}
+            sample_key = key
+            members[extension] = data
+        if members:
+            yield _tar_sample(sample_key, members)
+
+
+def _tar_sample(key, members):
+    metadata = json.loads(members['json']) if 'json' in members else {}
+    return key, members['jpg'], members.get('txt', b'').decode('utf-8'), metadata
+
+
+WRITERS = {
+    'tar': TarShardWriter,
+    'array': ArrayShardWriter,
+}
+
+
+def make_writer(name, directory, **options):
+    """
+    Create a shard writer by name.
+
+    :param name: One of WRITERS: 'tar' or 'array'.
+    :param directory: Directory the shards are written to.
+    :param options: Keyword arguments of the writer's class.
+    """
+    if name not in WRITERS:
+        raise ValueError(f"Unknown shard format {name!r}, expected one of {', '.join(WRITERS)}")
+    return WRITERS[name](directory, **options)
@@ -0,0 +1,156 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from loguru import logger
+
+from common.tile_store import tile_name
+
+# File name suffix of each map layer
+LAYER_SUFFIXES = {'satellite': '_s.jpg', 'road': '_r.png'}
+
+
+class TileCache:
+    """
+    Process-wide, size-bounded tile cache shared by every AOI, keyed by (layer, zoom, x, y).
+
+    Each tile is stored once at `<root>/<layer>/<zoom>_<x>_<y><suffix>`, however many AOIs cover it. Entries
+    are evicted least recently used first once the cache grows past `max_bytes`; tiles pinned by an AOI that
+    is still being processed are never evicted. Concurrent requests for a tile that is being downloaded wait
+    for that one download instead of fetching it again.
+    """
+
+    def __init__(self, root, max_bytes=20 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.failed = 0
+        self.evicted = 0
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._in_flight = {}  # path -> Event set when its download finishes
+        self._pins = Counter()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Index tiles left by earlier runs, oldest modification time first."""
+        entries = []
+        for layer in LAYER_SUFFIXES:
+            directory = os.path.join(self.root, layer)
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._entries[path] = size
+            self.size += size
+        if entries:
+            logger.info(f"Tile cache {self.root}: {len(entries)} tiles, {self.size / 1e6:.1f} MB")
+
+    def path(self, layer, zoom, x, y):
+        return os.path.join(self.root, layer, tile_name(zoom, x, y, LAYER_SUFFIXES[layer]))
+
+    def pin(self, paths):
+        """Protect tiles from eviction until they are unpinned (pins are counted per caller)."""
+        with self._lock:
+            self._pins.update(paths)
+
+    def unpin(self, paths):
+        with self._lock:
+            for path in paths:
+                self._pins[path] -= 1
+                if self._pins[path] <= 0:
+                    del self._pins[path]
+            self._evict_locked()
+
+    def get(self, layer, zoom, x, y, fetch):
+        """
+        Make sure a tile is cached, downloading it with `fetch()` on a miss.
+
+        :param fetch: Callable returning the tile bytes, or None if the download failed.
+        :return: Path of the cached tile, or None if it could not be downloaded.
+        """
+        path = self.path(layer, zoom, x, y)
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return path
+            event = self._in_flight.get(path)
+            owner = event is None
+            if owner:
+                event = self._in_flight[path] = threading.Event()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            # Another AOI is downloading this tile; share its result
+            event.wait()
+            with self._lock:
+                return path if path in self._entries else None
+
+        content = None
+        try:
+            content = fetch()
+            if content is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(content)
+        finally:
+            with self._lock:
+                if content is not None:
+                    self._entries[path] = len(content)
+                    self.size += len(content)
+                    self._evict_locked()
+                else:
+                    self.failed += 1
+                del self._in_flight[path]
+            event.set()
+        return path if content is not None else None
+
+    def _evict_locked(self):
+        excess = self.size - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for path, size in self._entries.items():
+            if excess <= 0:
+                break
+            if path not in self._pins:
+                victims.append(path)
+                excess -= size
+        for path in victims:
+            self.size -= self._entries.pop(path)
+            self.evicted += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def summary(self):
+        requests = self.hits + self.coalesced + self.misses
+        return {
+            'requests': requests,
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'failed': self.failed,
+            'evicted': self.evicted,
+            # Coalesced requests were served without a download of their own, so they count as hits
+            'hit_rate': (self.hits + self.coalesced) / requests if requests else 0.0,
+            'megabytes': self.size / 1e6,
+        }
+
+    def log_summary(self):
+        summary = self.summary()
+        logger.info(f"Tile cache {self.root}: {summary['requests']} requests, {summary['hit_rate']:.1%} hit rate "
+                    f"({summary['hits']} hits, {summary['coalesced']} coalesced, {summary['misses']} downloads, "
+                    f"{summary['failed']} failed), {summary['evicted']} evicted, {summary['megabytes']:.1f} MB cached")
+        return summary
@@ -0,0 +1,109 @@
+"""
+Plans which tiles a set of AOIs needs, from the polygons rather than their bounding boxes.
+
+The polygons are projected to tile units at the target zoom, an STRtree is built over them, and every tile of
+the AOIs' bounding box ranges is queried against it once. Only tiles that intersect at least one polygon make
+it into the plan, so the corners of elongated, diagonal or L-shaped AOIs are never downloaded, and a tile shared
+by several AOIs appears once in the download plan and once per AOI in the tile -> AOI index.
+"""
+import numpy as np
+import shapely
+from loguru import logger
+from shapely import STRtree
+
+from common.coords import TILE_SIZE, bd09_to_pixel
+from common.pyramid import morton_code
+
+
+class TilePlan:
+    """
+    Deduplicated tile download plan for a list of AOI polygons at one zoom level.
+
+    :ivar tiles: Unique (x, y) tiles intersecting any polygon, in Morton order.
+    :ivar aoi_tiles: For each AOI, the (x, y) tiles its polygon intersects.
+    :ivar tile_aois: Inverted index (x, y) -> indices of the AOIs whose polygon intersects that tile.
+    :ivar bbox_tiles: Tiles the AOIs' bounding boxes cover, counted once per AOI (what used to be downloaded).
+    """
+
+    def __init__(self, zoom, tiles, aoi_tiles, tile_aois, bbox_tiles):
+        self.zoom = zoom
+        self.tiles = tiles
+        self.aoi_tiles = aoi_tiles
+        self.tile_aois = tile_aois
+        self.bbox_tiles = bbox_tiles
+
+    def summary(self):
+        per_aoi = sum(len(tiles) for tiles in self.aoi_tiles)
+        return {
+            'aois': len(self.aoi_tiles),
+            'tiles': len(self.tiles),
+            'aoi_tiles': per_aoi,
+            'bbox_tiles': self.bbox_tiles,
+            # Share of the bounding box tiles that no longer need to be fetched
+            'saved': 1 - len(self.tiles) / self.bbox_tiles if self.bbox_tiles else 0.0,
+        }
+
+    def log_summary(self, name='plan'):
+        summary = self.summary()
+        logger.info(f"{name}: {summary['aois']} AOIs need {summary['tiles']} unique tiles at zoom {self.zoom} "
+                    f"({summary['aoi_tiles']} AOI-tile pairs, {summary['bbox_tiles']} bounding box tiles, "
+                    f"{summary['saved']:.1%} fewer)")
+        return summary
+
+
+def project_to_tiles(polygons, zoom):
+    """Project BD09 lon/lat geometries to tile coordinates (one unit per tile, y growing northwards)."""
+
+    def project(coords):
+        px, py = bd09_to_pixel(coords[:, 0], coords[:, 1], zoom)
+        return np.column_stack((px, py)) / TILE_SIZE
+
+    return shapely.transform(np.asarray(polygons, dtype=object), project)
+
+
+def plan_tiles(polygons, zoom, margin=1.0):
+    """
+    Compute the exact set of tiles intersecting any of the AOI polygons.
+
+    :param polygons: BD09 lon/lat Polygons or MultiPolygons, one per AOI.
+    :param zoom: Baidu zoom level.
+    :param margin: Pixels by which tiles are grown before the intersection test, so that a polygon ending just
+                   short of a tile edge still gets the pixels the mask may round onto it.
+    :return: TilePlan.
+    """
+    projected = project_to_tiles(polygons, zoom)
+    if len(projected) == 0:
+        return TilePlan(zoom, [], [], {}, 0)
+
+    # Candidate tiles: the same per-AOI ranges download_tiles covers for a bounding box
+    bounds = np.floor(shapely.bounds(projected)).astype(np.int64)
+    widths = bounds[:, 2] - bounds[:, 0] + 1
+    heights = bounds[:, 3] - bounds[:, 1] + 1
+    counts = widths * heights
+    owners = np.repeat(np.arange(len(projected)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    xs = bounds[owners, 0] + offsets // heights[owners]
+    ys = bounds[owners, 1] + offsets % heights[owners]
+    candidates = np.unique(np.column_stack((xs, ys)), axis=0)
+
+    # One query of every candidate tile against the tree of polygons gives all (tile, AOI) pairs at once
+    pad = margin / TILE_SIZE
+    boxes = shapely.box(candidates[:, 0] - pad, candidates[:, 1] - pad,
+                        candidates[:, 0] + 1 + pad, candidates[:, 1] + 1 + pad)
+    tile_index, aoi_index = STRtree(projected).query(boxes, predicate='intersects')
+
+    used = np.unique(tile_index)
+    origin = candidates[used].min(axis=0) if len(used) else np.zeros(2, dtype=np.int64)
+    order = used[np.argsort(morton_code(candidates[used, 0] - origin[0], candidates[used, 1] - origin[1]),
+                            kind='stable')]
+    tiles = [(int(x), int(y)) for x, y in candidates[order]]
+
+    aoi_tiles = [[] for _ in range(len(projected))]
+    tile_aois = {}
+    for tile, aoi in zip(tile_index.tolist(), aoi_index.tolist()):
+        xy = (int(candidates[tile, 0]), int(candidates[tile, 1]))
+        aoi_tiles[aoi].append(xy)
+        tile_aois.setdefault(xy, []).append(aoi)
+    for tiles_of_aoi in aoi_tiles:
+        tiles_of_aoi.sort()
+    return TilePlan(zoom, tiles, aoi_tiles, tile_aois, int(counts.sum()))
@@ -0,0 +1,127 @@
+"""
+Pixel-statistics pre-filter for tiles that are not worth captioning (open water, forest, desert, blank tiles).
+
+Each tile is decoded at a fraction of its size (the JPEG decoder scales by 1/2, 1/4 or 1/8 in the DCT, so a
+64 px decode of a 256 px tile costs a fraction of a full one) and reduced to a few numbers: the share of water-,
+vegetation- and sand-coloured pixels, the share of edge pixels (buildings and roads make many edges), and the
+spread of grey levels. A tile is rejected when one land cover dominates it and it has almost no edges; the
+thresholds are deliberately conservative, since a wrongly rejected tile is lost while a wrongly kept one only costs
+a caption call that the caption keyword filter can still catch.
+"""
+import csv
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from common.tile_store import read_tile
+
+FEATURES = ('brightness', 'contrast', 'edges', 'water', 'vegetation', 'sand')
+
+DEFAULT_THRESHOLDS = {
+    'blank_contrast': 4.0,  # Grey-level standard deviation below which a tile is blank (missing or uniform)
+    'ocean_water': 0.85,  # Share of water pixels from which a tile is open water...
+    'ocean_edges': 0.03,  # ...if at most this share of its pixels are edges
+    'forest_vegetation': 0.85,
+    'forest_edges': 0.08,
+    'desert_sand': 0.85,
+    'desert_edges': 0.03,
+}
+
+
+def tile_features(path, size=64, edge_level=32):
+    """
+    Cheap pixel statistics of a tile.
+
+    :param path: Path of the tile (a file, or a tile in its directory's pack).
+    :param size: Side in pixels of the downsampled decode the statistics are computed on.
+    :param edge_level: Grey-level step between neighbouring pixels above which a pixel counts as an edge.
+    :return: A dict of the FEATURES, each a share in [0, 1] except brightness and contrast (grey levels).
+    """
+    with Image.open(io.BytesIO(read_tile(path))) as image:
+        image.draft('RGB', (size, size))
+        pixels = np.asarray(image.convert('RGB').resize((size, size)), dtype=np.int32)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    grey = (r * 299 + g * 587 + b * 114) // 1000
+    steps = np.abs(np.diff(grey, axis=0))[:, :-1] + np.abs(np.diff(grey, axis=1))[:-1, :]
+    return {
+        'brightness': float(grey.mean()),
+        'contrast': float(grey.std()),
+        'edges': float((steps > edge_level).mean()),
+        # Blue over red marks water, whether clear blue or murky teal
+        'water': float(((b > r + 12) & (b + 12 >= g)).mean()),
+        # Excess green (2g - r - b) marks vegetation, also dark forest
+        'vegetation': float(((2 * g - r - b > 20) & (g > b)).mean()),
+        # Bright tan: red over blue, red at least green
+        'sand': float(((r > b + 20) & (r >= g) & (grey > 110)).mean()),
+    }
+
+
+def classify_tile(features, thresholds=DEFAULT_THRESHOLDS):
+    """
+    :param features: The dict of `tile_features`.
+    :param thresholds: Thresholds as in DEFAULT_THRESHOLDS.
+    :return: 'ocean', 'forest', 'desert' or 'blank' for a tile to reject, None for a tile to caption.
+    """
+    if features['water'] >= thresholds['ocean_water'] and features['edges'] <= thresholds['ocean_edges']:
+        return 'ocean'
+    if features['vegetation'] >= thresholds['forest_vegetation'] and features['edges'] <= thresholds['forest_edges']:
+        return 'forest'
+    if features['sand'] >= thresholds['desert_sand'] and features['edges'] <= thresholds['desert_edges']:
+        return 'desert'
+    # Checked last: calm open water can be as flat as a missing tile
+    if features['contrast'] < thresholds['blank_contrast']:
+        return 'blank'
+    return None
+
+
+def _features_or_none(path):
+    try:
+        return tile_features(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read {path}: {e}")
+        return None
+
+
+def prefilter_tiles(paths, thresholds=DEFAULT_THRESHOLDS, workers=None, chunksize=64):
+    """
+    Compute the features of tiles across a process pool and classify them.
+
+    :param paths: Tile paths.
+    :param thresholds: Thresholds as in DEFAULT_THRESHOLDS.
+    :param workers: Worker processes (defaults to the number of CPUs).
+    :param chunksize: Tiles sent to a worker at a time.
+    :return: Generator of (path, category, features) in the order of `paths`; category is None for tiles to
+             caption, and unreadable tiles are kept with features None.
+    """
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=get_context('spawn')) as pool:
+        for path, features in zip(paths, pool.map(_features_or_none, paths, chunksize=chunksize)):
+            yield path, None if features is None else classify_tile(features, thresholds), features
+
+
+def write_report(csv_path, rows):
+    """
+    Write the pre-filter's decisions as CSV: image, category (empty for tiles to caption) and the features.
+
+    :param rows: Iterable of (image key, category, features).
+    """
+    tmp_path = csv_path + '.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(('image', 'category') + FEATURES)
+        for image, category, features in rows:
+            values = [f"{features[name]:.4f}" for name in FEATURES] if features else [''] * len(FEATURES)
+            writer.writerow([image, category or ''] + values)
+    os.replace(tmp_path, csv_path)
+
+
+def load_rejected(csv_path):
+    """The image keys a pre-filter report rejected, as {image: category}; empty if there is no report."""
+    if not os.path.exists(csv_path):
+        return {}
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return {row['image']: row['category'] for row in csv.DictReader(f) if row['category']}
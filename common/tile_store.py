@@ -0,0 +1,268 @@
+"""
+Pluggable tile storage.
+
+    - DirectoryTileStore: the original layout, one `{zoom}_{x}_{y}_s.jpg` file per tile under a directory.
+    - PackedTileStore: every tile of a directory appended to one `<directory>.pack` container file, with an
+      in-memory (zoom, x, y) -> (offset, length) index rebuilt from the record headers on open. Reads return
+      memoryview slices of an mmap of the file, so no copy is made until the tile is decoded.
+
+Downstream stages keep addressing tiles by their usual paths (e.g. `tiles/Beijing/16_12614_4690_s.jpg`):
+`read_tile` and `list_tile_paths` resolve such paths against `tiles/Beijing.pack` when it exists, and against
+the directory otherwise.
+"""
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+TILE_SUFFIX = '_s.jpg'
+PACK_SUFFIX = '.pack'
+
+# File magic, then one record per tile: header (zoom, x, y, length) followed by the tile bytes
+PACK_MAGIC = b'UCTPACK1'
+RECORD_HEADER = struct.Struct('<HiiI')
+
+
+def tile_name(zoom, x, y, suffix=TILE_SUFFIX):
+    """File name of a tile, e.g. 16_12614_4690_s.jpg."""
+    return f"{zoom}_{x}_{y}{suffix}"
+
+
+def parse_tile_name(name):
+    """Extract (zoom, x, y) from a tile file name."""
+    zoom, x, y, _ = name.split('_')
+    return int(zoom), int(x), int(y)
+
+
+class DirectoryTileStore:
+    """One file per tile under `root`."""
+
+    def __init__(self, root, suffix=TILE_SUFFIX):
+        self.root = root
+        self.suffix = suffix
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.root, tile_name(zoom, x, y, self.suffix))
+
+    def put(self, zoom, x, y, data):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path(zoom, x, y), 'wb') as f:
+            f.write(data)
+
+    def get(self, zoom, x, y):
+        """Tile bytes, or None if the tile is missing."""
+        try:
+            with open(self.path(zoom, x, y), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def has(self, zoom, x, y):
+        return os.path.exists(self.path(zoom, x, y))
+
+    def size(self, zoom, x, y):
+        return os.path.getsize(self.path(zoom, x, y))
+
+    def keys(self):
+        """(zoom, x, y) of every tile in the directory."""
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.suffix) and entry.name.count('_') == 3:
+                    yield parse_tile_name(entry.name)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PackedTileStore:
+    """
+    Append-only container of tiles with an (zoom, x, y) -> (offset, length) index.
+
+    Writing a tile that already exists appends a new record that supersedes the old one. A record cut short
+    by a crash is ignored (and overwritten) the next time the file is opened.
+    """
+
+    def __init__(self, path, suffix=TILE_SUFFIX, readonly=False):
+        self.path = path
+        self.suffix = suffix
+        self.readonly = readonly
+        self.index = {}
+        self._lock = threading.Lock()
+        self._mmap = None
+        if readonly:
+            # Readers never truncate, so they can open a pack while another process appends to it
+            self._file = open(path, 'rb')
+            self._end = self._load_index(len(PACK_MAGIC))
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.write(PACK_MAGIC)
+            self._file.flush()
+        self._end = self._load_index(len(PACK_MAGIC))
+        # Drop a partially written trailing record so new records start on a record boundary
+        self._file.truncate(self._end)
+
+    def _load_index(self, offset):
+        """
+        Add the records from `offset` onwards to the index by walking their headers.
+
+        :return: Offset after the last complete record.
+        """
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f"{self.path} is not a tile pack")
+            if size <= offset:
+                return offset
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while offset + RECORD_HEADER.size <= size:
+                    zoom, x, y, length = RECORD_HEADER.unpack_from(data, offset)
+                    start = offset + RECORD_HEADER.size
+                    if start + length > size:
+                        break
+                    self.index[(zoom, x, y)] = (start, length)
+                    offset = start + length
+        return offset
+
+    def _view(self, start, length):
+        if self._mmap is None or start + length > len(self._mmap):
+            # The file has grown since it was mapped. The old map is not closed: views handed out by get() may
+            # still reference it, and it is released once they are gone
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)[start:start + length]
+
+    def put(self, zoom, x, y, data):
+        with self._lock:
+            self._file.seek(self._end)
+            self._file.write(RECORD_HEADER.pack(zoom, x, y, len(data)))
+            self._file.write(data)
+            start = self._end + RECORD_HEADER.size
+            self.index[(zoom, x, y)] = (start, len(data))
+            self._end = start + len(data)
+
+    def get(self, zoom, x, y):
+        """Tile bytes as a zero-copy memoryview, or None if the tile is missing."""
+        with self._lock:
+            entry = self.index.get((zoom, x, y))
+            if entry is None and self.readonly:
+                # Another process may have appended the tile since the index was built
+                self._end = self._load_index(self._end)
+                entry = self.index.get((zoom, x, y))
+            if entry is None:
+                return None
+            return self._view(*entry)
+
+    def has(self, zoom, x, y):
+        return (zoom, x, y) in self.index
+
+    def size(self, zoom, x, y):
+        return self.index[(zoom, x, y)][1]
+
+    def keys(self):
+        with self._lock:
+            if self.readonly:
+                self._end = self._load_index(self._end)
+            return list(self.index)
+
+    def flush(self):
+        """Write buffered records through to disk."""
+        if self.readonly:
+            return
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        with self._lock:
+            self._file.close()
+            # Views handed out by get() may still reference the map; it is released once they are gone
+            self._mmap = None
+
+
+def open_tile_store(directory, suffix=TILE_SUFFIX, packed=None, readonly=False):
+    """
+    Open the tile store for a directory of tiles.
+
+    :param directory: Tile directory, e.g. tiles/Beijing; its packed form is tiles/Beijing.pack.
+    :param suffix: Tile file name suffix.
+    :param packed: True/False to force a backend; None picks the pack if it exists.
+    :param readonly: Open a pack for reading only (it must already exist).
+    """
+    if packed is None:
+        packed = os.path.exists(directory + PACK_SUFFIX)
+    if packed:
+        return PackedTileStore(directory + PACK_SUFFIX, suffix, readonly)
+    return DirectoryTileStore(directory, suffix)
+
+
+# Open stores by (directory, suffix, readonly), least recently used first. Read-only stores beyond
+# MAX_OPEN_STORES are closed, so a process reading many packs (e.g. one per AOI) does not keep every pack's
+# file and map open; writable stores stay open until close_tile_store
+MAX_OPEN_STORES = 32
+_stores = OrderedDict()
+_stores_lock = threading.Lock()
+
+
+def get_tile_store(directory, suffix=TILE_SUFFIX, packed=None, readonly=False):
+    """
+    Shared store for a directory of tiles, opened once per process.
+
+    Writers and readers in the same process should use this instead of `open_tile_store`, so tiles written
+    to a pack are immediately visible to `read_tile` through the same index: a read-only request returns the
+    writable store when one is open. A store first opened read-only is reopened for writing when a writer
+    asks for it.
+    """
+    with _stores_lock:
+        writable_key, readonly_key = (directory, suffix, False), (directory, suffix, True)
+        if readonly and writable_key in _stores:
+            key = writable_key
+        else:
+            key = readonly_key if readonly else writable_key
+            if not readonly and readonly_key in _stores:
+                _stores.pop(readonly_key).close()
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = open_tile_store(directory, suffix, packed, readonly)
+            readonly_keys = [k for k in _stores if k[2]]
+            for k in readonly_keys[:max(0, len(readonly_keys) - MAX_OPEN_STORES)]:
+                _stores.pop(k).close()
+        _stores.move_to_end(key)
+        return store
+
+
+def close_tile_store(directory):
+    """Close the shared stores of a directory (e.g. once an AOI is done); they are reopened on the next use."""
+    with _stores_lock:
+        for key in [key for key in _stores if key[0] == directory]:
+            _stores.pop(key).close()
+
+
+def list_tile_paths(directory, suffix=TILE_SUFFIX):
+    """Paths of all tiles of a directory, whether they are stored as files or in its pack."""
+    store = get_tile_store(directory, suffix, readonly=True)
+    return [os.path.join(directory, tile_name(zoom, x, y, suffix)) for zoom, x, y in store.keys()]
+
+
+def read_tile(path):
+    """Bytes of the tile at `path`, read from its directory's pack if there is one, else from the file."""
+    directory, name = os.path.split(path)
+    store = get_tile_store(directory, name[name.rindex('_'):], readonly=True)
+    if isinstance(store, PackedTileStore):
+        data = store.get(*parse_tile_name(name))
+        if data is None:
+            raise FileNotFoundError(f"{name} not found in {store.path}")
+        return data
+    with open(path, 'rb') as f:
+        return f.read()
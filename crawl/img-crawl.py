@@ -1,11 +1,17 @@
+import asyncio
 import os
-import random
-import time
+import sys
 from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from loguru import logger
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.coords import bd09_to_pixel
+from common.downloader import TileDownloader
+from common.manifest import CrawlManifest
+from common.pyramid import build_pyramid
+from common.tile_store import open_tile_store
+
 """
 Define three main coordinate systems
     - WGS84: The coordinate system used by the GPS global satellite positioning system.
@@ -13,36 +19,22 @@ Define three main coordinate systems
     - BD09: The coordinate system used by Baidu Maps.
 """
 
-# Access key for Baidu Maps
-# Configuration viewable at: https://lbsyun.baidu.com/apiconsole/center#/home
-ak = 'Replace with your own Baidu ak'
-
-
 # Convert latitude and longitude to Baidu map coordinates
+# Computed locally with the same projection as the geoconv API (from=5, to=6), so no Baidu ak is needed
 def bd_latlng2xy(zoom, latitude, longitude):
-    url = "https://api.map.baidu.com/geoconv/v1/"
-    # For detailed parameters, refer to https://lbs.baidu.com/faq/api?title=webapi/guide/changeposition-base
-    params = {
-        "coords": str(longitude) + ',' + str(latitude),
-        "from": "5",
-        "to": "6",
-        "ak": ak,
-    }
-    response = requests.get(url=url, params=params)
-    result = response.json()
-    logger.info(f'result: {result}')
-    loc = result["result"][0]
-    res = 2 ** (18 - zoom)  # Calculate the scaling factor
-    x = loc['x'] / res
-    y = loc['y'] / res
+    x, y = bd09_to_pixel(longitude, latitude, zoom)
     return x, y
 
 
 # Download map tiles
-def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, longitude_stop, satellite=True):
-    # Create a save directory with a separate subdirectory for each city
+# backend is 'thread' (ThreadPoolExecutor over a pooled requests session) or 'asyncio' (aiohttp, bounded queue)
+# With a manifest, only tiles that are missing or failed and due for retry are scheduled
+# With packed=True the tiles are appended to a single tiles/<city>.pack file instead of one file per tile
+def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, longitude_stop, satellite=True,
+                   backend='thread', manifest=None, packed=False):
+    # Create a save directory (or pack) with a separate subdirectory for each city
     root_save = os.path.join("tiles", city)
-    os.makedirs(root_save, exist_ok=True)
+    store = open_tile_store(root_save, '_s.jpg' if satellite else '_r.png', packed)
 
     # Perform coordinate conversion
     start_x, start_y = bd_latlng2xy(zoom, latitude_start, longitude_start)
@@ -61,19 +53,72 @@ def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, l
     logger.info(f'x range: {start_x} to {stop_x}')
     logger.info(f'y range: {start_y} to {stop_y}')
 
-    # Loop to download each tile, using a thread pool of custom size, e.g., max_workers=666
-    with ThreadPoolExecutor(max_workers=666) as executor:
+    if manifest is not None:
+        # Tiles downloaded before the manifest existed are imported once from the store's listing
+        if not manifest.has_tiles(city, zoom):
+            logger.info(f"Imported {manifest.import_existing(city, zoom, store)} existing tiles")
+        tiles, done, waiting = manifest.pending(city, zoom, start_x, stop_x, start_y, stop_y)
+        pending = (stop_x - start_x) * (stop_y - start_y) - done - waiting
+        logger.info(f"{pending} tiles to download, {done} already done, {waiting} failed tiles backing off")
+    else:
+        tiles = ((x, y) for x in range(start_x, stop_x) for y in range(start_y, stop_y))
+
+    if backend == 'asyncio':
+        download_tiles_async(city, zoom, tiles, satellite, store, manifest)
+        store.close()
+        return
+
+    # Loop to download each tile over one pooled session, e.g., max_workers=666
+    # The downloader adapts the number of in-flight requests to the server's latency and 429/5xx responses
+    downloader = TileDownloader(max_workers=666)
+    with ThreadPoolExecutor(max_workers=downloader.max_workers) as executor:
         futures = []
-        for x in range(start_x, stop_x):
-            for y in range(start_y, stop_y):
-                futures.append(executor.submit(download_tile, x, y, zoom, satellite, root_save))
+        for x, y in tiles:
+            futures.append(executor.submit(download_tile, x, y, zoom, satellite, store, downloader,
+                                           city, manifest))
         # Wait for all threads to complete
         for future in futures:
             future.result()
-
-
-# Download an individual map tile
-def download_tile(x, y, zoom, satellite, root_save):
+    downloader.log_summary(city)
+    downloader.close()
+    store.close()
+    if manifest is not None:
+        manifest.flush()
+
+
+# Download map tiles with the asyncio backend
+# Tile coordinates are generated lazily and streamed through a bounded queue, so memory stays flat
+def download_tiles_async(city, zoom, tiles, satellite, store, manifest=None, concurrency=10000):
+    # Imported here so aiohttp is only required when this backend is selected
+    from common.async_downloader import AsyncTileDownloader
+
+    def jobs():
+        for x, y in tiles:
+            # Without a manifest, fall back to skipping tiles that are already stored
+            if manifest is None and store.has(zoom, x, y):
+                continue
+            url, _ = tile_url(x, y, zoom, satellite)
+            yield url, None, x, y
+
+    # Runs in a worker thread after each tile, so storing never blocks the event loop
+    def on_done(job, content):
+        _, _, x, y = job
+        if content is not None:
+            store.put(zoom, x, y, content)
+            if manifest is not None:
+                manifest.record_success(city, zoom, x, y, content)
+        elif manifest is not None:
+            manifest.record_failure(city, zoom, x, y)
+
+    downloader = AsyncTileDownloader(concurrency=concurrency)
+    asyncio.run(downloader.run(jobs(), on_done=on_done, skip_existing=False))
+    if manifest is not None:
+        manifest.flush()
+    downloader.log_summary(city)
+
+
+# Build the URL and file name of an individual map tile
+def tile_url(x, y, zoom, satellite):
     if satellite:
         # Satellite imagery URL
         url = f"http://shangetu0.map.bdimg.com/it/u=x={x};y={y};z={zoom};v=009;type=sate&fm=46&udt=20150504&app=webearth2&v=009&udt=20150601"
@@ -82,22 +127,29 @@ def download_tile(x, y, zoom, satellite, root_save):
         # Road map image URL
         url = f'http://online3.map.bdimg.com/tile/?qt=tile&x={x}&y={y}&z={zoom}&styles=pl&scaler=1&udt=20180810'
         filename = f"{zoom}_{x}_{y}_r.png"
+    return url, filename
 
-    filename = os.path.join(root_save, filename)
 
-    # Check if the file exists, download if it doesn't
-    if not os.path.exists(filename):
-        try:
-            logger.info(f'downloading filename: {filename}')
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
+# Download an individual map tile
+def download_tile(x, y, zoom, satellite, store, downloader, city=None, manifest=None):
+    url, filename = tile_url(x, y, zoom, satellite)
+
+    # With a manifest the tile was already scheduled from it, so download and record the outcome
+    if manifest is not None:
+        logger.info(f'downloading filename: {filename}')
+        content = downloader.fetch(url)
+        if content is not None:
+            store.put(zoom, x, y, content)
+            manifest.record_success(city, zoom, x, y, content)
+        else:
+            manifest.record_failure(city, zoom, x, y)
+    # Check if the tile exists, download if it doesn't
+    elif not store.has(zoom, x, y):
+        logger.info(f'downloading filename: {filename}')
+        content = downloader.fetch(url)
+        if content is not None:
             logger.info(f"-- saving {filename}")
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-            time.sleep(random.random())  # Random sleep to reduce server load
-        except requests.RequestException as e:
-            logger.info(f"-- {filename} -> {e}")
+            store.put(zoom, x, y, content)
     else:
         logger.info(f"File already exists: {filename}")
 
@@ -115,13 +167,24 @@ def main():
 
     zoom = 16  # Coarse zoom level
     # zoom = 19  # Fine zoom level
+    # Coarsest zoom level to derive locally from the downloaded `zoom` level by 2x2 downsampling, e.g. 16 with
+    # zoom = 19 downloads only zoom 19 and builds 18, 17 and 16 from it (None downloads `zoom` only)
+    min_zoom = None
     satellite = True  # Satellite image (if False, download road images)
+    backend = 'thread'  # Download backend: 'thread' or 'asyncio' (for very large crawls, requires aiohttp)
+    packed = False  # Store each city's tiles in one tiles/<city>.pack file instead of one file per tile
+    # Records every tile's status so a restart only schedules missing or failed tiles
+    manifest = CrawlManifest(os.path.join("tiles", "manifest.sqlite"))
 
     # Loop through the cities and download the corresponding satellite images
     for city, coordinates in cities.items():
         logger.info(f"Downloading tiles for {city}...")
         lat_start, lat_stop, lon_start, lon_stop = coordinates
-        download_tiles(city, zoom, lat_start, lat_stop, lon_start, lon_stop, satellite)
+        download_tiles(city, zoom, lat_start, lat_stop, lon_start, lon_stop, satellite, backend, manifest, packed)
+        if min_zoom is not None and min_zoom < zoom:
+            logger.info(f"Building zoom levels {zoom - 1} to {min_zoom} for {city}...")
+            build_pyramid(os.path.join("tiles", city), zoom, min_zoom, '_s.jpg' if satellite else '_r.png', packed)
+    manifest.close()
 
 
 if __name__ == "__main__":
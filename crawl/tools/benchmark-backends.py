@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.async_downloader import AsyncTileDownloader
+from common.downloader import TileDownloader
+
+# Benchmark parameters
+host, port = '127.0.0.1', 8766
+tile_count = 20000  # Number of tiles each backend downloads
+tile_size = 20000  # Bytes per stub tile, roughly a zoom 16 satellite JPEG
+server_latency = 0.05  # Seconds the stub server waits before answering, to mimic a remote tile server
+thread_workers = 666
+async_concurrency = 4000  # Client and stub server share this process's open-file limit
+
+
+def start_stub_tile_server():
+    """Serve fake tiles at /tile/{zoom}/{x}/{y} from a background thread."""
+    payload = os.urandom(tile_size)
+
+    async def handle(request):
+        await asyncio.sleep(server_latency)
+        return web.Response(body=payload, content_type='image/jpeg')
+
+    app = web.Application()
+    app.router.add_get('/tile/{zoom}/{x}/{y}', handle)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port, backlog=4096).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+def tile_jobs(root_save):
+    for i in range(tile_count):
+        x, y = divmod(i, 1000)
+        yield f"http://{host}:{port}/tile/16/{x}/{y}", os.path.join(root_save, f"16_{x}_{y}_s.jpg")
+
+
+def run_thread_backend(root_save):
+    downloader = TileDownloader(max_workers=thread_workers)
+
+    def download(job):
+        url, filename = job
+        content = downloader.fetch(url)
+        if content is not None:
+            with open(filename, 'wb') as f:
+                f.write(content)
+
+    with ThreadPoolExecutor(max_workers=downloader.max_workers) as executor:
+        list(executor.map(download, tile_jobs(root_save)))
+    downloader.close()
+    return downloader.log_summary('thread')
+
+
+def run_asyncio_backend(root_save):
+    downloader = AsyncTileDownloader(concurrency=async_concurrency)
+    asyncio.run(downloader.run(tile_jobs(root_save)))
+    return downloader.log_summary('asyncio')
+
+
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, level="INFO", filter=lambda record: record["function"] == "log_summary")
+    start_stub_tile_server()
+    time.sleep(0.5)
+
+    results = {}
+    for name, backend in [('thread', run_thread_backend), ('asyncio', run_asyncio_backend)]:
+        with tempfile.TemporaryDirectory() as root_save:
+            results[name] = backend(root_save)
+
+    for name, summary in results.items():
+        print(f"{name:>8}: {summary['tiles']} tiles, {summary['tiles_per_second']:.0f} tiles/s, "
+              f"p50 {summary['latency_p50'] * 1000:.0f} ms, p95 {summary['latency_p95'] * 1000:.0f} ms")
@@ -0,0 +1,46 @@
+import os
+import sys
+
+from loguru import logger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.tile_store import DirectoryTileStore, PACK_SUFFIX, PackedTileStore
+
+# Migration parameters
+base_directory = '../tiles'
+cities = ['Beijing', 'Guangzhou', 'Shanghai', 'Shenzhen']
+suffix = '_s.jpg'
+remove_files = False  # Delete the tile files once they are safely in the pack
+
+
+def pack_directory(directory, suffix, remove_files=False):
+    """
+    Copy every tile file of a directory into <directory>.pack.
+
+    Tiles already in the pack are skipped, so an interrupted migration can simply be rerun.
+
+    :return: Number of tiles added to the pack.
+    """
+    source = DirectoryTileStore(directory, suffix)
+    pack = PackedTileStore(directory + PACK_SUFFIX, suffix)
+    added = 0
+    for zoom, x, y in source.keys():
+        if not pack.has(zoom, x, y):
+            pack.put(zoom, x, y, source.get(zoom, x, y))
+            added += 1
+    pack.flush()
+
+    if remove_files:
+        for zoom, x, y in list(source.keys()):
+            if pack.has(zoom, x, y):
+                os.remove(source.path(zoom, x, y))
+    logger.info(f"{directory}: {added} tiles added, {len(pack.index)} tiles in {pack.path}")
+    pack.close()
+    return added
+
+
+if __name__ == "__main__":
+    for city in cities:
+        directory = os.path.join(base_directory, city)
+        if os.path.isdir(directory):
+            pack_directory(directory, suffix, remove_files)
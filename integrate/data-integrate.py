@@ -1,46 +1,49 @@
 import csv
 import os
+import sys
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-import rasterio
-import requests
+import numpy as np
 from loguru import logger
-from pyproj import Transformer
+
+from raster_sampler import RasterSampler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.coords import bd09mc_to_bd09, tile_to_bd09mc
+from common.tile_store import PACK_SUFFIX, open_tile_store, tile_name
 
 # Configuration parameters
-ak = 'Replace with your own Baidu ak'
 carbon_emissions_tif_path = "/Users/zhongsiru/project/src/dataset/odiac/2021/odiac2022_1km_excl_intl_2112.tif"
 worldtop_population_tif_path = "/Users/zhongsiru/project/src/dataset/worldtop/chn_ppp_2020_1km_Aggregated.tif"
 gpp_tif_path = "/Users/zhongsiru/project/src/dataset/gdp/2010/cngdp2010.tif"
 zoom = 16
 root_folder = "/Users/zhongsiru/project/src/dataset/satellite/baidu_satellite_extended"
 csv_filename = "/Users/zhongsiru/project/src/dataset/satellite/baidu_satellite_extended/integrated_satellite_data.csv"
+bulk_mode = True  # Integrate all new tiles in one vectorized pass instead of per-tile batches
+zonal_mode = False  # Also compute area-weighted statistics over each tile's full footprint
+zonal_csv_filename = "/Users/zhongsiru/project/src/dataset/satellite/baidu_satellite_extended/integrated_satellite_zonal_data.csv"
 
 
 def bd_xy2latlng(zoom, x, y):
-    """Convert BD09 pixel coordinates to WGS84 lat/lng for a given zoom level."""
-    res = 2 ** (18 - zoom)
-    bd_x = x * 256 * res
-    bd_y = y * 256 * res
-
-    params = {
-        "coords": f"{bd_x},{bd_y}",
-        "from": "6",  # BD09
-        "to": "5",  # WGS84
-        "ak": ak
-    }
-    response = requests.get(url="https://api.map.baidu.com/geoconv/v1/", params=params)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    loc = response.json()["result"][0]
-    return loc['y'], loc['x']  # latitude, longitude
+    """Convert BD09 tile coordinates to lat/lng for a given zoom level, matching geoconv from=6, to=5.
+
+    Accepts scalars or NumPy arrays, so a whole column of tiles converts in one call.
+    """
+    bd_x, bd_y = tile_to_bd09mc(x, y, zoom)
+    lng, lat = bd09mc_to_bd09(bd_x, bd_y)
+    return lat, lng  # latitude, longitude
+
+
+@lru_cache(maxsize=None)
+def get_raster_sampler(tif_path):
+    """Open each raster once and reuse its sampler for every lookup."""
+    return RasterSampler(tif_path)
 
 
 def read_raster_value_at_coordinate(tif_path, lat, lon):
     """Retrieve raster value for a specific point using its lat, lon."""
-    with rasterio.open(tif_path) as src:
-        row, col = src.index(lon, lat)
-        data = src.read(1)
-        return data[row, col]
+    return get_raster_sampler(tif_path).sample_point(lat, lon)
 
 
 def get_point_carbon_emission(lat, lon):
@@ -54,15 +57,8 @@ def get_point_population(lat, lon):
 
 
 def get_point_gdp(lat, lon):
-    """Retrieve GDP value for a specific point."""
-    with rasterio.open(gpp_tif_path) as src:
-        transformer = Transformer.from_crs("EPSG:4326", src.crs, always_xy=True)
-        x_transformed, y_transformed = transformer.transform(lon, lat)
-        row, col = src.index(x_transformed, y_transformed)
-        if 0 <= row < src.height and 0 <= col < src.width:
-            gdp_value = src.read(1)[row, col]
-            return max(0, gdp_value)
-        return 0
+    """Retrieve GDP value for a specific point (0 outside the raster)."""
+    return max(0, read_raster_value_at_coordinate(gpp_tif_path, lat, lon))
 
 
 def extract_coordinates_from_filename(filename):
@@ -81,10 +77,16 @@ def get_processed_images(csv_filename):
 
 
 def get_all_images(root_folder):
-    """Retrieve all image names from the directory."""
+    """Retrieve all image names from the directory, including tiles stored in <city>.pack files."""
     all_images = set()
     for city_folder in os.listdir(root_folder):
         city_path = os.path.join(root_folder, city_folder)
+        if city_folder.endswith(PACK_SUFFIX):
+            city_folder = city_folder[:-len(PACK_SUFFIX)]
+            store = open_tile_store(os.path.join(root_folder, city_folder), packed=True, readonly=True)
+            all_images.update(f"{city_folder}/{tile_name(*key)}" for key in store.keys())
+            store.close()
+            continue
         if not os.path.isdir(city_path):
             continue
         for image_file in os.listdir(city_path):
@@ -154,6 +156,88 @@ def update_csv_with_changes(root_folder, csv_filename, batch_size=20):
         logger.info(f"Finished processing batch {batch_num + 1}/{num_batches}")
 
 
+def update_csv_bulk(root_folder, csv_filename):
+    """Integrate every new tile in one vectorized pass: parse, convert, sample and write as whole arrays."""
+    initialize_csv_file(csv_filename)
+
+    processed_images = get_processed_images(csv_filename)
+    new_images = sorted(get_all_images(root_folder) - processed_images)
+    if not new_images:
+        logger.info("No new images to process")
+        return
+
+    logger.info(f"Processing {len(new_images)} new images in bulk mode")
+    coordinates = np.array([extract_coordinates_from_filename(image_key.split("/")[1]) for image_key in new_images],
+                           dtype=np.int64)
+    xs, ys = coordinates[:, 0], coordinates[:, 1]
+    lats, lons = bd_xy2latlng(zoom, xs, ys)
+
+    emission_values = get_raster_sampler(carbon_emissions_tif_path).sample(lats, lons)
+    # Same rounding and clipping as get_point_population, applied to the whole column
+    populations = np.maximum(0, np.round(get_raster_sampler(worldtop_population_tif_path).sample(lats, lons)))
+    gdps = get_raster_sampler(gpp_tif_path).sample(lats, lons)
+
+    # Append the whole result table to the CSV in one go
+    with open(csv_filename, 'a', newline='') as csvfile:
+        csv.writer(csvfile).writerows(
+            # GDP is clipped per value as in get_point_gdp, so a clipped cell is written as 0, not 0.0
+            (image_key, f"({x},{y})", f"({lat}, {lon})", emission_value, int(population), max(0, gdp))
+            for image_key, x, y, lat, lon, emission_value, population, gdp in zip(
+                new_images, xs.tolist(), ys.tolist(), lats.tolist(), lons.tolist(),
+                emission_values, populations, gdps))
+
+    logger.info(f"Finished processing {len(new_images)} images")
+
+
+def update_zonal_csv(root_folder, zonal_csv_filename):
+    """
+    Compute area-weighted sum/mean/max of carbon, population and GDP over each tile's full footprint,
+    from its lower-left (x, y) to its upper-right (x + 1, y + 1) corner, for all tiles at once.
+    """
+    processed_images = get_processed_images(zonal_csv_filename)
+    new_images = sorted(get_all_images(root_folder) - processed_images)
+    if not new_images:
+        logger.info("No new images to process for zonal statistics")
+        return
+
+    logger.info(f"Computing zonal statistics for {len(new_images)} new images")
+    coordinates = np.array([extract_coordinates_from_filename(image_key.split("/")[1]) for image_key in new_images],
+                           dtype=np.int64)
+    xs, ys = coordinates[:, 0], coordinates[:, 1]
+    lat_min, lon_min = bd_xy2latlng(zoom, xs, ys)
+    lat_max, lon_max = bd_xy2latlng(zoom, xs + 1, ys + 1)
+
+    rasters = [('carbon_emissions (ton)', carbon_emissions_tif_path, False),
+               ('population (unit)', worldtop_population_tif_path, True),
+               ('gdp (million yuan)', gpp_tif_path, True)]
+    fieldnames = ['satellite_img_name', 'BD09 coordinate', 'Lower-Left coordinate', 'Upper-Right coordinate']
+    columns = []
+    for name, tif_path, clip_negative in rasters:
+        stats = get_raster_sampler(tif_path).zonal_stats(lat_min, lon_min, lat_max, lon_max,
+                                                         clip_negative=clip_negative)
+        for stat in ('sum', 'mean', 'max'):
+            fieldnames.append(f"{name} {stat}")
+            columns.append(stats[stat].tolist())
+
+    write_header = not os.path.exists(zonal_csv_filename)
+    with open(zonal_csv_filename, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if write_header:
+            writer.writerow(fieldnames)
+        writer.writerows(
+            (image_key, f"({x},{y})", f"({lat_lo}, {lon_lo})", f"({lat_hi}, {lon_hi})", *values)
+            for image_key, x, y, lat_lo, lon_lo, lat_hi, lon_hi, *values in zip(
+                new_images, xs.tolist(), ys.tolist(), lat_min.tolist(), lon_min.tolist(),
+                lat_max.tolist(), lon_max.tolist(), *columns))
+
+    logger.info(f"Finished zonal statistics for {len(new_images)} images")
+
+
 if __name__ == "__main__":
     logger.info("Starting data extraction...")
-    update_csv_with_changes(root_folder, csv_filename)
+    if bulk_mode:
+        update_csv_bulk(root_folder, csv_filename)
+    else:
+        update_csv_with_changes(root_folder, csv_filename)
+    if zonal_mode:
+        update_zonal_csv(root_folder, zonal_csv_filename)
@@ -1,39 +1,31 @@
+import os
+import sys
+
 import pandas as pd
-import requests
 from loguru import logger
 
-# Replace with your Baidu Map API key (ak)
-ak = '1ZtwxRT5sUDd6jaj0c7sCpjy9zXTl10O'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.coords import bd09mc_to_bd09, tile_to_bd09mc
 
 
-# Convert Baidu map coordinates to latitude and longitude
+# Convert Baidu map coordinates to latitude and longitude (same result as geoconv from=6, to=5)
+# Works on scalars or whole NumPy columns
 def bd_xy2latlng(zoom, x, y):
-    res = 2 ** (18 - zoom)
-    bd_x = x * 256 * res
-    bd_y = y * 256 * res
-
-    params = {
-        "coords": f"{bd_x},{bd_y}",
-        "from": "6",  # BD09
-        "to": "5",  # WGS84
-        "ak": ak
-    }
-    response = requests.get(url="https://api.map.baidu.com/geoconv/v1/", params=params)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    loc = response.json()["result"][0]
-    return loc['y'], loc['x']  # latitude, longitude
+    bd_x, bd_y = tile_to_bd09mc(x, y, zoom)
+    lng, lat = bd09mc_to_bd09(bd_x, bd_y)
+    return lat, lng  # latitude, longitude
 
 
-# Function to calculate upper-right coordinates and add them to the DataFrame
-def calculate_and_add_upper_right(row):
-    lower_left_bd09_coord = tuple(map(int, row['BD09 coordinate'][1:-1].split(',')))  # Convert to tuple
-    upper_right_bd09_coord = lower_left_bd09_coord[0] + 1, lower_left_bd09_coord[1] + 1
+# Function to calculate upper-right coordinates for a whole DataFrame in one vectorized call
+def calculate_upper_right(df):
+    lower_left_bd09_coord = df['BD09 coordinate'].str[1:-1].str.split(',', expand=True).astype(int)
+    upper_right_x = lower_left_bd09_coord[0].to_numpy() + 1
+    upper_right_y = lower_left_bd09_coord[1].to_numpy() + 1
     zoom_level = 16  # Zoom level 16
-    return bd_xy2latlng(zoom_level, upper_right_bd09_coord[0], upper_right_bd09_coord[1])
+    lat, lng = bd_xy2latlng(zoom_level, upper_right_x, upper_right_y)
+    return [(float(a), float(b)) for a, b in zip(lat, lng)]
 
 
-# Define a threshold for updating the CSV file
-update_threshold = 10  # Update the CSV file every 10 rows
 if __name__ == '__main__':
     # Load the CSV file into a pandas DataFrame
     df = pd.read_csv('integrated_satellite_data.csv')
@@ -44,37 +36,27 @@ if __name__ == '__main__':
     except FileNotFoundError:
         temp_df = pd.DataFrame()  # Create an empty DataFrame if the file doesn't exist
 
-    # Create an empty list to store processed data rows
-    processed_rows = []
-
-    # Loop through each row and apply the function
-    for index, row in df.iterrows():
-        # Check if the temporary DataFrame exists and if the current satellite_img_name is in temp_df
-        if not temp_df.empty and row['satellite_img_name'] in temp_df['satellite_img_name'].values:
-            logger.info(f"Row {index} with satellite_img_name '{row['satellite_img_name']}' already processed in temp file. Skipping...")
-            continue
-
-        upper_right_coord = calculate_and_add_upper_right(row)
-        processed_rows.append(row)  # Append the original row
-        processed_rows[-1]['Upper-Right WGS84 Coordinate'] = upper_right_coord  # Update 'Upper-Right WGS84 Coordinate' column
-
-        # Check if the threshold is reached and update the CSV file
-        if (index + 1) % update_threshold == 0:
-            # Create a new DataFrame with processed rows
-            updated_df = pd.DataFrame(processed_rows)
+    # Skip rows whose satellite_img_name is already in the temporary file
+    if not temp_df.empty:
+        pending_df = df[~df['satellite_img_name'].isin(temp_df['satellite_img_name'])].copy()
+        logger.info(f"{len(df) - len(pending_df)} rows already processed in temp file. Skipping...")
+    else:
+        pending_df = df.copy()
 
-            # Append the new DataFrame to the existing temporary CSV file
-            if not temp_df.empty:
-                temp_df = pd.concat([temp_df, updated_df], ignore_index=True)
-            else:
-                temp_df = updated_df
+    if not pending_df.empty:
+        pending_df['Upper-Right WGS84 Coordinate'] = calculate_upper_right(pending_df)
 
-            # Deduplicate based on 'satellite_img_name' column
-            temp_df = temp_df.drop_duplicates(subset='satellite_img_name')
+        # Append the new rows to the existing temporary data
+        if not temp_df.empty:
+            temp_df = pd.concat([temp_df, pending_df], ignore_index=True)
+        else:
+            temp_df = pending_df
 
-            # Save the updated DataFrame to the temporary CSV file
-            temp_df.to_csv('temp_integrated_satellite_data.csv', index=False)
+        # Deduplicate based on 'satellite_img_name' column
+        temp_df = temp_df.drop_duplicates(subset='satellite_img_name')
 
-            logger.info(f"Processed {index + 1} rows. Updating CSV file...")
+        # Save the updated DataFrame to the temporary CSV file
+        temp_df.to_csv('temp_integrated_satellite_data.csv', index=False)
+        logger.info(f"Processed {len(pending_df)} rows. Updating CSV file...")
 
     logger.info("CSV file updated with Upper Right Coordinate.")
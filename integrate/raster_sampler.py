@@ -0,0 +1,176 @@
+import threading
+
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+
+class RasterSampler:
+    """
+    Samples a single-band GeoTIFF at batches of (lat, lon) points.
+
+    The dataset is opened once and the EPSG:4326 -> raster CRS transformer is built once. Each batch is
+    converted to row/col indices in one vectorized call, then only the internal blocks covering the batch
+    are decoded and values are picked out with fancy indexing. The last decoded window is kept, so
+    lookups that fall inside it (e.g. tiles of the same city) never touch the file again.
+    """
+
+    def __init__(self, tif_path, band=1, fill_value=0):
+        self.tif_path = tif_path
+        self.band = band
+        self.fill_value = fill_value
+        self.src = rasterio.open(tif_path)
+        # Skip the transform entirely when the raster is already in WGS84 lat/lon
+        if self.src.crs is None or self.src.crs.to_epsg() == 4326:
+            self.transformer = None
+        else:
+            self.transformer = Transformer.from_crs("EPSG:4326", self.src.crs, always_xy=True)
+        self._window = None
+        self._data = None
+        # rasterio datasets are not safe to read from several threads at once
+        self._lock = threading.Lock()
+
+    def index(self, lat, lon):
+        """Convert lat/lon arrays to raster row/col arrays (may fall outside the raster)."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if self.transformer is not None:
+            lon, lat = self.transformer.transform(lon, lat)
+        rows, cols = rowcol(self.src.transform, lon, lat)
+        return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+    def _read_window(self, row_start, row_stop, col_start, col_stop):
+        """Return the cached block covering the given range, decoding it only if needed."""
+        window = self._window
+        if window is None or not (window[0] <= row_start and row_stop <= window[1]
+                                  and window[2] <= col_start and col_stop <= window[3]):
+            # Grow the range to whole internal blocks so neighbouring lookups hit the cache
+            block_height, block_width = self.src.block_shapes[self.band - 1]
+            row_start = row_start // block_height * block_height
+            col_start = col_start // block_width * block_width
+            row_stop = min(-(-row_stop // block_height) * block_height, self.src.height)
+            col_stop = min(-(-col_stop // block_width) * block_width, self.src.width)
+            self._data = self.src.read(self.band, window=Window(col_start, row_start,
+                                                                 col_stop - col_start, row_stop - row_start))
+            self._window = window = (row_start, row_stop, col_start, col_stop)
+        return self._data, window[0], window[2]
+
+    def sample(self, lat, lon):
+        """
+        Look up raster values for arrays of latitudes and longitudes.
+
+        :param lat: Latitudes (scalar or array).
+        :param lon: Longitudes (scalar or array).
+        :return: Array of raster values; points outside the raster get `fill_value`.
+        """
+        rows, cols = self.index(lat, lon)
+        rows, cols = np.atleast_1d(rows), np.atleast_1d(cols)
+        inside = (rows >= 0) & (rows < self.src.height) & (cols >= 0) & (cols < self.src.width)
+        values = np.full(rows.shape, self.fill_value, dtype=self.src.dtypes[self.band - 1])
+        if inside.any():
+            rows_in, cols_in = rows[inside], cols[inside]
+            with self._lock:
+                data, row_off, col_off = self._read_window(rows_in.min(), rows_in.max() + 1,
+                                                           cols_in.min(), cols_in.max() + 1)
+                values[inside] = data[rows_in - row_off, cols_in - col_off]
+        return values
+
+    def pixel_bounds(self, lat_min, lon_min, lat_max, lon_max):
+        """
+        Convert lat/lon boxes to fractional pixel boxes (col_min, row_min, col_max, row_max).
+
+        For projected rasters the four corners are transformed and their bounding box is used.
+        """
+        lat_min, lon_min, lat_max, lon_max = np.broadcast_arrays(
+            *(np.atleast_1d(np.asarray(v, dtype=np.float64)) for v in (lat_min, lon_min, lat_max, lon_max)))
+        corner_lons = np.stack([lon_min, lon_max, lon_min, lon_max])
+        corner_lats = np.stack([lat_min, lat_min, lat_max, lat_max])
+        if self.transformer is not None:
+            corner_lons, corner_lats = self.transformer.transform(corner_lons, corner_lats)
+        cols, rows = ~self.src.transform * (corner_lons, corner_lats)
+        return cols.min(axis=0), rows.min(axis=0), cols.max(axis=0), rows.max(axis=0)
+
+    def zonal_stats(self, lat_min, lon_min, lat_max, lon_max, clip_negative=False, chunk_size=100000):
+        """
+        Area-weighted statistics of the raster over arrays of lat/lon boxes (e.g. tile footprints).
+
+        Every box is laid over the same small stencil of cells anchored at its top-left cell, so all boxes
+        are handled with broadcast array operations instead of a per-box loop. A cell's weight is the
+        fraction of it covered by the box; nodata cells and cells outside the raster get no weight.
+
+        :param lat_min: South edges of the boxes.
+        :param lon_min: West edges of the boxes.
+        :param lat_max: North edges of the boxes.
+        :param lon_max: East edges of the boxes.
+        :param clip_negative: Treat negative cell values as 0, like the point lookups do for population and GDP.
+        :param chunk_size: Number of boxes processed per vectorized step, to bound memory.
+        :return: Dict of arrays: 'sum' (area-weighted sum of cell values), 'mean' (area-weighted mean),
+                 'max' (max over overlapped cells) and 'coverage' (overlapped area in cells).
+        """
+        col_min, row_min, col_max, row_max = self.pixel_bounds(lat_min, lon_min, lat_max, lon_max)
+        count = len(col_min)
+        result = {key: np.zeros(count) for key in ('sum', 'mean', 'max', 'coverage')}
+        if count == 0:
+            return result
+
+        # Read every block the boxes can touch once, up front
+        first_row = int(np.clip(np.floor(row_min).min(), 0, self.src.height - 1))
+        last_row = int(np.clip(np.ceil(row_max).max(), first_row + 1, self.src.height))
+        first_col = int(np.clip(np.floor(col_min).min(), 0, self.src.width - 1))
+        last_col = int(np.clip(np.ceil(col_max).max(), first_col + 1, self.src.width))
+        with self._lock:
+            data, row_off, col_off = self._read_window(first_row, last_row, first_col, last_col)
+        nodata = self.src.nodata
+
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            c0, c1 = col_min[start:stop], col_max[start:stop]
+            r0, r1 = row_min[start:stop], row_max[start:stop]
+
+            # Shared stencil: offsets of the cells a box can overlap, relative to its first cell
+            base_col, base_row = np.floor(c0).astype(np.int64), np.floor(r0).astype(np.int64)
+            span_cols = int((np.ceil(c1) - base_col).max())
+            span_rows = int((np.ceil(r1) - base_row).max())
+            cols = base_col[:, np.newaxis] + np.arange(max(span_cols, 1))
+            rows = base_row[:, np.newaxis] + np.arange(max(span_rows, 1))
+
+            # Fraction of each stencil column/row covered by the box; the cell weight is their product
+            overlap_x = np.clip(np.minimum(c1[:, np.newaxis], cols + 1) - np.maximum(c0[:, np.newaxis], cols), 0, 1)
+            overlap_y = np.clip(np.minimum(r1[:, np.newaxis], rows + 1) - np.maximum(r0[:, np.newaxis], rows), 0, 1)
+            weights = overlap_y[:, :, np.newaxis] * overlap_x[:, np.newaxis, :]
+
+            # Gather the stencil values; cells outside the raster are masked out
+            valid_cols = (cols >= 0) & (cols < self.src.width)
+            valid_rows = (rows >= 0) & (rows < self.src.height)
+            valid = valid_rows[:, :, np.newaxis] & valid_cols[:, np.newaxis, :]
+            values = data[np.clip(rows, first_row, last_row - 1)[:, :, np.newaxis] - row_off,
+                          np.clip(cols, first_col, last_col - 1)[:, np.newaxis, :] - col_off].astype(np.float64)
+            valid &= np.isfinite(values)
+            if nodata is not None:
+                valid &= values != nodata
+            if clip_negative:
+                values = np.maximum(values, 0)
+            weights = np.where(valid, weights, 0)
+            values = np.where(valid, values, 0)
+
+            weighted_sum = (weights * values).sum(axis=(1, 2))
+            coverage = weights.sum(axis=(1, 2))
+            result['sum'][start:stop] = weighted_sum
+            result['coverage'][start:stop] = coverage
+            result['mean'][start:stop] = np.divide(weighted_sum, coverage, out=np.zeros_like(coverage),
+                                                   where=coverage > 0)
+            overlapped = weights > 0
+            result['max'][start:stop] = np.where(overlapped.any(axis=(1, 2)),
+                                                 np.where(overlapped, values, -np.inf).max(axis=(1, 2)), 0)
+        return result
+
+    def sample_point(self, lat, lon):
+        """Look up the raster value for a single point."""
+        return self.sample(lat, lon)[0]
+
+    def close(self):
+        self.src.close()
+        self._data = None
+        self._window = None
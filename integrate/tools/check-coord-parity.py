@@ -0,0 +1,52 @@
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.coords import bd09mc_to_bd09, bd09_to_bd09mc, tile_to_bd09mc
+
+# CSV files whose coordinates were produced by the Baidu geoconv API (from=6, to=5)
+output_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output')
+csv_path = os.path.join(output_folder, "integrated_satellite_data.csv")
+temp_csv_path = os.path.join(output_folder, "temp_integrated_satellite_data.csv")
+zoom = 16
+
+
+def parse_pair(value):
+    """Parse a "(a, b)" string into a tuple of floats."""
+    a, b = value[1:-1].split(',')
+    return float(a), float(b)
+
+
+def load_recorded(path, offset, column):
+    """Load tile coordinates (shifted by offset) and the recorded lat/lng in the given column."""
+    with open(path, 'r') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    tiles = np.array([parse_pair(row['BD09 coordinate']) for row in rows], dtype=np.int64) + offset
+    recorded = np.array([parse_pair(row[column]) for row in rows])
+    return tiles, recorded
+
+
+def check(name, tiles, recorded):
+    """Compare the offline conversion against the recorded API results and print a summary."""
+    bd_x, bd_y = tile_to_bd09mc(tiles[:, 0], tiles[:, 1], zoom)
+    lng, lat = bd09mc_to_bd09(bd_x, bd_y)
+    exact = np.mean((lat == recorded[:, 0]) & (lng == recorded[:, 1]))
+    max_diff = max(np.abs(lat - recorded[:, 0]).max(), np.abs(lng - recorded[:, 1]).max())
+
+    # Round trip back to Mercator, the direction used by the crawlers (from=5, to=6)
+    back_x, back_y = bd09_to_bd09mc(lng, lat)
+    max_round_trip = max(np.abs(back_x - bd_x).max(), np.abs(back_y - bd_y).max())
+
+    print(f"{name}: {len(tiles)} points, {exact:.2%} bit-identical, max diff {max_diff:.3g} deg, "
+          f"max Mercator round trip error {max_round_trip:.3g} m")
+    return exact == 1.0
+
+
+if __name__ == "__main__":
+    results = [check("lower-left", *load_recorded(csv_path, 0, 'WGS84 coordinate'))]
+    if os.path.exists(temp_csv_path):
+        results.append(check("upper-right", *load_recorded(temp_csv_path, 1, 'Upper-Right WGS84 Coordinate')))
+    sys.exit(0 if all(results) else 1)
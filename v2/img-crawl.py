@@ -1,75 +1,45 @@
 import csv
-import math
+import io
+import itertools
 import os
-import random
-import time
-from concurrent.futures import ThreadPoolExecutor
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 
-import requests
+import numpy as np
 from PIL import Image
-from PIL import ImageDraw
 from loguru import logger
-from shapely import Polygon
+import shapely
 from shapely.geometry import box
-from shapely.wkt import loads
 
-# 百度地图的访问密钥
-# 配置可见：https://lbsyun.baidu.com/apiconsole/center#/home
-ak = '1ZtwxRT5sUDd6jaj0c7sCpjy9zXTl10O'
-
-
-# 预处理函数，用于处理原始aoi.csv文件
-def preprocess(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        file_content = file.read()
-
-    # 将NBSP替换为空格
-    file_content = file_content.replace('\xa0', ' ')
-
-    # 将替换后的内容写回文件
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(file_content)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.coords import TILE_SIZE, bd09_to_pixel, gcj02_to_bd09
+from common.downloader import TileDownloader
+from common.mask import mask_in_place, masked_copy, polygon_rings
+from common.pipeline import Pipeline
+from common.tile_cache import TileCache
+from common.tile_plan import plan_tiles
+from common.tile_store import close_tile_store, get_tile_store, parse_tile_name, read_tile
 
 
 # 将经纬度坐标转换为百度地图坐标
+# 与 geoconv 接口（from=5, to=6）使用相同的投影在本地计算，无需百度 ak
 def bd_latlng2xy(zoom, latitude, longitude):
-    url = "https://api.map.baidu.com/geoconv/v1/"
-    # 详细参数参考：https://lbs.baidu.com/faq/api?title=webapi/guide/changeposition-base
-    params = {
-        "coords": str(longitude) + ',' + str(latitude),
-        "from": "5",
-        "to": "6",
-        "ak": ak,
-    }
-    response = requests.get(url=url, params=params)
-    result = response.json()
-    loc = result["result"][0]
-    res = 2 ** (18 - zoom)  # 计算缩放因子
-    x = loc['x'] / res
-    y = loc['y'] / res
+    x, y = bd09_to_pixel(longitude, latitude, zoom)
     return x, y
 
 
-# 将高德地图坐标转换为百度地图坐标
-def convert_gd_to_baidu(gg_lng, gg_lat):
-    X_PI = math.pi * 3000.0 / 180.0
-    x = gg_lng
-    y = gg_lat
-    z = math.sqrt(x * x + y * y) + 0.00002 * math.sin(y * X_PI)
-    theta = math.atan2(y, x) + 0.000003 * math.cos(x * X_PI)
-    bd_lng = z * math.cos(theta) + 0.0065
-    bd_lat = z * math.sin(theta) + 0.006
-    return {
-        "bd_lat": bd_lat,
-        "bd_lng": bd_lng
-    }
-
-
 # 下载地图瓦片
-def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, longitude_stop, satellite=True):
-    # 为每个城市创建一个带有单独子目录的保存目录
+# packed=True 时，瓦片追加写入 img/tiles/<city>.pack 单个文件，而不是每个瓦片一个文件
+# 传入 downloader 时多个 AOI 共享同一个连接池和自适应并发限制
+# 传入 cache 时瓦片存入所有 AOI 共享的瓦片缓存，返回的瓦片在 cache.unpin(tile_paths) 之前不会被淘汰
+# 传入 tiles（(x, y) 列表，例如 plan_tiles 得到的与多边形相交的瓦片）时只下载这些瓦片，网格仍为外接矩形的范围，其余瓦片留空
+# 传入 executor 时在这个（多个 AOI 共享的）线程池中下载，否则为本次调用创建一个
+def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, longitude_stop, satellite=True,
+                   packed=False, downloader=None, cache=None, tiles=None, executor=None):
+    # 为每个城市创建一个带有单独子目录（或打包文件）的保存目录
     root_save = os.path.join("img/tiles", city)
-    os.makedirs(root_save, exist_ok=True)
+    store = get_tile_store(root_save, '_s.jpg' if satellite else '_r.png', packed) if cache is None else None
 
     # 进行坐标转换
     start_x, start_y = bd_latlng2xy(zoom, latitude_start, longitude_start)
@@ -86,26 +56,55 @@ def download_tiles(city, zoom, latitude_start, latitude_stop, longitude_start, l
     grid_size_y = stop_y - start_y
     logger.info(f'x range: {start_x} to {stop_x}')
     logger.info(f'y range: {start_y} to {stop_y}')
+    if tiles is None:
+        tiles = [(x, y) for x in range(start_x, stop_x) for y in range(start_y, stop_y)]
 
-    # 使用自定义大小的线程池循环下载每个图块，例如 max_workers=666
+    # 通过共享连接池的会话循环下载每个图块，例如 max_workers=666
+    # 下载器会根据服务器延迟和 429/5xx 响应自适应调整并发请求数
     tile_paths = []
-    with ThreadPoolExecutor(max_workers=666) as executor:
-        futures = []
-        for x in range(start_x, stop_x):
-            for y in range(start_y, stop_y):
-                tile_path = os.path.join(root_save, f"{zoom}_{x}_{y}_s.jpg")
+    shared_downloader = downloader is not None
+    if not shared_downloader:
+        downloader = TileDownloader(max_workers=666)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=downloader.max_workers)
+    futures = []
+    try:
+        for x, y in tiles:
+            if cache is not None:
+                tile_path = cache.path('satellite' if satellite else 'road', zoom, x, y)
+                cache.pin((tile_path,))
                 tile_paths.append(tile_path)
-                futures.append(executor.submit(download_tile, x, y, zoom, satellite, root_save))
+                futures.append(executor.submit(download_cached_tile, x, y, zoom, satellite, cache, downloader))
+            else:
+                tile_paths.append(os.path.join(root_save, f"{zoom}_{x}_{y}_s.jpg"))
+                futures.append(executor.submit(download_tile, x, y, zoom, satellite, store, downloader))
         # 等待所有线程完成
         for future in futures:
             future.result()
+    except BaseException:
+        # 出错时调用方拿不到 tile_paths，无法 unpin：取消尚未开始的下载并在这里解除固定，否则这些瓦片会一直留在缓存中
+        for future in futures:
+            future.cancel()
+        if cache is not None:
+            cache.unpin(tile_paths)
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown()
+    if not shared_downloader:
+        downloader.log_summary(city)
+        downloader.close()
+    if store is not None:
+        # 写入完成后关闭该 AOI 的存储（打包文件的句柄），拼接进程从磁盘读取
+        close_tile_store(root_save)
 
     # 返回图块路径、左上角图块坐标和网格大小
     return tile_paths, (start_x, stop_y), (grid_size_x, grid_size_y)
 
 
-# 下载单个地图瓦片
-def download_tile(x, y, zoom, satellite, root_save):
+# 瓦片的下载地址和文件名
+def tile_url(x, y, zoom, satellite):
     if satellite:
         # 卫星图像 URL
         url = f"http://shangetu0.map.bdimg.com/it/u=x={x};y={y};z={zoom};v=009;type=sate&fm=46&udt=20150504&app=webearth2&v=009&udt=20150601"
@@ -114,58 +113,130 @@ def download_tile(x, y, zoom, satellite, root_save):
         # 路线图图像 URL
         url = f'http://online3.map.bdimg.com/tile/?qt=tile&x={x}&y={y}&z={zoom}&styles=pl&scaler=1&udt=20180810'
         filename = f"{zoom}_{x}_{y}_r.png"
+    return url, filename
 
-    filename = os.path.join(root_save, filename)
 
-    # 检查文件是否存在，不存在则下载
-    if not os.path.exists(filename):
-        try:
-            logger.info(f'downloading filename: {filename}')
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
+# 通过共享瓦片缓存下载单个地图瓦片：已缓存则直接命中，其他 AOI 正在下载同一瓦片时等待其结果
+def download_cached_tile(x, y, zoom, satellite, cache, downloader):
+    url, filename = tile_url(x, y, zoom, satellite)
+
+    def fetch():
+        logger.info(f'downloading filename: {filename}')
+        return downloader.fetch(url)
+
+    cache.get('satellite' if satellite else 'road', zoom, x, y, fetch)
+
+
+# 下载单个地图瓦片
+def download_tile(x, y, zoom, satellite, store, downloader):
+    url, filename = tile_url(x, y, zoom, satellite)
+
+    # 检查瓦片是否存在，不存在则下载
+    if not store.has(zoom, x, y):
+        logger.info(f'downloading filename: {filename}')
+        content = downloader.fetch(url)
+        if content is not None:
             logger.info(f"-- saving {filename}")
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-            time.sleep(random.random())  # Random sleep to reduce server load
-        except requests.RequestException as e:
-            logger.info(f"-- {filename} -> {e}")
+            store.put(zoom, x, y, content)
     else:
         logger.info(f"File already exists: {filename}")
 
 
+# 将一批高德（GCJ02）多边形整体转换为百度（BD09）坐标：所有多边形的全部坐标点（包括内部空洞和多多边形的各个部分）
+# 只调用一次 gcj02_to_bd09
+def convert_polygons(polygons):
+    def convert(coords):
+        bd_lng, bd_lat = gcj02_to_bd09(coords[:, 0], coords[:, 1])
+        return np.column_stack((bd_lng, bd_lat))
+
+    return shapely.transform(polygons, convert)
+
+
+# 流式解析AOI文件：在内存中将NBSP替换为空格（不再改写 aoi.csv），每 batch_size 行用 shapely 的数组接口批量解析 WKT
+# 并批量转换坐标，然后逐个产出 AOI，大文件无需全部解析完就能开始下载
+def iter_aois(file_path, batch_size=1000):
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(line.replace('\xa0', ' ') for line in csvfile)
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                break
+            polygons = convert_polygons(shapely.from_wkt([row['wkt'] for row in rows]))
+            for row, polygon, bounds in zip(rows, polygons, shapely.bounds(polygons).tolist()):
+                yield {
+                    'address': row['aoi_address'],
+                    'centroid': row['centroid'],
+                    'polygon': polygon,
+                    'bounding_square': box(*bounds)
+                }
+
+
 # 解析AOI文件
 def parse_aoi_file(file_path):
-    aois = []
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            wkt = row['wkt']
-            # 转换WKT中的坐标点
-            polygon = loads(wkt)
-            converted_polygon = []
-            for point in polygon.exterior.coords:
-                lat, lon = point[1], point[0]
-                conversion_result = convert_gd_to_baidu(lon, lat)
-                converted_lat = conversion_result["bd_lat"]
-                converted_lon = conversion_result["bd_lng"]
-                converted_polygon.append((converted_lon, converted_lat))
-            # 创建转换后的多边形
-            converted_polygon = Polygon(converted_polygon)
-            aoi = {
-                'address': row['aoi_address'],
-                'centroid': row['centroid'],
-                'polygon': converted_polygon,
-                'bounding_square': get_bounding_square(converted_polygon)
-            }
-            aois.append(aoi)
-    return aois
-
-
-# 获取多边形的外接矩形
-def get_bounding_square(polygon):
-    minx, miny, maxx, maxy = polygon.bounds
-    return box(minx, miny, maxx, maxy)
+    return list(iter_aois(file_path))
+
+
+# 瓦片规划：逐个 AOI 算出与多边形相交的瓦片（而不是外接矩形覆盖的全部瓦片），写入 aoi['tiles'] 后立即产出，
+# 不会等整个文件解析完才开始下载；多个 AOI 共享的瓦片由共享瓦片缓存去重，全部产出后记录总的节省比例
+def plan_aois(aois, zoom):
+    planned, bbox_tiles = 0, 0
+    for aoi in aois:
+        plan = plan_tiles([aoi['polygon']], zoom)
+        aoi['tiles'] = plan.aoi_tiles[0]
+        planned += len(aoi['tiles'])
+        bbox_tiles += plan.bbox_tiles
+        yield aoi
+    logger.info(f"tile plan: {planned} of {bbox_tiles} bounding box tiles intersect the AOI polygons "
+                f"({1 - planned / bbox_tiles if bbox_tiles else 0:.1%} fewer)")
+
+
+# 流式拼接：先确定输出窗口，只解码与窗口相交的瓦片，并直接写入预分配的 NumPy 缓冲区
+# 峰值内存只与输出大小有关，而与瓦片网格大小无关
+def stitch_window(tile_paths, top_left_tile, grid_size, window=None, scale=1, out=None):
+    """
+    :param tile_paths: 瓦片路径列表
+    :param top_left_tile: 左上角瓦片坐标 (start_x, stop_y)，与 download_tiles 的返回值相同
+    :param grid_size: 网格大小 (列数, 行数)
+    :param window: 拼接图像坐标系中的输出窗口 (left, upper, right, lower)；None 表示整张拼接图
+    :param scale: 输出缩小倍数；JPEG 瓦片以 draft 模式直接按缩小后的分辨率解码
+    :param out: 可选的预分配 uint8 数组（例如 np.memmap），形状为 (高, 宽, 3)
+    :return: 形状为 (高, 宽, 3) 的 uint8 数组
+    """
+    start_x, stop_y = top_left_tile
+    if window is None:
+        window = (0, 0, grid_size[0] * TILE_SIZE, grid_size[1] * TILE_SIZE)
+    left, upper, right, lower = (v // scale for v in window)
+    if out is None:
+        out = np.zeros((lower - upper, right - left, 3), dtype=np.uint8)
+    tile_size = TILE_SIZE // scale
+
+    for tile_path in tile_paths:
+        # 瓦片在拼接图像中的位置：列从 start_x 开始，行从顶部（最大的 y）开始
+        _, x, y = parse_tile_name(os.path.basename(tile_path))
+        tile_left = (x - start_x) * tile_size
+        tile_upper = (stop_y - 1 - y) * tile_size
+        # 跳过与输出窗口不相交的瓦片，不读取也不解码
+        box_left, box_right = max(left, tile_left), min(right, tile_left + tile_size)
+        box_upper, box_lower = max(upper, tile_upper), min(lower, tile_upper + tile_size)
+        if box_left >= box_right or box_upper >= box_lower:
+            continue
+
+        try:
+            data = read_tile(tile_path)
+        except FileNotFoundError:
+            logger.info(f"Missing tile left blank: {tile_path}")
+            continue
+        with Image.open(io.BytesIO(data)) as tile:
+            if scale > 1:
+                tile.draft('RGB', (tile_size, tile_size))
+            tile = tile.convert('RGB')
+            if tile.size != (tile_size, tile_size):
+                tile = tile.resize((tile_size, tile_size), Image.BOX)
+            pixels = np.asarray(tile)
+        out[box_upper - upper:box_lower - upper, box_left - left:box_right - left] = \
+            pixels[box_upper - tile_upper:box_lower - tile_upper, box_left - tile_left:box_right - tile_left]
+
+    return out
 
 
 # 拼接单张瓦片图
@@ -174,68 +245,71 @@ def stitch_tiles(tile_paths, grid_size):
         logger.info("No tiles to stitch")
         return
 
-    tile_width, tile_height = Image.open(tile_paths[0]).size
-    total_width = tile_width * grid_size[0]
-    total_height = tile_height * grid_size[1]
-    stitched_image = Image.new('RGB', (total_width, total_height))
-
-    # 根据文件名中的x和y坐标对瓦片路径进行排序
-    # 首先提取 x 和 y 的值，然后按 y 升序、x 升序排列
-    tile_paths.sort(key=lambda path: (int(path.split('_')[2]), int(path.split('_')[1])))
-
-    for i, tile_path in enumerate(tile_paths):
-        with Image.open(tile_path) as tile:
-            # 计算瓦片在拼接图像中的位置
-            x_index = i % grid_size[0]
-            y_index = i // grid_size[0]
-            x = x_index * tile_width
-            y = (grid_size[1] - 1 - y_index) * tile_height  # 从底部开始计算 y 坐标
-            stitched_image.paste(tile, (x, y))
-
-    return stitched_image
+    # 从文件名中解析一次瓦片坐标，得到左上角瓦片
+    coords = [parse_tile_name(os.path.basename(path)) for path in tile_paths]
+    top_left_tile = (min(x for _, x, _ in coords), max(y for _, _, y in coords) + 1)
+    return Image.fromarray(stitch_window(tile_paths, top_left_tile, grid_size))
+
+
+# 应用遮罩, 返回遮罩后的AOI图像
+# 支持带内部空洞的多边形和多多边形；输入为 PIL 图像时返回 PIL 图像，为 (高, 宽, 3) 的 uint8 数组时返回数组
+# in_place=True 时直接在输入数组的裁剪区域上把多边形外的像素置零并返回该视图（会修改输入），不分配新的缓冲区；
+# PIL 输入和超出图像范围的裁剪本来就要复制，复制后总是原地遮罩
+def mask_aoi(stitched_image, aoi_polygon, tile_bounds, in_place=False):
+    is_pil = isinstance(stitched_image, Image.Image)
+    width, height = stitched_image.size if is_pil else (stitched_image.shape[1], stitched_image.shape[0])
+
+    # 将AOI多边形所有环的地理坐标一次性转换为图像上的像素坐标
+    min_lon, min_lat, max_lon, max_lat = tile_bounds
+    pixel_rings = [np.column_stack(((ring[:, 0] - min_lon) / (max_lon - min_lon) * width,
+                                    (max_lat - ring[:, 1]) / (max_lat - min_lat) * height))
+                   for ring in polygon_rings(aoi_polygon)]
+
+    # 获取AOI多边形的像素边界（内部空洞位于外环之内，不影响边界）
+    points = np.concatenate(pixel_rings)
+    min_x, min_y = points.min(axis=0)
+    max_x, max_y = points.max(axis=0)
+    crop_box = (float(min_x), float(min_y), float(max_x), float(max_y))
+    logger.info(f"Cropping with box: {crop_box}")
+    # 多边形坐标转换为相对于矩形图像的坐标
+    relative_rings = [ring - (min_x, min_y) for ring in pixel_rings]
+
+    # 裁剪出AOI覆盖的矩形区域（与 PIL 的 crop 一样按四舍五入取整，超出图像的部分为黑色）
+    left, upper, right, lower = (int(round(v)) for v in crop_box)
+    if is_pil:
+        # 裁剪结果是自有的副本，直接原地遮罩
+        aoi_image = np.array(stitched_image.crop((left, upper, right, lower)).convert('RGB'))
+        return Image.fromarray(mask_in_place(aoi_image, relative_rings))
+    if left >= 0 and upper >= 0 and right <= width and lower <= height:
+        # 直接使用原数组的视图，不复制
+        aoi_image = stitched_image[upper:lower, left:right]
+        if in_place:
+            return mask_in_place(aoi_image, relative_rings)
+        # 只复制多边形内部的像素，其余部分为黑色
+        return masked_copy(aoi_image, relative_rings)
+    aoi_image = np.zeros((lower - upper, right - left) + stitched_image.shape[2:], dtype=np.uint8)
+    src_left, src_upper = max(left, 0), max(upper, 0)
+    src_right, src_lower = min(right, width), min(lower, height)
+    if src_left < src_right and src_upper < src_lower:
+        aoi_image[src_upper - upper:src_lower - upper, src_left - left:src_right - left] = \
+            stitched_image[src_upper:src_lower, src_left:src_right]
+    return mask_in_place(aoi_image, relative_rings)
 
 
 # 应用遮罩, 保存遮罩后的AOI图像
-def apply_mask(stitched_image, aoi_polygon, tile_bounds, save_path):
-    # 将AOI多边形的地理坐标转换为图像上的像素坐标
-    def convert_coords(coords):
-        min_lon, min_lat, max_lon, max_lat = tile_bounds
-        x_percent = (coords[0] - min_lon) / (max_lon - min_lon)
-        y_percent = (max_lat - coords[1]) / (max_lat - min_lat)
-        return (x_percent * stitched_image.width, y_percent * stitched_image.height)
-
-    # 确定AOI多边形在拼接图像上的像素坐标
-    aoi_coords = [convert_coords(point) for point in aoi_polygon.exterior.coords]
-
-    # 获取AOI多边形的像素边界
-    aoi_pixel_bounds = [(min(x[0] for x in aoi_coords), min(y[1] for y in aoi_coords)),
-                        (max(x[0] for x in aoi_coords), max(y[1] for y in aoi_coords))]
-
-    # 裁剪拼接图像以获取AOI覆盖的矩形区域
-    crop_box = (aoi_pixel_bounds[0][0], aoi_pixel_bounds[0][1],
-                aoi_pixel_bounds[1][0], aoi_pixel_bounds[1][1])
-    logger.info(f"Cropping with box: {crop_box}")
-    aoi_image = stitched_image.crop(crop_box)
-
-    # 在AOI覆盖的矩形图像上创建遮罩
-    mask = Image.new('L', aoi_image.size, 0)
-    draw = ImageDraw.Draw(mask)
-    # 转换AOI坐标为相对于矩形图像的坐标
-    relative_aoi_coords = [(x[0] - aoi_pixel_bounds[0][0], x[1] - aoi_pixel_bounds[0][1]) for x in aoi_coords]
-    # 在遮罩上绘制多边形
-    draw.polygon(relative_aoi_coords, fill=255)
-    black_background = Image.new('RGB', aoi_image.size)
-    # 应用遮罩
-    masked_aoi_image = Image.composite(aoi_image, black_background, mask)
+# 输入可以是 PIL 图像或 stitch_window 返回的数组；传入数组且 in_place=True 时直接在数组上遮罩，速度最快
+def apply_mask(stitched_image, aoi_polygon, tile_bounds, save_path, in_place=False):
+    masked_aoi_image = mask_aoi(stitched_image, aoi_polygon, tile_bounds, in_place)
+    if isinstance(masked_aoi_image, np.ndarray):
+        masked_aoi_image = Image.fromarray(masked_aoi_image)
     # 保存遮罩后的AOI图像
     masked_aoi_image.save(save_path)
 
     logger.info(f"Masked image saved to {save_path}")
 
 
-# 裁剪拼接后的图像
-def crop_stitched_image(stitched_image, start_lat, start_lon, stop_lat, stop_lon, zoom, top_left_x_tile,
-                        top_left_y_tile):
+# 计算裁剪窗口在拼接图像中的像素坐标 (left, upper, right, lower)，无需先拼接图像
+def crop_window(start_lat, start_lon, stop_lat, stop_lon, zoom, top_left_x_tile, top_left_y_tile, grid_size):
     # 将起始坐标和终止坐标转换为像素坐标
     start_x, start_y = bd_latlng2xy(zoom, start_lat, start_lon)
     stop_x, stop_y = bd_latlng2xy(zoom, stop_lat, stop_lon)
@@ -255,50 +329,122 @@ def crop_stitched_image(stitched_image, start_lat, start_lon, stop_lat, stop_lon
     # 确保坐标在图像范围内
     left = max(0, left)
     upper = max(0, upper)
-    right = min(stitched_image.width, right)
-    lower = min(stitched_image.height, lower)
+    right = min(grid_size[0] * TILE_SIZE, right)
+    lower = min(grid_size[1] * TILE_SIZE, lower)
+    return left, upper, right, lower
+
 
-    # 裁剪拼接图像
-    crop_area = (left, upper, right, lower)
+# 裁剪拼接后的图像
+def crop_stitched_image(stitched_image, start_lat, start_lon, stop_lat, stop_lon, zoom, top_left_x_tile,
+                        top_left_y_tile):
+    grid_size = (stitched_image.width // TILE_SIZE, stitched_image.height // TILE_SIZE)
+    crop_area = crop_window(start_lat, start_lon, stop_lat, stop_lon, zoom, top_left_x_tile, top_left_y_tile,
+                            grid_size)
     cropped_image = stitched_image.crop(crop_area)
     return cropped_image
 
 
+# 流水线第 3 阶段（进程池）：拼接、裁剪并遮罩一个 AOI，返回待保存的图像
+def render_aoi(job):
+    left, upper, right, lower = job['window']
+    scale = job['scale']
+    if job['save_stitched']:
+        # 拼接全部瓦片，裁剪图直接取缓冲区的切片
+        stitched = stitch_window(job['tile_paths'], job['top_left_tile'], job['grid_size'], scale=scale)
+        cropped = stitched[upper // scale:lower // scale, left // scale:right // scale]
+    else:
+        # 只解码与裁剪窗口相交的瓦片
+        stitched = None
+        cropped = stitch_window(job['tile_paths'], job['top_left_tile'], job['grid_size'], job['window'], scale)
+
+    # 关闭本进程为该 AOI 打开的瓦片存储，进程池中的进程不会随 AOI 累积打开的打包文件和映射
+    close_tile_store(os.path.dirname(job['tile_paths'][0]))
+
+    images = {
+        'cropped_images': cropped,
+        'masked_images': mask_aoi(cropped, job['polygon'], job['tile_bounds']),
+    }
+    if stitched is not None:
+        images['stitched_images'] = stitched
+    return {'address': job['address'], 'images': images}
+
+
+# 流水线第 4 阶段（写入线程池）：编码并保存图像
+def save_aoi(result):
+    for folder, image in result['images'].items():
+        save_path = os.path.join("img", folder, f"{result['address']}.jpg")
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        Image.fromarray(image).save(save_path)
+        logger.info(f"Saved {save_path}")
+    return result['address']
+
+
 def main():
-    preprocess('aoi.csv')
-    aois = parse_aoi_file('aoi.csv')
     zoom = 19  # 百度地图缩放级别
     satellite = True  # 卫星图像
-
-    for aoi in aois:
-        square = aoi['bounding_square']
-        lon_start, lat_start, lon_stop, lat_stop = square.bounds
-        tile_paths, (top_left_x_tile, top_left_y_tile), grid_size = \
-            download_tiles(aoi['address'], zoom, lat_start, lat_stop, lon_start, lon_stop, satellite)
-
-        # 拼接瓦片块并保存拼接图像
-        stitched_image = stitch_tiles(tile_paths, grid_size)
-        if stitched_image:
-            # 根据原始坐标裁剪拼接图像
-            cropped_image = crop_stitched_image(
-                stitched_image, lat_start, lon_start, lat_stop, lon_stop, zoom, top_left_x_tile, top_left_y_tile)
-            cropped_save_path = os.path.join("img/cropped_images", f"{aoi['address']}.jpg")
-            os.makedirs(os.path.dirname(cropped_save_path), exist_ok=True)
-            cropped_image.save(cropped_save_path)
-            logger.info(f"Cropped image saved to {cropped_save_path}")
-
-            # 保存拼接图像
-            stitched_sava_path = os.path.join("img/stitched_images", f"{aoi['address']}.jpg")
-            os.makedirs(os.path.dirname(stitched_sava_path), exist_ok=True)
-            stitched_image.save(stitched_sava_path)
-            logger.info(f"Stitched image saved to {stitched_sava_path}")
-
-            # 应用遮罩并保存遮罩后的图像
-            tile_bounds = (lon_start, lat_start, lon_stop, lat_stop)
-            masked_sava_path = os.path.join("img/masked_images", f"{aoi['address']}.jpg")
-            os.makedirs(os.path.dirname(masked_sava_path), exist_ok=True)
-            apply_mask(cropped_image, aoi['polygon'], tile_bounds, masked_sava_path)
-            logger.info(f"Masked image saved to {masked_sava_path}")
+    packed = False  # 将每个AOI的瓦片存入单个 .pack 文件，避免海量小文件
+    save_stitched = True  # 是否保存完整拼接图；关闭后只解码裁剪窗口内的瓦片，内存只与裁剪图大小有关
+    scale = 1  # 输出图像缩小倍数；为 2、4、8 时 JPEG 瓦片直接以低分辨率解码
+    # 各阶段并发数：下载线程（每个线程处理一个 AOI，共享同一个下载器）、拼接进程、保存线程
+    fetch_workers = 8
+    render_workers = os.cpu_count()
+    save_workers = 4
+    use_cache = True  # 为 False 时每个 AOI 的瓦片单独存放在 img/tiles/<address> 下（此时 packed 生效）
+    plan = False  # 只下载与 AOI 多边形相交的瓦片；外接矩形内多边形未覆盖的瓦片在拼接图和裁剪图中留黑，只需要遮罩图时再开启
+
+    downloader = TileDownloader(max_workers=666)
+    # 所有下载线程共享一个线程池，总线程数不随下载线程数成倍增加
+    download_pool = ThreadPoolExecutor(max_workers=downloader.max_workers)
+
+    # 所有 AOI 共享的瓦片缓存，重叠或嵌套的 AOI 不再重复下载同一瓦片；超过上限时按最近最少使用淘汰
+    cache = TileCache("img/tiles/cache", max_bytes=20 * 1024 ** 3) if use_cache else None
+
+    # 流水线第 2 阶段（I/O 线程池）：下载 AOI 外接矩形覆盖的瓦片，并计算裁剪窗口
+    def fetch_aoi(aoi):
+        lon_start, lat_start, lon_stop, lat_stop = aoi['bounding_square'].bounds
+        tile_paths, (top_left_x_tile, top_left_y_tile), grid_size = download_tiles(
+            aoi['address'], zoom, lat_start, lat_stop, lon_start, lon_stop, satellite, packed, downloader, cache,
+            aoi.get('tiles'), download_pool)
+        if not tile_paths:
+            logger.info("No tiles to stitch")
+            return None
+        return {
+            'address': aoi['address'],
+            'tile_paths': tile_paths,
+            'top_left_tile': (top_left_x_tile, top_left_y_tile),
+            'grid_size': grid_size,
+            'window': crop_window(lat_start, lon_start, lat_stop, lon_stop, zoom, top_left_x_tile, top_left_y_tile,
+                                  grid_size),
+            'polygon': aoi['polygon'],
+            'tile_bounds': (lon_start, lat_start, lon_stop, lat_stop),
+            'save_stitched': save_stitched,
+            'scale': scale,
+        }
+
+    # 阶段之间使用有界队列：后一阶段跟不上时，前一阶段会阻塞等待（背压）
+    # 拼接进程使用 spawn 启动，避免在已有线程的进程中 fork
+    with ProcessPoolExecutor(max_workers=render_workers, mp_context=get_context('spawn')) as render_pool:
+        # 流水线第 3 阶段：在进程池中拼接，完成后释放该 AOI 对缓存瓦片的占用
+        def render(job):
+            try:
+                return render_pool.submit(render_aoi, job).result()
+            finally:
+                if cache is not None:
+                    cache.unpin(job['tile_paths'])
+
+        pipeline = Pipeline('aoi')
+        pipeline.add_stage('fetch', fetch_aoi, workers=fetch_workers)
+        pipeline.add_stage('render', render, workers=render_workers)
+        pipeline.add_stage('save', save_aoi, workers=save_workers)
+        # 第 1 阶段：流式解析 AOI 文件，并逐个规划需要下载的瓦片
+        aois = iter_aois('aoi.csv')
+        pipeline.run(plan_aois(aois, zoom) if plan else aois)
+
+    download_pool.shutdown()
+    downloader.log_summary('aoi')
+    downloader.close()
+    if cache is not None:
+        cache.log_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+from loguru import logger
+from shapely import Polygon
+
+# 基准参数：模拟 19 级下的大型 AOI
+image_size = (12000, 9000)  # 裁剪图像大小（宽, 高）
+vertex_count = 2000  # 外环顶点数
+hole_count = 20  # 内部空洞数
+repeats = 3
+Image.MAX_IMAGE_PIXELS = None
+
+# 加载 v2/img-crawl.py（文件名带连字符，不能直接 import）
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'img-crawl.py')
+spec = importlib.util.spec_from_file_location('img_crawl', script_path)
+img_crawl = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(img_crawl)
+
+
+# 原实现：逐点转换坐标，PIL 绘制外环，再与全尺寸黑色背景合成（忽略空洞）
+def legacy_mask(stitched_image, aoi_polygon, tile_bounds):
+    def convert_coords(coords):
+        min_lon, min_lat, max_lon, max_lat = tile_bounds
+        x_percent = (coords[0] - min_lon) / (max_lon - min_lon)
+        y_percent = (max_lat - coords[1]) / (max_lat - min_lat)
+        return (x_percent * stitched_image.width, y_percent * stitched_image.height)
+
+    aoi_coords = [convert_coords(point) for point in aoi_polygon.exterior.coords]
+    aoi_pixel_bounds = [(min(x[0] for x in aoi_coords), min(y[1] for y in aoi_coords)),
+                        (max(x[0] for x in aoi_coords), max(y[1] for y in aoi_coords))]
+    crop_box = (aoi_pixel_bounds[0][0], aoi_pixel_bounds[0][1],
+                aoi_pixel_bounds[1][0], aoi_pixel_bounds[1][1])
+    aoi_image = stitched_image.crop(crop_box)
+    mask = Image.new('L', aoi_image.size, 0)
+    draw = ImageDraw.Draw(mask)
+    relative_aoi_coords = [(x[0] - aoi_pixel_bounds[0][0], x[1] - aoi_pixel_bounds[0][1]) for x in aoi_coords]
+    draw.polygon(relative_aoi_coords, fill=255)
+    black_background = Image.new('RGB', aoi_image.size)
+    return Image.composite(aoi_image, black_background, mask)
+
+
+def make_aoi(rng, jagged=False):
+    """A star-shaped AOI with `vertex_count` vertices and small square holes, in BD09 lon/lat."""
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertex_count))
+    if jagged:
+        # 半径随机跳变，每行有大量交点（最坏情况）
+        radii = rng.uniform(0.7, 1.0, vertex_count)
+    else:
+        radii = 0.85 + 0.1 * np.sin(5 * angles) + 0.03 * np.sin(37 * angles) + rng.uniform(0, 0.005, vertex_count)
+    lon = 120.1 + 0.01 * radii * np.cos(angles)
+    lat = 30.3 + 0.01 * radii * np.sin(angles)
+    holes = []
+    for cx, cy in rng.uniform(-0.004, 0.004, (hole_count, 2)):
+        d = 0.0003
+        holes.append([(120.1 + cx - d, 30.3 + cy - d), (120.1 + cx + d, 30.3 + cy - d),
+                      (120.1 + cx + d, 30.3 + cy + d), (120.1 + cx - d, 30.3 + cy + d)])
+    return Polygon(np.column_stack((lon, lat)), holes)
+
+
+def timed(func, *args):
+    best, result = float('inf'), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# 原地遮罩会修改输入，每次计时前复制一份（复制不计入时间）
+def timed_in_place(array, polygon, tile_bounds):
+    best, result = float('inf'), None
+    for _ in range(repeats):
+        target = array.copy()
+        start = time.perf_counter()
+        result = img_crawl.mask_aoi(target, polygon, tile_bounds, in_place=True)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(polygon, image, array):
+    tile_bounds = polygon.bounds
+    legacy_time, legacy = timed(legacy_mask, image, polygon, tile_bounds)
+    image_time, image_masked = timed(img_crawl.mask_aoi, image, polygon, tile_bounds)
+    array_time, masked = timed(img_crawl.mask_aoi, array, polygon, tile_bounds)
+    in_place_time, in_place_masked = timed_in_place(array, polygon, tile_bounds)
+
+    # 与原实现比较外环遮罩（原实现不处理空洞，因此比较时去掉空洞）
+    shell_masked = img_crawl.mask_aoi(array, Polygon(polygon.exterior), tile_bounds)
+    differing = np.any(np.asarray(legacy) != shell_masked, axis=2).mean()
+    holes_masked = masked.any(axis=2).sum() < shell_masked.any(axis=2).sum()
+    same = np.array_equal(masked, in_place_masked) and np.array_equal(masked, np.asarray(image_masked))
+
+    logger.info(f"legacy PIL mask: {legacy_time:.3f}s")
+    # PIL 输入/输出时裁剪、转换为数组和转换回 PIL 图像的复制占了大部分时间
+    logger.info(f"vectorized mask, PIL image in/out: {image_time:.3f}s ({legacy_time / image_time:.1f}x)")
+    logger.info(f"vectorized mask, array in, new array out: {array_time:.3f}s ({legacy_time / array_time:.1f}x)")
+    logger.info(f"vectorized mask, array masked in place: {in_place_time:.3f}s ({legacy_time / in_place_time:.1f}x)")
+    logger.info(f"pixels differing from the legacy mask (exterior ring only): {differing:.4%}, "
+                f"holes masked out: {holes_masked}, same result on every path: {same}")
+    return legacy_time / in_place_time if same else 0.0
+
+
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, filter=lambda record: not record['message'].startswith('Cropping'))
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 256, (image_size[1], image_size[0], 3), dtype=np.uint8)
+    image = Image.fromarray(array)
+
+    logger.info(f"{image_size[0]}x{image_size[1]} AOI, {vertex_count} vertices, {hole_count} holes")
+    speedup = run(make_aoi(rng), image, array)
+    logger.info("Jagged AOI (many runs per row):")
+    run(make_aoi(rng, jagged=True), image, array)
+    sys.exit(0 if speedup >= 5 else 1)
@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import sys
+
+from loguru import logger
+from shapely import Polygon
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.tile_plan import plan_tiles
+
+# 规划参数
+aoi_file = 'aoi.csv'
+zoom = 19
+
+# 加载 v2/img-crawl.py（文件名带连字符，不能直接 import）
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'img-crawl.py')
+spec = importlib.util.spec_from_file_location('img_crawl', script_path)
+img_crawl = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(img_crawl)
+
+
+# 细长的斜向 AOI 和 L 形 AOI（BD09 经纬度），外接矩形内大部分瓦片都不与多边形相交
+def synthetic_aois():
+    lon, lat, d = 120.1, 30.3, 0.0002
+    diagonal = Polygon([(lon, lat), (lon + d, lat), (lon + 0.02 + d, lat + 0.02), (lon + 0.02, lat + 0.02)])
+    l_shape = Polygon([(lon, lat), (lon + 0.02, lat), (lon + 0.02, lat + 0.001), (lon + 0.001, lat + 0.001),
+                       (lon + 0.001, lat + 0.02), (lon, lat + 0.02)])
+    return [diagonal, l_shape]
+
+
+if __name__ == "__main__":
+    # 统计 AOI 文件只下载与多边形相交的瓦片时，相比下载外接矩形覆盖的全部瓦片能省下多少
+    if os.path.exists(aoi_file):
+        plan_tiles([aoi['polygon'] for aoi in img_crawl.iter_aois(aoi_file)], zoom).log_summary(aoi_file)
+    else:
+        logger.info(f"{aoi_file} not found, skipped")
+    plan_tiles(synthetic_aois(), zoom).log_summary('diagonal and L-shaped AOIs')